@@ -30,8 +30,21 @@ usage() {
     exit 1
 }
 
+RUST_BUILD_UTILS_ROOT="$(dirname "$(readlink -f "$0")")/../.."
+
 # Detect architecture from the binary file and map it to rust_build_utils target
 detect_binary_arch_from_bin() {
+    # SDK images without binutils fall back to rust_build_utils.elf, when it is
+    # available next to this script
+    if ! command -v readelf >/dev/null; then
+        if command -v python3 >/dev/null && [ -f "$RUST_BUILD_UTILS_ROOT/rust_build_utils/elf.py" ]; then
+            PYTHONPATH="$RUST_BUILD_UTILS_ROOT${PYTHONPATH:+:$PYTHONPATH}" python3 -m rust_build_utils.elf arch "$1"
+            return
+        fi
+        echo "ERROR: readelf or python3 is needed to detect the arch of $1" >&2
+        exit 1
+    fi
+
     machine=$(readelf -h "$1" | awk -F: '/Machine:/ {print $2}' | xargs)
     case "$machine" in
         "Advanced Micro Devices X86-64") echo "x86_64" ;;
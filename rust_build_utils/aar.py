@@ -0,0 +1,265 @@
+import os
+import shutil
+import struct
+import zipfile
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Collection, List, Mapping, Optional, Tuple
+
+import rust_build_utils.publish as publish
+from rust_build_utils.publish import StrPath
+
+# Gradle doesn't preserve file timestamps in AARs, entries get this constant date
+ZIP_DATE_TIME = (1980, 2, 1, 0, 0, 0)
+COMPRESS_LEVEL = 6
+
+_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+_LOCAL_HEADER_SIGNATURE = 0x04034B50
+_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+_CENTRAL_HEADER_SIGNATURE = 0x02014B50
+_END_OF_CENTRAL_DIRECTORY = struct.Struct("<IHHHHIIH")
+_END_OF_CENTRAL_DIRECTORY_SIGNATURE = 0x06054B50
+_FLAG_ENCRYPTED = 0x1
+_FLAG_UTF8 = 0x800
+_ZIP_LIMIT = 0xFFFFFFFF
+_MAX_ENTRIES = 0xFFFF
+_CREATE_SYSTEM_UNIX = 3
+_COPY_BUFFER_SIZE = 1 << 20
+
+
+class AarError(Exception):
+    pass
+
+
+@dataclass
+class _Entry:
+    name: bytes
+    flags: int
+    method: int
+    dos_time: int
+    dos_date: int
+    crc: int
+    compressed_size: int
+    size: int
+    create_system: int
+    external_attr: int
+    offset: int
+
+
+def _dos_date_time(date_time: Tuple[int, ...]) -> Tuple[int, int]:
+    year, month, day, hour, minute, second = date_time
+    dos_date = (year - 1980) << 9 | month << 5 | day
+    dos_time = hour << 11 | minute << 5 | second // 2
+    return dos_date, dos_time
+
+
+def _check_limit(name: str, value: int) -> None:
+    if value >= _ZIP_LIMIT:
+        raise AarError(f"{name} is too large for a zip without zip64 extensions")
+
+
+class ZipWriter:
+    """Minimal zip writer for AARs, without zip64 extensions.
+
+    Entries are either copied still compressed from another zip or deflated
+    while being streamed from a file, so no entry is ever held in memory.
+    """
+
+    def __init__(self, f: BinaryIO):
+        self._f = f
+        self._entries: List[_Entry] = []
+
+    def _write_local_header(self, entry: _Entry) -> None:
+        _check_limit("archive", entry.offset)
+        self._f.write(
+            _LOCAL_HEADER.pack(
+                _LOCAL_HEADER_SIGNATURE,
+                20 if entry.method == zipfile.ZIP_DEFLATED else 10,
+                entry.flags,
+                entry.method,
+                entry.dos_time,
+                entry.dos_date,
+                entry.crc,
+                entry.compressed_size,
+                entry.size,
+                len(entry.name),
+                0,
+            )
+        )
+        self._f.write(entry.name)
+
+    def copy_entry(self, source: zipfile.ZipFile, info: zipfile.ZipInfo) -> None:
+        """Copies entry `info` of `source` without decompressing it."""
+        if info.flag_bits & _FLAG_ENCRYPTED:
+            raise AarError(f"{info.filename} is encrypted")
+        assert source.fp
+        source.fp.seek(info.header_offset)
+        header = source.fp.read(_LOCAL_HEADER.size)
+        fields = _LOCAL_HEADER.unpack(header)
+        if fields[0] != _LOCAL_HEADER_SIGNATURE:
+            raise AarError(f"bad local header of {info.filename}")
+        source.fp.seek(fields[9] + fields[10], os.SEEK_CUR)
+
+        dos_date, dos_time = _dos_date_time(info.date_time)
+        entry = _Entry(
+            name=info.filename.encode("utf-8"),
+            # Sizes are known, so no data descriptor is written
+            flags=_FLAG_UTF8 if not info.filename.isascii() else 0,
+            method=info.compress_type,
+            dos_time=dos_time,
+            dos_date=dos_date,
+            crc=info.CRC,
+            compressed_size=info.compress_size,
+            size=info.file_size,
+            create_system=info.create_system,
+            external_attr=info.external_attr,
+            offset=self._f.tell(),
+        )
+        self._write_local_header(entry)
+        remaining = info.compress_size
+        while remaining:
+            chunk = source.fp.read(min(remaining, _COPY_BUFFER_SIZE))
+            if not chunk:
+                raise AarError(f"{info.filename} is truncated")
+            self._f.write(chunk)
+            remaining -= len(chunk)
+        self._entries.append(entry)
+
+    def write_file(self, name: str, path: StrPath) -> None:
+        """Adds file `path` as entry `name`, deflated while it is read."""
+        dos_date, dos_time = _dos_date_time(ZIP_DATE_TIME)
+        entry = _Entry(
+            name=name.encode("utf-8"),
+            flags=_FLAG_UTF8 if not name.isascii() else 0,
+            method=zipfile.ZIP_DEFLATED,
+            dos_time=dos_time,
+            dos_date=dos_date,
+            crc=0,
+            compressed_size=0,
+            size=0,
+            create_system=_CREATE_SYSTEM_UNIX,
+            external_attr=(0o100644 << 16),
+            offset=self._f.tell(),
+        )
+        self._write_local_header(entry)
+
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        with open(path, "rb") as f:
+            while chunk := f.read(_COPY_BUFFER_SIZE):
+                entry.crc = zlib.crc32(chunk, entry.crc)
+                entry.size += len(chunk)
+                compressed = compressor.compress(chunk)
+                entry.compressed_size += len(compressed)
+                self._f.write(compressed)
+        compressed = compressor.flush()
+        entry.compressed_size += len(compressed)
+        self._f.write(compressed)
+        _check_limit(name, max(entry.size, entry.compressed_size))
+
+        # Sizes are only known now, the header is rewritten in place
+        end = self._f.tell()
+        self._f.seek(entry.offset)
+        self._write_local_header(entry)
+        self._f.seek(end)
+        self._entries.append(entry)
+
+    def close(self) -> None:
+        if len(self._entries) > _MAX_ENTRIES:
+            raise AarError("too many entries for a zip without zip64 extensions")
+        start = self._f.tell()
+        for entry in self._entries:
+            self._f.write(
+                _CENTRAL_HEADER.pack(
+                    _CENTRAL_HEADER_SIGNATURE,
+                    entry.create_system << 8 | 20,
+                    20 if entry.method == zipfile.ZIP_DEFLATED else 10,
+                    entry.flags,
+                    entry.method,
+                    entry.dos_time,
+                    entry.dos_date,
+                    entry.crc,
+                    entry.compressed_size,
+                    entry.size,
+                    len(entry.name),
+                    0,
+                    0,
+                    0,
+                    0,
+                    entry.external_attr,
+                    entry.offset,
+                )
+            )
+            self._f.write(entry.name)
+        end = self._f.tell()
+        _check_limit("central directory", end)
+        self._f.write(
+            _END_OF_CENTRAL_DIRECTORY.pack(
+                _END_OF_CENTRAL_DIRECTORY_SIGNATURE,
+                0,
+                0,
+                len(self._entries),
+                len(self._entries),
+                end - start,
+                start,
+                0,
+            )
+        )
+
+
+def jni_entries(lib_path: StrPath) -> Mapping[str, str]:
+    """Native libraries of a `jniLibs` directory (`<abi>/*.so`) by AAR entry name."""
+    entries = {}
+    for root, dirs, files in os.walk(lib_path):
+        dirs.sort()
+        for file in sorted(files):
+            # Like the Android gradle plugin, only shared libraries are packaged
+            if file.endswith(".so"):
+                path = os.path.join(root, file)
+                relative = Path(os.path.relpath(path, lib_path)).as_posix()
+                entries[f"jni/{relative}"] = path
+    return entries
+
+
+def write_aar(
+    output: StrPath,
+    base_aar: StrPath,
+    jni_libs: Mapping[str, StrPath],
+    previous: Optional[StrPath] = None,
+    unchanged: Collection[str] = (),
+) -> Tuple[int, int]:
+    """Writes `output` with the entries of `base_aar` (an AAR built without
+    native libraries) and the native libraries `jni_libs` (entry name to path).
+
+    Libraries in `unchanged` are copied still compressed from the `previous`
+    AAR instead of being compressed again. `output` is replaced atomically and
+    may be `previous`. Returns the number of libraries copied and compressed.
+    """
+    copied = compressed = 0
+    with publish.atomic_path(output) as tmp_path:
+        with open(tmp_path, "wb") as f, zipfile.ZipFile(base_aar) as base:
+            writer = ZipWriter(f)
+            for info in base.infolist():
+                if not info.filename.startswith("jni/"):
+                    writer.copy_entry(base, info)
+
+            previous_zip = zipfile.ZipFile(previous) if previous else None
+            try:
+                previous_infos = (
+                    {info.filename: info for info in previous_zip.infolist()}
+                    if previous_zip
+                    else {}
+                )
+                for name, path in jni_libs.items():
+                    if previous_zip and name in unchanged and name in previous_infos:
+                        writer.copy_entry(previous_zip, previous_infos[name])
+                        copied += 1
+                    else:
+                        writer.write_file(name, path)
+                        compressed += 1
+            finally:
+                if previous_zip:
+                    previous_zip.close()
+            writer.close()
+        shutil.copymode(base_aar, tmp_path)
+    return copied, compressed
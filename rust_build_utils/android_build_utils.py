@@ -1,14 +1,24 @@
+import functools
 import os
 import shutil
-import subprocess
+import time
+import zipfile
+import rust_build_utils.aar as aar
+import rust_build_utils.elf as elf
+import rust_build_utils.fingerprint as fingerprint
+import rust_build_utils.publish as publish
 import rust_build_utils.rust_utils as rutils
+import rust_build_utils.symbol_store as symbol_store
+import rust_build_utils.tracing as tracing
 from rust_build_utils.rust_utils_config import (
     GLOBAL_CONFIG,
     NDK_IMAGE_PATH,
     NDK_VERSION,
 )
+from dataclasses import dataclass
+from pathlib import Path
 from string import Template
-from typing import Optional
+from typing import Dict, Optional
 
 
 TOOLCHAIN = (
@@ -16,27 +26,39 @@ TOOLCHAIN = (
 )
 
 
-def strip(project: rutils.Project, config: rutils.CargoConfig, packages=None):
-    if config.target_os != "android" or config.debug or packages == None:
-        return
+STRIP_BIN = f"{TOOLCHAIN}/bin/llvm-objcopy"
 
-    strip_bin = f"{TOOLCHAIN}/bin/llvm-objcopy"
 
-    arch = GLOBAL_CONFIG[config.target_os]["archs"][config.arch]["dist"]
-    dist_dir = project.get_distribution_path(config.target_os, arch, "", config.debug)
+def _strip_binary(
+    config: rutils.CargoConfig,
+    store: Optional[symbol_store.SymbolStore],
+    bin_path: str,
+):
+    strip_bin = STRIP_BIN
 
-    def _create_debug_symbols(bin_path: str):
+    def _extract_debug_symbols(bin_path: str, output: str, compression: str = "zlib"):
         create_debug_symbols_cmd = [
             f"{strip_bin}",
             "--only-keep-debug",
-            "--compress-debug-sections=zlib",
+            f"--compress-debug-sections={compression}",
             f"{bin_path}",
-            f"{bin_path}.debug",
+            f"{output}",
         ]
-        rutils.run_command(create_debug_symbols_cmd)
+        rutils.run_command(create_debug_symbols_cmd, env=config.env)
 
-        set_read_only_cmd = ["chmod", "0444", f"{bin_path}.debug"]
-        rutils.run_command(set_read_only_cmd)
+    def _create_debug_symbols(bin_path: str):
+        if store and store.deposit(
+            bin_path,
+            lambda output, compression: _extract_debug_symbols(
+                bin_path, str(output), compression
+            ),
+        ):
+            if os.path.exists(f"{bin_path}.debug"):
+                os.remove(f"{bin_path}.debug")
+            return
+
+        _extract_debug_symbols(bin_path, f"{bin_path}.debug")
+        os.chmod(f"{bin_path}.debug", 0o444)
 
     def _strip_debug_symbols(bin_path: str):
         strip_cmd = [
@@ -44,13 +66,41 @@ def strip(project: rutils.Project, config: rutils.CargoConfig, packages=None):
             "--strip-unneeded" if bin_path.endswith(".a") else "--strip-all",
             f"{bin_path}",
         ]
-        rutils.run_command(strip_cmd)
+        rutils.run_command(strip_cmd, env=config.env)
 
-    for _, bins in packages.items():
-        for _, bin in bins.items():
-            bin_path = f"{dist_dir}/{bin}"
-            _create_debug_symbols(bin_path)
-            _strip_debug_symbols(bin_path)
+    # Eg. when the hook runs again on the same dist directory
+    if elf.is_stripped(bin_path):
+        print(f"{bin_path} is already stripped, skipping")
+        return
+    _create_debug_symbols(bin_path)
+    _strip_debug_symbols(bin_path)
+
+
+def strip(project: rutils.Project, config: rutils.CargoConfig, packages=None):
+    if config.target_os != "android" or config.debug or packages == None:
+        return
+
+    arch = GLOBAL_CONFIG[config.target_os]["archs"][config.arch]["dist"]
+    dist_dir = project.get_distribution_path(config.target_os, arch, "", config.debug)
+
+    store = symbol_store.from_env()
+
+    # Binaries are independent, so they are processed concurrently
+    rutils.run_in_parallel(
+        {
+            bin: functools.partial(_strip_binary, config, store, f"{dist_dir}/{bin}")
+            for bins in packages.values()
+            for bin in bins.values()
+        },
+        "strip",
+    )
+
+
+def strip_artifact(project: rutils.Project, config: rutils.CargoConfig, bin_path: str):
+    """`post_artifact` variant of `strip`, for a single published binary."""
+    if config.target_os != "android" or config.debug:
+        return
+    _strip_binary(config, symbol_store.from_env(), bin_path)
 
 
 def _process_template(
@@ -60,54 +110,70 @@ def _process_template(
         filedata = Template(f.read())
         result = filedata.substitute(substitution_data)
 
-    with open(processed_file, "w") as f:
-        f.write(result)
+    _write_if_changed(processed_file, result)
 
 
-def _generate_aar(
+def _write_if_changed(path: str, content: str) -> None:
+    # Rewriting unchanged files would make gradle consider them changed
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            if f.read() == content:
+                return
+    with open(path, "w") as f:
+        f.write(content)
+
+
+@dataclass(frozen=True)
+class GradleOptions:
+    """How gradle is run to build the AAR.
+
+    With `warm`, the gradle project in `android_aar/` is kept between runs and
+    only changed files are rewritten, the daemon is kept running and a local
+    build cache in the user cache directory is used, so unchanged bindings are
+    not compiled again.
+    """
+
+    warm: bool = False
+    heap: str = "1g"
+
+
+def _prepare_gradle_project(
     project: rutils.Project,
-    project_name: str,
     package_name: str,
     artifact_id: str,
     version: str,
     binding_path: str,
-    lib_path: str,
+    lib_path: Optional[str],
     settings_gradle_path: Optional[str],
     build_gradle_path: Optional[str],
     init_gradle_path: Optional[str],
-):
-    if version.startswith("v"):
-        version = version[len("v") :]
-    script_dir = os.path.dirname(__file__)
+    gradle: GradleOptions = GradleOptions(),
+) -> str:
+    """Writes the gradle project building the AAR and returns its main module
+    directory. Native libraries are left out when `lib_path` is None."""
     out_dir = os.path.join(project.root_dir, "android_aar")
     main_dir = os.path.join(out_dir, "main")
-    if os.path.exists(out_dir):
+    if os.path.exists(out_dir) and not gradle.warm:
         shutil.rmtree(out_dir)
     os.makedirs(main_dir, exist_ok=True)
     if settings_gradle_path:
-        shutil.copyfile(settings_gradle_path, f"{out_dir}/settings.gradle")
+        with open(settings_gradle_path, "r") as f:
+            _write_if_changed(f"{out_dir}/settings.gradle", f.read())
     else:
-        with open(f"{out_dir}/settings.gradle", "w") as f:
-            f.write("include ':main'\n")
+        _write_if_changed(f"{out_dir}/settings.gradle", "include ':main'\n")
     if init_gradle_path:
         init_gradle_template = init_gradle_path
         init_gradle_processed = os.path.join(out_dir, "init.gradle")
-        init_gradle_dict = {
-            "PATH_TO_DEPENDENT_CRATE": os.path.join(project.root_dir, "Cargo.toml")
-        }
-        _process_template(init_gradle_template, init_gradle_processed, init_gradle_dict)
+        _process_template(
+            init_gradle_template, init_gradle_processed, _init_gradle_dict(project)
+        )
 
     gradle_dict = {
         "PACKAGE_NAME": package_name,
         "ARTIFACT_ID": artifact_id,
         "VERSION": version,
     }
-    if build_gradle_path:
-        gradle_template = build_gradle_path
-    else:
-        gradle_template = os.path.join(
-            script_dir, "..", "aar_templates", "__build.gradle"
-        )
+    gradle_template = build_gradle_path or _default_build_gradle_path()
     gradle_processed = os.path.join(main_dir, "build.gradle")
     print(f"Using gradle template: {gradle_template}")
     _process_template(gradle_template, gradle_processed, gradle_dict)
@@ -119,28 +185,283 @@ def _generate_aar(
     os.makedirs(internal_main_dir, exist_ok=True)
 
     manifest_dict = {"PACKAGE_NAME": package_name}
-    manifest_template = os.path.join(
-        script_dir, "..", "aar_templates", "__AndroidManifest.xml"
-    )
     manifest_processed = os.path.join(internal_main_dir, "AndroidManifest.xml")
 
-    _process_template(manifest_template, manifest_processed, manifest_dict)
+    _process_template(_manifest_template_path(), manifest_processed, manifest_dict)
+
+    # Only a single bindings directory is kept in the project
+    for entry in os.listdir(internal_main_dir):
+        path = os.path.join(internal_main_dir, entry)
+        if os.path.isdir(path) and entry not in {binding_type, "jniLibs"}:
+            shutil.rmtree(path)
+    publish.sync_tree(binding_path, binding_src_dir)
+    if lib_path is not None:
+        publish.sync_tree(lib_path, jni_libs_dir)
+    elif os.path.exists(jni_libs_dir):
+        shutil.rmtree(jni_libs_dir)
+    return main_dir
+
+
+def _init_gradle_dict(project: rutils.Project) -> Dict[str, str]:
+    return {"PATH_TO_DEPENDENT_CRATE": os.path.join(project.root_dir, "Cargo.toml")}
+
+
+def _default_build_gradle_path() -> str:
+    script_dir = os.path.dirname(__file__)
+    return os.path.join(script_dir, "..", "aar_templates", "__build.gradle")
+
+
+def _manifest_template_path() -> str:
+    script_dir = os.path.dirname(__file__)
+    return os.path.join(script_dir, "..", "aar_templates", "__AndroidManifest.xml")
+
+
+_GRADLE_WARM_INIT_SCRIPT = """\
+settingsEvaluated {{ settings ->
+    settings.buildCache {{
+        local {{
+            directory = new File('{cache_dir}')
+        }}
+    }}
+}}
+gradle.taskGraph.whenReady {{
+    new File('{configured_file}').text = System.currentTimeMillis().toString()
+}}
+"""
+
+
+def _gradle_build(main_dir: str, gradle: GradleOptions = GradleOptions()) -> str:
+    command = [
+        "gradle",
+        "build",
+        "-p",
+        main_dir,
+        f"-Dorg.gradle.jvmargs=-Xmx{gradle.heap}",
+    ]
+    if not gradle.warm:
+        tracing.check_call(command)
+        return os.path.join(main_dir, "build", "outputs", "aar", "main-release.aar")
+
+    out_dir = os.path.dirname(main_dir)
+    cache_dir = fingerprint.get_user_cache_dir() / "gradle-build-cache"
+    configured_file = os.path.join(out_dir, ".configured")
+    init_script = os.path.join(out_dir, "rust_build_utils.init.gradle")
+    _write_if_changed(
+        init_script,
+        _GRADLE_WARM_INIT_SCRIPT.format(
+            cache_dir=cache_dir.as_posix(),
+            configured_file=Path(configured_file).as_posix(),
+        ),
+    )
+    if os.path.exists(configured_file):
+        os.remove(configured_file)
+
+    start = time.time()
+    tracing.check_call(
+        command + ["--daemon", "--build-cache", "--init-script", init_script]
+    )
+    end = time.time()
+
+    # Configuration includes connecting to (or starting) the daemon
+    if os.path.exists(configured_file):
+        with open(configured_file, "r") as f:
+            configured = int(f.read()) / 1000
+        print(
+            f"|TIMING| gradle configure: {configured - start:.2f}s, "
+            f"execute: {end - configured:.2f}s"
+        )
+    else:
+        print(f"|TIMING| gradle: {end - start:.2f}s")
+    return os.path.join(main_dir, "build", "outputs", "aar", "main-release.aar")
 
-    shutil.copytree(binding_path, binding_src_dir, dirs_exist_ok=True)
-    shutil.copytree(lib_path, jni_libs_dir, dirs_exist_ok=True)
 
-    subprocess.check_call(
-        ["gradle", "build", "-p", main_dir, "-Dorg.gradle.jvmargs=-Xmx1g"]
+def _gradle_inputs(
+    project: rutils.Project,
+    package_name: str,
+    artifact_id: str,
+    version: str,
+    binding_path: str,
+    settings_gradle_path: Optional[str],
+    build_gradle_path: Optional[str],
+    init_gradle_path: Optional[str],
+) -> str:
+    """Digest of everything the gradle project is generated from, except the
+    native libraries."""
+    checksums = rutils.get_checksum_cache(project)
+    binding_files = sorted(
+        os.path.join(root, file)
+        for root, _, files in os.walk(binding_path)
+        for file in files
     )
-    aar_output_path = os.path.join(
-        main_dir, "build", "outputs", "aar", "main-release.aar"
+    templates = [
+        settings_gradle_path,
+        build_gradle_path or _default_build_gradle_path(),
+        init_gradle_path,
+        _manifest_template_path(),
+    ]
+    inputs = {
+        "package_name": package_name,
+        "artifact_id": artifact_id,
+        "version": version,
+        "init_gradle": _init_gradle_dict(project),
+        "binding_type": binding_path.split("/")[-1],
+        "bindings": {
+            os.path.relpath(path, binding_path): digest
+            for path, digest in checksums.checksums(binding_files).items()
+        },
+        "templates": [checksums.checksum(path) if path else None for path in templates],
+    }
+    checksums.save()
+    return fingerprint.digest(inputs)
+
+
+def _generate_aar_incrementally(
+    project: rutils.Project,
+    aar_dest_path: str,
+    package_name: str,
+    artifact_id: str,
+    version: str,
+    binding_path: str,
+    lib_path: str,
+    settings_gradle_path: Optional[str],
+    build_gradle_path: Optional[str],
+    init_gradle_path: Optional[str],
+    gradle: GradleOptions = GradleOptions(),
+) -> None:
+    """Builds the AAR without native libraries with gradle, only when its inputs
+    change, and adds the native libraries to it in-process."""
+    aar_dir = project.get_build_dir() / "aar"
+    base_aar = aar_dir / f"{os.path.basename(aar_dest_path)}.base"
+    state_path = aar_dir / f"{os.path.basename(aar_dest_path)}.json"
+    state = fingerprint.load(state_path) or {}
+
+    gradle_inputs = _gradle_inputs(
+        project,
+        package_name,
+        artifact_id,
+        version,
+        binding_path,
+        settings_gradle_path,
+        build_gradle_path,
+        init_gradle_path,
     )
+    # A missing or damaged base AAR is rebuilt, even when its inputs are unchanged
+    if state.get("gradle") == gradle_inputs and zipfile.is_zipfile(base_aar):
+        print("Bindings and gradle templates are unchanged, skipping gradle")
+    else:
+        main_dir = _prepare_gradle_project(
+            project,
+            package_name,
+            artifact_id,
+            version,
+            binding_path,
+            None,
+            settings_gradle_path,
+            build_gradle_path,
+            init_gradle_path,
+            gradle,
+        )
+        aar_dir.mkdir(parents=True, exist_ok=True)
+        publish.publish_file(_gradle_build(main_dir, gradle), base_aar)
+
+    checksums = rutils.get_checksum_cache(project)
+    jni_libs = aar.jni_entries(lib_path)
+    lib_checksums = checksums.checksums(list(jni_libs.values()))
+    entries = {name: lib_checksums[path] for name, path in jni_libs.items()}
+    checksums.save()
+
+    # Libraries are reused from the AAR written last time, unless it was modified
+    previous: Optional[str] = None
+    unchanged = set()
+    if os.path.exists(aar_dest_path):
+        st = os.stat(aar_dest_path)
+        if state.get("aar") == [st.st_size, st.st_mtime_ns]:
+            previous = aar_dest_path
+            unchanged = {
+                name
+                for name, digest in entries.items()
+                if state.get("entries", {}).get(name) == digest
+            }
+
+    start = time.monotonic()
+    try:
+        copied, compressed = aar.write_aar(
+            aar_dest_path, base_aar, jni_libs, previous, unchanged
+        )
+    except (zipfile.BadZipFile, aar.AarError) as e:
+        if previous is None:
+            raise
+        print(f"Unable to reuse libraries of {previous} ({e}), compressing all")
+        copied, compressed = aar.write_aar(aar_dest_path, base_aar, jni_libs)
+    print(
+        f"|TIMING| write_aar {aar_dest_path}: {time.monotonic() - start:.2f}s "
+        f"({copied} libraries reused, {compressed} compressed)"
+    )
+
+    st = os.stat(aar_dest_path)
+    fingerprint.save(
+        state_path,
+        {
+            "gradle": gradle_inputs,
+            "entries": entries,
+            "aar": [st.st_size, st.st_mtime_ns],
+        },
+    )
+
+
+def _generate_aar(
+    project: rutils.Project,
+    project_name: str,
+    package_name: str,
+    artifact_id: str,
+    version: str,
+    binding_path: str,
+    lib_path: str,
+    settings_gradle_path: Optional[str],
+    build_gradle_path: Optional[str],
+    init_gradle_path: Optional[str],
+    incremental: bool = False,
+    gradle: GradleOptions = GradleOptions(),
+):
+    if version.startswith("v"):
+        version = version[len("v") :]
     dist_path = os.path.join(project.root_dir, "dist")
     os.makedirs(dist_path, exist_ok=True)
     aar_dest_path = os.path.join(dist_path, f"{project_name}.aar")
+
+    if incremental:
+        _generate_aar_incrementally(
+            project,
+            aar_dest_path,
+            package_name,
+            artifact_id,
+            version,
+            binding_path,
+            lib_path,
+            settings_gradle_path,
+            build_gradle_path,
+            init_gradle_path,
+            gradle,
+        )
+        return
+
+    main_dir = _prepare_gradle_project(
+        project,
+        package_name,
+        artifact_id,
+        version,
+        binding_path,
+        lib_path,
+        settings_gradle_path,
+        build_gradle_path,
+        init_gradle_path,
+        gradle,
+    )
+    aar_output_path = _gradle_build(main_dir, gradle)
     shutil.copy2(aar_output_path, aar_dest_path)
 
 
+@tracing.phase("aar")
 def generate_aar(project: rutils.Project, args):
     _generate_aar(
         project,
@@ -153,4 +474,9 @@ def generate_aar(project: rutils.Project, args):
         args.settings_gradle_path,
         args.build_gradle_path,
         args.init_gradle_path,
+        getattr(args, "incremental", False),
+        GradleOptions(
+            warm=getattr(args, "warm_gradle", False),
+            heap=getattr(args, "gradle_heap", "1g"),
+        ),
     )
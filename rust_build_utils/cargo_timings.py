@@ -0,0 +1,179 @@
+import json
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import rust_build_utils.publish as publish
+
+# Modes of units running (not compiling) a build script
+BUILD_SCRIPT_RUN_MODES = ("run-custom-build",)
+
+
+def timings_html_path(target_dir: str) -> Path:
+    """Report written by `cargo build --timings`, overwritten by every build."""
+    return Path(target_dir) / "cargo-timings" / "cargo-timing.html"
+
+
+def load_units(html_path: Path) -> List[Dict[str, Any]]:
+    """Parses the `UNIT_DATA` array embedded in a cargo timings html report.
+
+    Every unit has (among others) `i`, `name`, `version`, `mode`, `target`,
+    `start`, `duration`, `rmeta_time`, `unlocked_units` and
+    `unlocked_rmeta_units`. Times are in seconds since the start of the build.
+    """
+    with open(html_path, "r", encoding="utf-8") as f:
+        html = f.read()
+    marker = "const UNIT_DATA = "
+    index = html.find(marker)
+    if index < 0:
+        raise ValueError(f"UNIT_DATA not found in {html_path}")
+    units, _ = json.JSONDecoder().raw_decode(html, index + len(marker))
+    return units
+
+
+def _unit_name(unit: Dict[str, Any]) -> str:
+    name = f"{unit['name']} v{unit['version']}"
+    target = unit.get("target", "").strip()
+    if target:
+        name += f" ({target})"
+    return name
+
+
+def _frontend_time(unit: Dict[str, Any]) -> float:
+    # Units not producing metadata (binaries, build script runs) have no rmeta_time
+    rmeta_time = unit.get("rmeta_time")
+    return unit["duration"] if rmeta_time is None else rmeta_time
+
+
+def _has_metadata(unit: Dict[str, Any]) -> bool:
+    return unit.get("rmeta_time") is not None
+
+
+def critical_path(units: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Chain of units that determined the length of the build, first unit first.
+
+    Every unit is started by the dependency unlocking it last (when it finished,
+    or when its metadata was ready for pipelined dependencies). Following these
+    dependencies back from the unit finishing last gives the critical path.
+    """
+    by_index = {unit["i"]: unit for unit in units}
+    unlocked_by: Dict[int, int] = {}
+    unlocked_at: Dict[int, float] = {}
+    for unit in units:
+        end = unit["start"] + unit["duration"]
+        rmeta_end = unit["start"] + _frontend_time(unit)
+        for index, time in [(i, end) for i in unit.get("unlocked_units", [])] + [
+            (i, rmeta_end) for i in unit.get("unlocked_rmeta_units", [])
+        ]:
+            if time >= unlocked_at.get(index, -1.0):
+                unlocked_at[index] = time
+                unlocked_by[index] = unit["i"]
+
+    if not units:
+        return []
+    last = max(units, key=lambda u: u["start"] + u["duration"])
+    path = [last]
+    while path[-1]["i"] in unlocked_by:
+        path.append(by_index[unlocked_by[path[-1]["i"]]])
+    return list(reversed(path))
+
+
+def build_report(
+    units: List[Dict[str, Any]],
+    fresh_units: int = 0,
+    top: int = 15,
+) -> Dict[str, Any]:
+    def entry(unit: Dict[str, Any]) -> Dict[str, Any]:
+        # Only units producing metadata tell when the frontend was done
+        split = _has_metadata(unit)
+        return {
+            "unit": _unit_name(unit),
+            "start": round(unit["start"], 2),
+            "duration": round(unit["duration"], 2),
+            "frontend": round(unit["rmeta_time"], 2) if split else None,
+            "codegen_and_link": (
+                round(unit["duration"] - unit["rmeta_time"], 2) if split else None
+            ),
+        }
+
+    crates: Dict[str, float] = {}
+    for unit in units:
+        key = f"{unit['name']} v{unit['version']}"
+        crates[key] = crates.get(key, 0.0) + unit["duration"]
+
+    build_scripts = [
+        unit
+        for unit in units
+        if unit.get("mode") in BUILD_SCRIPT_RUN_MODES
+        or unit.get("target", "").strip() == "build script"
+    ]
+    split_units = [u for u in units if _has_metadata(u)]
+    path = critical_path(units)
+    # Pipelined units overlap, so this is less than the sum of their durations
+    path_duration = (
+        path[-1]["start"] + path[-1]["duration"] - path[0]["start"] if path else 0.0
+    )
+    return {
+        "total": round(max((u["start"] + u["duration"] for u in units), default=0), 2),
+        "units_built": len(units),
+        "units_fresh": fresh_units,
+        "cpu": round(sum(u["duration"] for u in units), 2),
+        "frontend": round(sum(u["rmeta_time"] for u in split_units), 2),
+        "codegen_and_link": round(
+            sum(u["duration"] - u["rmeta_time"] for u in split_units), 2
+        ),
+        # binaries, build scripts and their runs
+        "unsplit": round(sum(u["duration"] for u in units if not _has_metadata(u)), 2),
+        "slowest_crates": [
+            {"crate": name, "duration": round(duration, 2)}
+            for name, duration in sorted(crates.items(), key=lambda c: -c[1])[:top]
+        ],
+        "slowest_units": [
+            entry(u) for u in sorted(units, key=lambda u: -u["duration"])[:top]
+        ],
+        "build_scripts": [
+            entry(u) for u in sorted(build_scripts, key=lambda u: -u["duration"])
+        ],
+        "critical_path": [entry(u) for u in path],
+        "critical_path_duration": round(path_duration, 2),
+    }
+
+
+def format_report(report: Dict[str, Any], top: int = 10) -> str:
+    lines = [
+        f"total {report['total']:.2f}s, {report['units_built']} units built "
+        f"({report['units_fresh']} fresh), {report['cpu']:.2f}s of compile time: "
+        f"{report['frontend']:.2f}s frontend, {report['codegen_and_link']:.2f}s codegen+link, "
+        f"{report['unsplit']:.2f}s binaries and build scripts",
+        "slowest crates:",
+    ]
+    lines += [
+        f"  {c['duration']:8.2f}s  {c['crate']}" for c in report["slowest_crates"][:top]
+    ]
+    lines.append("build scripts:")
+    lines += [
+        f"  {u['duration']:8.2f}s  {u['unit']}" for u in report["build_scripts"][:top]
+    ]
+    lines.append(f"critical path ({report['critical_path_duration']:.2f}s):")
+    for u in report["critical_path"]:
+        split = (
+            f" (codegen+link {u['codegen_and_link']:.2f}s)"
+            if u["codegen_and_link"] is not None
+            else ""
+        )
+        lines.append(f"  {u['start']:8.2f}s +{u['duration']:.2f}s{split}  {u['unit']}")
+    return "\n".join(lines)
+
+
+def write_report(
+    html_path: Path, report_path: Path, fresh_units: int = 0
+) -> Optional[Dict[str, Any]]:
+    """Writes a json report of the cargo timings in `html_path` to `report_path`
+    and a readable version next to it. Returns None when cargo wrote no timings."""
+    if not html_path.exists():
+        return None
+    report = build_report(load_units(html_path), fresh_units)
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    with publish.atomic_write(report_path) as f:
+        json.dump(report, f, indent=2)
+    report_path.with_suffix(".txt").write_text(format_report(report) + "\n")
+    return report
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import mmap
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import rust_build_utils.publish as publish
+from rust_build_utils.publish import StrPath
+
+HASH_BUFFER_SIZE = 1 << 20
+# Oldest entries are dropped once the cache grows past this
+MAX_ENTRIES = 10000
+
+
+def sha256_file(path: StrPath) -> str:
+    """sha256 of a file, mmap'ed when possible. hashlib releases the GIL for
+    large updates, so this runs in parallel in threads."""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                sha256.update(mm)
+        except (ValueError, OSError):
+            # empty files and filesystems not supporting mmap
+            f.seek(0)
+            buffer = bytearray(HASH_BUFFER_SIZE)
+            view = memoryview(buffer)
+            while size := f.readinto(buffer):
+                sha256.update(view[:size])
+    return sha256.hexdigest()
+
+
+def _stat_key(path: StrPath) -> str:
+    st = os.stat(path)
+    return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+
+class ChecksumCache:
+    """sha256 checksums keyed by (device, inode, size, mtime), so files that were
+    not modified are never read again. Persisted to `path` when given."""
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, List] = self._load() if path else {}
+
+    def _load(self) -> Dict[str, List]:
+        assert self.path
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def get(self, path: StrPath) -> Optional[str]:
+        key = _stat_key(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry[1] = time.time()
+            return entry[0]
+
+    def record(self, path: StrPath, digest: str) -> None:
+        """Records a checksum that is known without reading the file, eg. of a
+        copy of a file with a known checksum."""
+        key = _stat_key(path)
+        with self._lock:
+            self._entries[key] = [digest, time.time()]
+
+    def checksum(self, path: StrPath) -> str:
+        key = _stat_key(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[1] = time.time()
+                return entry[0]
+
+        digest = sha256_file(path)
+        # Don't cache the result when the file was modified while being hashed
+        if _stat_key(path) == key:
+            with self._lock:
+                self._entries[key] = [digest, time.time()]
+        return digest
+
+    def checksums(
+        self, paths: List[str], max_workers: Optional[int] = None
+    ) -> Dict[str, str]:
+        """Checksums of `paths`, files that are not cached are hashed concurrently.
+
+        Used where all files are known upfront, eg. the native libraries of an
+        AAR. Builds hash artifacts as cargo reports them with `checksum`.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(zip(paths, executor.map(self.checksum, paths)))
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            # Merge with entries saved meanwhile by other processes
+            entries = self._load()
+            entries.update(self._entries)
+            if len(entries) > MAX_ENTRIES:
+                newest = sorted(entries.items(), key=lambda e: e[1][1])[-MAX_ENTRIES:]
+                entries = dict(newest)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with publish.atomic_write(self.path) as f:
+                json.dump(entries, f)
+            self._entries = entries
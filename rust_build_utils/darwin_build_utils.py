@@ -1,13 +1,31 @@
 from contextlib import contextmanager
+import errno
+import functools
 from pathlib import Path
 from rust_build_utils.rust_utils_config import GLOBAL_CONFIG
-from typing import Optional, List, Dict, Iterator
+from typing import (
+    Any,
+    Callable,
+    Optional,
+    List,
+    Dict,
+    Iterable,
+    Iterator,
+    Mapping,
+    Tuple,
+)
 import json
 import os
-import re
+import plistlib
+import rust_build_utils.checksum as checksum
+import rust_build_utils.fingerprint as fingerprint
+import rust_build_utils.macho as macho
+import rust_build_utils.publish as publish
 import rust_build_utils.rust_utils as rutils
+import rust_build_utils.tracing as tracing
 import shutil
-import subprocess
+import threading
+import time
 
 
 def get_universal_library_distribution_directory(
@@ -29,43 +47,82 @@ def get_xcframework_path(
     return Path(project.get_darwin_distribution_dir()) / f"{framework_name}.xcframework"
 
 
-def _get_load_command_version(
-    command_source: str, load_command: str, version_key: str
-) -> Optional[str]:
-    # Check if this is the right load command
-    if f"cmd {load_command}" not in command_source:
-        return None
+# Fields of `otool -l` load commands needed to find deployment targets
+_OTOOL_VERSION_FIELDS = ("cmd", "version", "minos", "sdk")
 
-    # Extract the appropriate version property
-    if match := re.search(rf"{version_key} (\d+\.\d+)", command_source):
-        return match.group(1)
-    else:
-        assert False, f"'{version_key}' not found in load command '{load_command}'"
 
+def _otool_load_commands(
+    lines: Iterable[str], fields: Tuple[str, ...] = _OTOOL_VERSION_FIELDS
+) -> Iterator[Dict[str, str]]:
+    """Yields the `fields` of every load command in `otool -l` output.
+
+    Reads the output line by line and keeps only the current load command,
+    so memory does not grow with the size of the output (eg. of archives with
+    thousands of members). The first value of a repeated field wins, eg. the
+    `version` of the first build tool of an LC_BUILD_VERSION command.
+    """
+    command: Optional[Dict[str, str]] = None
+    for line in lines:
+        if line.startswith("Load command "):
+            if command is not None:
+                yield command
+            command = {}
+            continue
+        if command is None:
+            continue
+        if line.rstrip().endswith(":"):
+            # Header of the next archive member or fat slice
+            yield command
+            command = None
+            continue
+        parts = line.split()
+        if len(parts) == 2 and parts[0] in fields:
+            command.setdefault(parts[0], parts[1])
+    if command is not None:
+        yield command
+
+
+def _load_command_versions(
+    lines: Iterable[str], load_command: str, version_key: str
+) -> List[str]:
+    versions = []
+    for command in _otool_load_commands(lines, ("cmd", version_key)):
+        if command.get("cmd") != load_command:
+            continue
+        version = command.get(version_key)
+        assert version, f"'{version_key}' not found in load command '{load_command}'"
+        # Only major and minor versions are compared
+        versions.append(".".join(version.split(".")[:2]))
+    return versions
+
+
+def _macho_versions(path: str, load_command: str, version_key: str) -> List[str]:
+    """Same as `_load_command_versions` of `otool -l` output, without spawning otool."""
+    versions = []
+    for command in macho.version_commands(path):
+        if command.name != load_command:
+            continue
+        version = command.get(version_key)
+        assert version, f"'{version_key}' not found in load command '{load_command}'"
+        # Only major and minor versions are compared, as for otool output
+        versions.append(".".join(version.split(".")[:2]))
+    return versions
 
-def _assert_load_commands(
-    load_commands: str, deployment_assert, fetch_max_version: bool = False
+
+def _assert_versions(
+    versions: List[str], deployment_assert, fetch_max_version: bool = False
 ) -> None:
     load_command = deployment_assert[0]
     version_key = deployment_assert[1]
     minimum_os = deployment_assert[2]
 
-    # Matches each Load command until the beginning of the next load command or \Z (EOF).
-    # re.DOTALL instructs `re` to match newlines for `.`.
-    load_command_regex = re.compile(
-        r"Load command \d+.*?(?=Load command \d+|\Z)", re.DOTALL
-    )
-
     found_minos_version = False
     max_version = 0.0
 
-    for command_source in re.findall(load_command_regex, load_commands):
-        version = _get_load_command_version(command_source, load_command, version_key)
-
-        if version:
-            max_version = max(max_version, float(version))
-            found_minos_version = True
-        if version and not fetch_max_version:
+    for version in versions:
+        max_version = max(max_version, float(version))
+        found_minos_version = True
+        if not fetch_max_version:
             assert (
                 version == minimum_os
             ), f"incorrect {version_key}: {version}, expected {minimum_os}"
@@ -81,6 +138,32 @@ def _assert_load_commands(
         ), f"max version {max_version} is less than minimum version {minimum_os}"
 
 
+def _assert_binary_version(config: rutils.CargoConfig, binary_path: str) -> None:
+    deployment_assert = GLOBAL_CONFIG[config.target_os]["archs"][config.arch][
+        "deployment_assert"
+    ]
+
+    # ios-sim build has a different deployment assert for static libraries
+    fetch_max_version = isinstance(deployment_assert, dict)
+    if fetch_max_version:
+        deployment_assert = (
+            deployment_assert["static"]
+            if binary_path.endswith(".a")
+            else deployment_assert["all"]
+        )
+
+    load_command, version_key = deployment_assert[0], deployment_assert[1]
+    try:
+        versions = _macho_versions(binary_path, load_command, version_key)
+    except macho.MachOError as e:
+        print(f"Unable to read {binary_path} ({e}), falling back to otool")
+        load_commands = rutils.run_command_streaming(
+            ["otool", "-l", binary_path], env=config.env
+        )
+        versions = _load_command_versions(load_commands, load_command, version_key)
+    _assert_versions(versions, deployment_assert, fetch_max_version)
+
+
 def assert_version(
     project: rutils.Project,
     config: rutils.CargoConfig,
@@ -88,36 +171,28 @@ def assert_version(
 ) -> None:
     for _, bins in packages.items():
         for _, binary in bins.items():
-            binary_path = project.get_cargo_path(
-                config.rust_target, binary, config.debug
+            _assert_binary_version(
+                config,
+                project.get_cargo_path(
+                    config.rust_target, binary, config.debug, config.env
+                ),
             )
-            load_commands = rutils.run_command_with_output(
-                ["otool", "-l", binary_path], hide_output=True
-            )
-            deployment_assert = GLOBAL_CONFIG[config.target_os]["archs"][config.arch][
-                "deployment_assert"
-            ]
 
-            # ios-sim build has a different deployment assert for static libraries
-            if isinstance(deployment_assert, dict):
-                _assert_load_commands(
-                    load_commands,
-                    (
-                        deployment_assert["static"]
-                        if binary.endswith(".a")
-                        else deployment_assert["all"]
-                    ),
-                    fetch_max_version=True,
-                )
-            else:
-                _assert_load_commands(load_commands, deployment_assert)
+
+def assert_artifact_version(
+    project: rutils.Project, config: rutils.CargoConfig, binary_path: str
+) -> None:
+    """`post_artifact` variant of `assert_version`, for a single published binary."""
+    _assert_binary_version(config, binary_path)
 
 
+@tracing.phase("lipo")
 def lipo(
     project: rutils.Project,
     debug,
     target_os,
     packages: rutils.PackageList,
+    use_lipo: Optional[bool] = None,
 ):
     archs = GLOBAL_CONFIG[target_os]["archs"]
     universal_binary_dist_path = get_universal_library_distribution_directory(
@@ -133,9 +208,10 @@ def lipo(
                 archs.keys(),
                 binary,
                 debug,
+                use_lipo,
             )
 
-    for arch in archs:
+    def collect_arch(arch: str) -> None:
         dist_path = project.get_distribution_path(target_os, arch, "", debug)
 
         for _, bins in packages.items():
@@ -143,11 +219,28 @@ def lipo(
                 dsym_dir = f"{dist_path}/{binary}.dSYM"
                 if os.path.isdir(dsym_dir):
                     dst_dir = f"{universal_binary_dist_path}/{binary}.dSYM/{arch}"
-                    os.makedirs(dst_dir, exist_ok=True)
-                    shutil.copytree(dsym_dir, dst_dir, dirs_exist_ok=True)
+                    _move_tree(dsym_dir, dst_dir)
 
         shutil.rmtree(dist_path)
 
+    # dSYMs of debug builds are gigabytes, they are moved instead of copied
+    rutils.run_in_parallel(
+        {arch: functools.partial(collect_arch, arch) for arch in archs}, "dSYM"
+    )
+
+
+def _move_tree(src: str, dst: str) -> None:
+    """Moves directory `src` to `dst`, replacing it. Across filesystems the
+    files are hardlinked or cloned where possible, copied otherwise."""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        publish.replace_directory(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        with publish.staged_directory(dst) as staging_dir:
+            publish.copy_tree(src, staging_dir, allow_hardlink=True)
+
 
 def create_fat_binary(
     project: rutils.Project,
@@ -156,18 +249,32 @@ def create_fat_binary(
     architectures,
     cargo_artifact,
     debug,
+    use_lipo: Optional[bool] = None,
 ) -> None:
+    """Combines the per-arch artifacts into a universal binary.
+
+    `lipo` is used when `use_lipo` is set, by default only when it's installed.
+    Otherwise the fat file is written in-process, which also works on Linux.
+    """
     if not os.path.isdir(os.path.dirname(output)):
         os.makedirs(os.path.dirname(output))
 
-    command = ["lipo", "-create"]
-    for architecture in architectures:
-        command.append(
-            project.get_distribution_path(
-                target_os, architecture, cargo_artifact, debug
-            )
-        )
+    slices = [
+        project.get_distribution_path(target_os, architecture, cargo_artifact, debug)
+        for architecture in architectures
+    ]
+
+    if use_lipo is None:
+        use_lipo = shutil.which("lipo") is not None
+    if not use_lipo:
+        start = time.monotonic()
+        with tracing.span(f"write_fat {os.path.basename(output)}"):
+            macho.write_fat(slices, output)
+        print(f"|TIMING| write_fat {output}: {time.monotonic() - start:.2f}s\n")
+        return
 
+    command = ["lipo", "-create"]
+    command.extend(slices)
     command.extend(["-output", str(output)])
 
     rutils.run_command(command)
@@ -209,6 +316,24 @@ def _framework_modulemap(framework_name: str) -> str:
 """
 
 
+_PLATFORM_VERSION_MIN = [
+    "LC_VERSION_MIN_MACOSX",
+    "LC_VERSION_MIN_IPHONEOS",
+    "LC_VERSION_MIN_TVOS",
+]
+
+
+def _deployment_target(properties: Dict[str, str]) -> Optional[str]:
+    if not properties.get("cmd"):
+        return None
+    if properties["cmd"] in _PLATFORM_VERSION_MIN:
+        return properties["version"]
+    elif properties["cmd"] == "LC_BUILD_VERSION":
+        return properties["minos"]
+    else:
+        return None
+
+
 def extract_version(otool_output: str) -> Optional[str]:
     lines = otool_output.split("\n")
     properties = dict()
@@ -220,24 +345,11 @@ def extract_version(otool_output: str) -> Optional[str]:
         except ValueError:
             continue
 
-    platform_version_min = [
-        "LC_VERSION_MIN_MACOSX",
-        "LC_VERSION_MIN_IPHONEOS",
-        "LC_VERSION_MIN_TVOS",
-    ]
-
-    if not properties.get("cmd"):
-        return None
-    if properties["cmd"] in platform_version_min:
-        return properties["version"]
-    elif properties["cmd"] == "LC_BUILD_VERSION":
-        return properties["minos"]
-    else:
-        return None
+    return _deployment_target(properties)
 
 
 def _min_os_version_for_arch(filename: str, arch: str) -> str:
-    vtool_output = subprocess.check_output(
+    vtool_output = tracing.check_output(
         ["vtool", "-arch", arch, "-show-build", filename]
     ).decode("utf-8")
 
@@ -254,18 +366,12 @@ def _min_os_version_for_arch(filename: str, arch: str) -> str:
 
 
 def _min_os_version_for_static_library(filename: str, arch: str) -> str:
-    otool_output = subprocess.check_output(
-        ["otool", "-arch", arch, "-l", filename]
-    ).decode("utf-8")
-
-    load_command_regex = re.compile(
-        r"Load command \d+.*?(?=Load command \d+|\Z)", re.DOTALL
-    )
-
+    # The output of large archives is tens of MB, so it's parsed while streaming
     versions = []
-
-    for command_source in re.findall(load_command_regex, otool_output):
-        version = extract_version(command_source)
+    for command in _otool_load_commands(
+        tracing.stream(["otool", "-arch", arch, "-l", filename])
+    ):
+        version = _deployment_target(command)
         if version:
             versions.append(version)
 
@@ -275,194 +381,401 @@ def _min_os_version_for_static_library(filename: str, arch: str) -> str:
     return str(max(map(float, versions)))
 
 
-def _min_os_version(filename: str, is_static: bool = False) -> str:
-    archs = subprocess.check_output(["lipo", filename, "-archs"]).split()
+def _version_tuple(version: str) -> Tuple[int, ...]:
+    return tuple(map(int, version.split(".")))
+
 
-    arch_min_os_versions = []
+def _read_min_os_versions(filename: str, is_static: bool) -> Dict[str, str]:
+    """Minimum OS version per arch from a single pass over the Mach-O headers."""
+    versions: Dict[str, str] = {}
+    for arch_slice in macho.read_slices(filename):
+        found = [command.version for command in arch_slice.commands]
+        if not found:
+            raise Exception(f"versions not found for {filename} ({arch_slice.arch})")
+        # A static library is usable from the highest version any object requires
+        select = max if is_static else min
+        versions[arch_slice.arch] = select(found, key=_version_tuple)
+    return versions
 
-    for arch in archs:
-        arch_str = arch.decode("utf-8")
 
-        arch_min_os_version = (
-            _min_os_version_for_arch(filename, arch_str)
+def _min_os_versions_with_tools(filename: str, is_static: bool) -> Dict[str, str]:
+    archs = tracing.check_output(["lipo", filename, "-archs"]).split()
+    return {
+        arch.decode("utf-8"): (
+            _min_os_version_for_arch(filename, arch.decode("utf-8"))
             if not is_static
-            else _min_os_version_for_static_library(filename, arch_str)
+            else _min_os_version_for_static_library(filename, arch.decode("utf-8"))
         )
-        arch_min_os_version_components = tuple(map(int, arch_min_os_version.split(".")))
-        arch_min_os_versions.append(arch_min_os_version_components)
-
+        for arch in archs
+    }
+
+
+_checksum_cache = checksum.ChecksumCache()
+_min_os_versions_cache: Dict[str, Tuple[Dict[str, str], str]] = {}
+# Frameworks are assembled concurrently, guards the persisted cache
+_min_os_versions_lock = threading.Lock()
+
+
+def min_os_versions(
+    filename: str,
+    is_static: bool = False,
+    project: Optional[rutils.Project] = None,
+) -> Tuple[Dict[str, str], str]:
+    """Returns the minimum OS version of every arch of a (fat) library and the
+    lowest of them.
+
+    Results are memoized by the checksum of the file, with a `project` they are
+    also persisted in `.build/min-os-versions.json`.
+    """
+    cache_file = project.get_build_dir() / "min-os-versions.json" if project else None
+    checksums = rutils.get_checksum_cache(project) if project else _checksum_cache
+    key = f"{checksums.checksum(filename)}:{'static' if is_static else 'dynamic'}"
+    with _min_os_versions_lock:
+        if key not in _min_os_versions_cache and cache_file:
+            cached = (fingerprint.load(cache_file) or {}).get(key)
+            if cached:
+                _min_os_versions_cache[key] = (cached["archs"], cached["minimum"])
+        if key in _min_os_versions_cache:
+            return _min_os_versions_cache[key]
+
+    try:
+        versions = _read_min_os_versions(filename, is_static)
+    except macho.MachOError as e:
+        print(f"Unable to read {filename} ({e}), falling back to lipo and vtool")
+        versions = _min_os_versions_with_tools(filename, is_static)
     # Pick lowest version of any arch
-    min_os_version_components = map(str, min(arch_min_os_versions))
-    min_os_version = ".".join(min_os_version_components)
+    minimum = min(versions.values(), key=_version_tuple)
 
-    return min_os_version
+    with _min_os_versions_lock:
+        _min_os_versions_cache[key] = (versions, minimum)
+        if cache_file:
+            cached = fingerprint.load(cache_file) or {}
+            cached[key] = {"archs": versions, "minimum": minimum}
+            fingerprint.save(cache_file, cached)
+            checksums.save()
+    return versions, minimum
 
 
-def create_xcframework(
+def _min_os_version(
+    filename: str, is_static: bool = False, project: Optional[rutils.Project] = None
+) -> str:
+    return min_os_versions(filename, is_static, project)[1]
+
+
+def _find_library_file(
+    project: rutils.Project, debug: bool, target_os: str, library_file_name: str
+) -> Path:
+    dist_dir = get_universal_library_distribution_directory(project, target_os, debug)
+
+    library_file_path = dist_dir / library_file_name
+    if not library_file_path.exists():
+        # Search a lib file when the given file name doesn't contain an extension
+        if library_file_path.suffix:
+            raise FileNotFoundError(
+                f"{library_file_path} not found for {target_os} in {dist_dir}. "
+            )
+
+        dylib_path = dist_dir / f"{library_file_name}.dylib"
+        static_path = dist_dir / f"{library_file_name}.a"
+        if dylib_path.exists() and static_path.exists():
+            raise ValueError(
+                "Multiple library types found:",
+                dylib_path,
+                static_path,
+                "Expected only one type.",
+            )
+
+        if dylib_path.exists():
+            library_file_path = dylib_path
+        elif static_path.exists():
+            library_file_path = static_path
+        else:
+            raise FileNotFoundError(
+                f"Library file not found for {target_os} in {dist_dir}. "
+                f"Expected either {dylib_path.name} or {static_path.name}."
+            )
+
+    return library_file_path
+
+
+def _assemble_framework(
     project: rutils.Project,
     debug: bool,
-    framework_name: str,
+    target_os: str,
     swift_module_name: str,
     headers_directory: Dict[Path, Path],
-    library_file_name: str,
-    target_os_list: List[str] = rutils.XCFRAMEWORK_TARGET_OSES,
-) -> None:
-    xcframework_path = get_xcframework_path(project, debug, framework_name)
-    if xcframework_path.exists():
-        shutil.rmtree(xcframework_path)
+    library_file_path: Path,
+) -> Path:
+    """Creates the framework of a single target os, returns its path."""
+    versioned_framework = target_os in ["macos"]
 
-    command = ["xcodebuild", "-create-xcframework"]
+    # Create concrete Framework structure
+    framework_path = (
+        get_universal_library_distribution_directory(project, target_os, debug)
+        / f"{swift_module_name}.framework"
+    )
+    if framework_path.exists():
+        shutil.rmtree(framework_path)
 
-    for target_os in target_os_list:
-        versioned_framework = target_os in ["macos"]
+    if versioned_framework:
+        framework_inner_path = framework_path / "Versions" / "A"
+    else:
+        framework_inner_path = framework_path
 
-        # Create concrete Framework structure
-        framework_path = (
-            get_universal_library_distribution_directory(project, target_os, debug)
-            / f"{swift_module_name}.framework"
-        )
-        if framework_path.exists():
-            shutil.rmtree(framework_path)
+    framework_inner_path.mkdir(parents=True)
+
+    framework_headers_dir = framework_inner_path / "Headers"
+    framework_headers_dir.mkdir()
+    framework_modules_dir = framework_inner_path / "Modules"
+    framework_modules_dir.mkdir()
+
+    if versioned_framework:
+        framework_resources_dir = framework_inner_path / "Resources"
+        framework_resources_dir.mkdir()
+
+    # Cloned where possible, not hardlinked since install_name_tool modifies it
+    publish.copy_file(library_file_path, framework_inner_path / swift_module_name)
 
+    is_static_lib = library_file_path.suffix == ".a"
+
+    # fix @rpath to relative one since the absolute is embedded at this point
+    if not is_static_lib:
         if versioned_framework:
-            framework_inner_path = framework_path / "Versions" / "A"
+            id_dylib = (
+                f"@rpath/{swift_module_name}.framework/Versions/A/{swift_module_name}"
+            )
         else:
-            framework_inner_path = framework_path
+            id_dylib = f"@rpath/{swift_module_name}.framework/{swift_module_name}"
 
-        framework_inner_path.mkdir(parents=True)
+        tracing.check_call(
+            [
+                "install_name_tool",
+                "-id",
+                id_dylib,
+                str(framework_inner_path / swift_module_name),
+            ]
+        )
 
-        framework_headers_dir = framework_inner_path / "Headers"
-        framework_headers_dir.mkdir()
-        framework_modules_dir = framework_inner_path / "Modules"
-        framework_modules_dir.mkdir()
+    # Add headers
 
-        if versioned_framework:
-            framework_resources_dir = framework_inner_path / "Resources"
-            framework_resources_dir.mkdir()
+    for key, value in headers_directory.items():
+        destination = framework_headers_dir / key
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        publish.copy_file(value, destination, allow_hardlink=True)
 
-        dist_dir = get_universal_library_distribution_directory(
-            project, target_os, debug
+    # Add modulemap
+
+    with open(framework_modules_dir / "module.modulemap", "w") as modulemap:
+        modulemap.write(_framework_modulemap(swift_module_name))
+
+    # Add versioned structure
+
+    if versioned_framework:
+        framework_current_symlink = framework_path / "Versions" / "Current"
+        os.symlink("A", framework_current_symlink, target_is_directory=True)
+
+        os.symlink(
+            "Versions/Current/Headers",
+            framework_path / "Headers",
+            target_is_directory=True,
+        )
+        os.symlink(
+            "Versions/Current/Modules",
+            framework_path / "Modules",
+            target_is_directory=True,
+        )
+        os.symlink(
+            "Versions/Current/Resources",
+            framework_path / "Resources",
+            target_is_directory=True,
         )
 
-        library_file_path = dist_dir / library_file_name
-        if not library_file_path.exists():
-            # Search a lib file when the given file name doesn't contain an extension
-            if library_file_path.suffix:
-                raise FileNotFoundError(
-                    f"{library_file_path} not found for {target_os} in {dist_dir}. "
-                )
-
-            dylib_path = dist_dir / f"{library_file_name}.dylib"
-            static_path = dist_dir / f"{library_file_name}.a"
-            if dylib_path.exists() and static_path.exists():
-                raise ValueError(
-                    "Multiple library types found:",
-                    dylib_path,
-                    static_path,
-                    "Expected only one type.",
-                )
-
-            if dylib_path.exists():
-                library_file_path = dylib_path
-            elif static_path.exists():
-                library_file_path = static_path
-            else:
-                raise FileNotFoundError(
-                    f"Library file not found for {target_os} in {dist_dir}. "
-                    f"Expected either {dylib_path.name} or {static_path.name}."
-                )
-
-        shutil.copyfile(
-            library_file_path,
-            framework_inner_path / swift_module_name,
-            follow_symlinks=False,
+        os.symlink(
+            f"Versions/Current/{swift_module_name}",
+            framework_path / swift_module_name,
         )
 
-        is_static_lib = library_file_path.suffix == ".a"
-
-        # fix @rpath to relative one since the absolute is embedded at this point
-        if not is_static_lib:
-            if versioned_framework:
-                id_dylib = f"@rpath/{swift_module_name}.framework/Versions/A/{swift_module_name}"
-            else:
-                id_dylib = f"@rpath/{swift_module_name}.framework/{swift_module_name}"
-
-            subprocess.run(
-                [
-                    "install_name_tool",
-                    "-id",
-                    id_dylib,
-                    framework_inner_path / swift_module_name,
-                ],
-                check=True,
+    # Generate Info.plist
+
+    if versioned_framework:
+        framework_info_plist_path = framework_inner_path / "Resources" / "Info.plist"
+    else:
+        framework_info_plist_path = framework_inner_path / "Info.plist"
+
+    with open(framework_info_plist_path, "w") as info_plist:
+        info_plist.write(
+            _framework_info_plist(
+                swift_module_name,
+                # install_name_tool doesn't change the load commands of
+                # interest, the published library has a cached checksum
+                _min_os_version(str(library_file_path), is_static_lib, project),
             )
+        )
 
-        # Add headers
+    return framework_path
 
-        for key, value in headers_directory.items():
-            destination = framework_headers_dir / key
-            destination.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copyfile(value, destination)
 
-        # Add modulemap
+# Bump when the layout of the xcframework manifest changes
+XCFRAMEWORK_MANIFEST_VERSION = 1
 
-        with open(framework_modules_dir / "module.modulemap", "w") as modulemap:
-            modulemap.write(_framework_modulemap(swift_module_name))
 
-        # Add versioned structure
+def _xcframework_manifest_path(xcframework_path: Path) -> Path:
+    return xcframework_path.with_name(f"{xcframework_path.name}.manifest.json")
 
-        if versioned_framework:
-            framework_current_symlink = framework_path / "Versions" / "Current"
-            os.symlink("A", framework_current_symlink, target_is_directory=True)
 
-            os.symlink(
-                "Versions/Current/Headers",
-                framework_path / "Headers",
-                target_is_directory=True,
-            )
-            os.symlink(
-                "Versions/Current/Modules",
-                framework_path / "Modules",
-                target_is_directory=True,
-            )
-            os.symlink(
-                "Versions/Current/Resources",
-                framework_path / "Resources",
-                target_is_directory=True,
-            )
+def _framework_inputs(
+    project: rutils.Project,
+    library_file_path: Path,
+    headers_directory: Dict[Path, Path],
+) -> Dict:
+    """Everything a single platform framework is generated from."""
+    checksums = rutils.get_checksum_cache(project)
+    is_static_lib = library_file_path.suffix == ".a"
+    return {
+        "library": library_file_path.name,
+        "library_checksum": checksums.checksum(library_file_path),
+        "headers": {
+            str(key): checksums.checksum(value)
+            for key, value in sorted(headers_directory.items())
+        },
+        "min_os": _min_os_version(str(library_file_path), is_static_lib, project),
+    }
+
+
+@tracing.phase("xcframework")
+def create_xcframework(
+    project: rutils.Project,
+    debug: bool,
+    framework_name: str,
+    swift_module_name: str,
+    headers_directory: Dict[Path, Path],
+    library_file_name: str,
+    target_os_list: List[str] = rutils.XCFRAMEWORK_TARGET_OSES,
+) -> None:
+    """Creates `<framework_name>.xcframework` from the universal libraries.
 
-            os.symlink(
-                f"Versions/Current/{swift_module_name}",
-                framework_path / swift_module_name,
+    A manifest of the inputs of every platform is stored next to the
+    xcframework. Only frameworks of platforms whose library, headers or minimum
+    OS version changed are regenerated, xcodebuild is skipped when none did.
+    """
+    xcframework_path = get_xcframework_path(project, debug, framework_name)
+    manifest_path = _xcframework_manifest_path(xcframework_path)
+
+    library_file_paths = {
+        target_os: _find_library_file(project, debug, target_os, library_file_name)
+        for target_os in target_os_list
+    }
+    manifest: Dict[str, Any] = {
+        "version": XCFRAMEWORK_MANIFEST_VERSION,
+        "swift_module_name": swift_module_name,
+        "targets": list(target_os_list),
+        "platforms": {
+            target_os: _framework_inputs(
+                project, library_file_paths[target_os], headers_directory
             )
+            for target_os in target_os_list
+        },
+    }
+    rutils.get_checksum_cache(project).save()
+
+    previous = fingerprint.load(manifest_path) or {}
+    same_layout = all(
+        previous.get(key) == manifest[key]
+        for key in ("version", "swift_module_name", "targets")
+    )
+    framework_paths = {
+        target_os: get_universal_library_distribution_directory(
+            project, target_os, debug
+        )
+        / f"{swift_module_name}.framework"
+        for target_os in target_os_list
+    }
+    changed = [
+        target_os
+        for target_os in target_os_list
+        if not same_layout
+        or previous["platforms"].get(target_os) != manifest["platforms"][target_os]
+        or not framework_paths[target_os].exists()
+    ]
+    if not changed and xcframework_path.exists():
+        print(f"{xcframework_path} is up to date, skipping\n")
+        return
 
-        # Generate Info.plist
+    fingerprint.remove(manifest_path)
+    if xcframework_path.exists():
+        shutil.rmtree(xcframework_path)
 
-        if versioned_framework:
-            framework_info_plist_path = (
-                framework_inner_path / "Resources" / "Info.plist"
-            )
-        else:
-            framework_info_plist_path = framework_inner_path / "Info.plist"
-
-        with open(framework_info_plist_path, "w") as info_plist:
-            info_plist.write(
-                _framework_info_plist(
-                    swift_module_name,
-                    _min_os_version(
-                        str(framework_inner_path / swift_module_name), is_static_lib
-                    ),
-                )
+    # Frameworks of different platforms are independent, assemble them concurrently
+    print(f"Assembling frameworks for {', '.join(changed) or 'no platforms'}")
+    rutils.run_in_parallel(
+        {
+            target_os: functools.partial(
+                _assemble_framework,
+                project,
+                debug,
+                target_os,
+                swift_module_name,
+                headers_directory,
+                library_file_paths[target_os],
             )
+            for target_os in changed
+        },
+        "framework",
+    )
 
-        command.extend(["-framework", str(framework_path)])
+    command = ["xcodebuild", "-create-xcframework"]
+    for target_os in target_os_list:
+        command.extend(["-framework", str(framework_paths[target_os])])
 
     command.extend(["-output", str(xcframework_path)])
 
+    start = time.monotonic()
     rutils.run_command(command)
+    print(f"|TIMING| xcodebuild: {time.monotonic() - start:.2f}s\n")
+
+    fingerprint.save(manifest_path, manifest)
+
 
+# Points to the developer directory selected with `xcode-select`
+XCODE_SELECT_LINK = "/var/db/xcode_select_link"
 
-def get_sdk_path(target_os: str) -> Path:
+
+def _developer_dir(env: Optional[Mapping[str, str]] = None) -> str:
+    env = os.environ if env is None else env
+    if env.get("DEVELOPER_DIR"):
+        return os.path.realpath(env["DEVELOPER_DIR"])
+    return os.path.realpath(XCODE_SELECT_LINK)
+
+
+def _xcode_version(developer_dir: str) -> str:
+    # Xcode.app/Contents/Developer, version.plist is in Xcode.app/Contents
+    version_plist = Path(developer_dir).parent / "version.plist"
+    try:
+        with open(version_plist, "rb") as f:
+            version = plistlib.load(f)
+        return "{} ({})".format(
+            version.get("CFBundleShortVersionString"),
+            version.get("ProductBuildVersion"),
+        )
+    except (OSError, plistlib.InvalidFileException):
+        # Command line tools have no version.plist, they are replaced on update
+        try:
+            return str(os.stat(developer_dir).st_mtime_ns)
+        except OSError:
+            return ""
+
+
+_sdk_paths: Dict[Tuple[str, str], Path] = {}
+_sdk_paths_lock = threading.Lock()
+
+
+def get_sdk_path(target_os: str, env: Optional[Mapping[str, str]] = None) -> Path:
+    """SDK path of `target_os` reported by `xcrun` when run with `env`
+    (default `os.environ`).
+
+    Paths are cached for the session and in the user cache directory, keyed by
+    the active developer directory and its Xcode version.
+    """
     sdk = {
         "ios": "iphoneos",
         "ios-sim": "iphonesimulator",
@@ -471,36 +784,130 @@ def get_sdk_path(target_os: str) -> Path:
         "tvos-sim": "appletvsimulator",
     }.get(target_os)
     assert sdk, f"unsupported target_os '{target_os}'"
-    sdk_path = (
-        subprocess.check_output(["xcrun", "--sdk", sdk, "--show-sdk-path"])
-        .decode("utf-8")
-        .strip()
-    )
-    return Path(sdk_path)
 
+    developer_dir = _developer_dir(env)
+    with _sdk_paths_lock:
+        if (developer_dir, sdk) in _sdk_paths:
+            return _sdk_paths[(developer_dir, sdk)]
 
-def set_sdk(config) -> None:
-    os.environ["SDKROOT"] = str(get_sdk_path(config.target_os))
+        cache_file = fingerprint.get_user_cache_dir() / "sdk-paths.json"
+        key = fingerprint.digest([developer_dir, _xcode_version(developer_dir), sdk])
+        cached = (fingerprint.load(cache_file) or {}).get(key)
+        if cached and os.path.isdir(cached):
+            sdk_path = Path(cached)
+        else:
+            sdk_path = Path(
+                tracing.check_output(["xcrun", "--sdk", sdk, "--show-sdk-path"], env)
+                .decode("utf-8")
+                .strip()
+            )
+            cache = fingerprint.load(cache_file) or {}
+            cache[key] = str(sdk_path)
+            fingerprint.save(cache_file, cache)
+        _sdk_paths[(developer_dir, sdk)] = sdk_path
+        return sdk_path
+
+
+def sdk_env(config) -> Dict[str, str]:
     # SDKROOT is set to macos SDKROOT by default, when running ios builds it may fail because of clang
     # targeting macos SDKROOT when compiling ios
+    return {"SDKROOT": str(get_sdk_path(config.target_os, config.env))}
+
+
+def set_sdk(config) -> None:
+    """Legacy pre_build hook, builds get SDKROOT from the `sdk_env` env hook."""
+    os.environ.update(sdk_env(config))
+
+
+def _top_level_declarations(lines: Iterable[str]) -> Iterator[Dict[str, Any]]:
+    """Yields the top-level declarations of `clang -ast-dump=json` output one by one.
+
+    Only the declaration being read is kept in memory, the dump of a header
+    including the system headers is hundreds of MB.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    in_declarations = False
+    indent: Optional[int] = None
+    for line in lines:
+        buffer += line
+        if not in_declarations:
+            # Declarations are the `inner` array of the TranslationUnitDecl
+            index = buffer.find('"inner"')
+            if index < 0 or "[" not in buffer[index:]:
+                continue
+            buffer = buffer[buffer.index("[", index) + 1 :]
+            in_declarations = True
+            continue
+
+        stripped = line.lstrip()
+        if indent is None and stripped.startswith("{"):
+            indent = len(line) - len(stripped)
+        # clang pretty-prints the dump, so a declaration can only be complete
+        # on a line closing an object at the indentation it was opened with
+        if indent is None or not stripped.startswith("}"):
+            continue
+        if len(line) - len(stripped) != indent:
+            continue
+        try:
+            declaration, end = decoder.raw_decode(buffer.lstrip(" \t\r\n,"))
+        except json.JSONDecodeError:
+            continue
+        yield declaration
+        buffer = buffer.lstrip(" \t\r\n,")[end:]
+        indent = None
+
+    # Dumps that are not pretty-printed are decoded at once
+    buffer = buffer.lstrip(" \t\r\n,")
+    while in_declarations and buffer and not buffer.startswith("]"):
+        declaration, end = decoder.raw_decode(buffer)
+        yield declaration
+        buffer = buffer[end:].lstrip(" \t\r\n,")
+
 
+@functools.lru_cache(maxsize=None)
+def _clang_version() -> str:
+    return tracing.check_output(["clang", "--version"]).decode("utf-8").strip()
 
-def generate_stub_library(header_path: Path) -> str:
-    # Dump header file AST
-    ast = rutils.run_command_with_output(
-        ["clang", "-Xclang", "-ast-dump=json", str(header_path)],
-        hide_output=True,
+
+def _stub_function_names(header_path: Path) -> List[str]:
+    declarations = _top_level_declarations(
+        rutils.run_command_streaming(
+            ["clang", "-Xclang", "-ast-dump=json", "-fsyntax-only", str(header_path)]
+        )
     )
-    ast_json = json.loads(ast)
 
     # Filter out function declarations and extract function names. Discard any
     # function declarations that were included from other files (stdlib.h, etc..).
-    function_names: List[str] = [
+    return [
         cursor["name"]
-        for cursor in ast_json["inner"]
+        for cursor in declarations
         if cursor["kind"] == "FunctionDecl" and not cursor["loc"].get("includedFrom")
     ]
 
+
+def generate_stub_library(header_path: Path, cache_dir: Optional[Path] = None) -> str:
+    """Generates the source of a library stubbing every function declared in
+    `header_path`.
+
+    With a `cache_dir` the function names are cached by the contents of the
+    header and the clang version, the header must not include other headers
+    that change.
+    """
+    if cache_dir:
+        key = fingerprint.digest(
+            [fingerprint.file_digest(header_path), _clang_version()]
+        )
+        cache_path = cache_dir / f"{key}.json"
+        cached = fingerprint.load(cache_path)
+        if cached is not None:
+            function_names = cached["functions"]
+        else:
+            function_names = _stub_function_names(header_path)
+            fingerprint.save(cache_path, {"functions": function_names})
+    else:
+        function_names = _stub_function_names(header_path)
+
     # Generate stubbed functions that segfault in a predictable way when called
     functions_source = [
         f"""void {function_name}() {{
@@ -517,69 +924,111 @@ def generate_stub_library(header_path: Path) -> str:
     return heading + "\n".join(functions_source)
 
 
-def _build_shared_stub_library(
-    project: rutils.Project, os: str, target_string: str, stub_path: Path, output: Path
-) -> None:
-    def get_temp_arch_path(arc: str) -> Path:
-        return project.get_build_dir() / f"{os}-simulator-stub-{arch}.dylib"
-
+def _stub_output(
+    project: rutils.Project,
+    inputs: List[Any],
+    file_name: str,
+    build: Callable[[Path], None],
+) -> Path:
+    """Returns `file_name` built by `build(path)`, stored in
+    `.build/stub-objects/<hash of inputs>` and reused while `inputs` are unchanged."""
+    directory = project.get_build_dir() / "stub-objects" / fingerprint.digest(inputs)
+    path = directory / file_name
+    if path.exists():
+        print(f"Reusing {path}")
+        return path
+    with publish.staged_directory(directory) as staging_dir:
+        build(staging_dir / file_name)
+    return path
+
+
+def _compile_stubs(
+    project: rutils.Project,
+    os: str,
+    target_string: str,
+    stub_path: Path,
+    kind: str,
+    file_name: str,
+    arguments: List[str],
+) -> List[Path]:
+    """Compiles the stub source for every simulator arch concurrently."""
     sdk_path = get_sdk_path(f"{os}-sim")
+    source_digest = fingerprint.file_digest(stub_path)
     arches = ["arm64", "x86_64"]
-    for arch in arches:
-        rutils.run_command(
-            [
-                "clang",
-                "-shared",
-                "-fpic",
-                "-x",
-                "c",
-                "-target",
-                f"{arch}" + target_string,
-                "-isysroot",
-                str(sdk_path),
-                str(stub_path),
-                "-o",
-                str(get_temp_arch_path(arch)),
-            ]
+    outputs: Dict[str, Path] = {}
+
+    def compile_arch(arch: str) -> None:
+        target = f"{arch}" + target_string
+        outputs[arch] = _stub_output(
+            project,
+            [source_digest, target, str(sdk_path), kind, _clang_version()],
+            file_name,
+            lambda path: rutils.run_command(
+                ["clang"]
+                + arguments
+                + ["-x", "c", "-target", target, "-isysroot", str(sdk_path)]
+                + [str(stub_path), "-o", str(path)]
+            ),
         )
 
-    lipo_command: List[str] = ["lipo", "-create"]
-    for arch in arches:
-        lipo_command.extend([str(get_temp_arch_path(arch))])
-    lipo_command.extend(["-output", str(output)])
-    rutils.run_command(lipo_command)
+    rutils.run_in_parallel(
+        {arch: functools.partial(compile_arch, arch) for arch in arches}, "stub"
+    )
+    return [outputs[arch] for arch in arches]
 
 
-def _build_static_stub_library(
+def _publish_stub(project: rutils.Project, library: Path, output: Path) -> None:
+    # Keep the output untouched when it's the same, it's an input of the xcframework
+    checksums = rutils.get_checksum_cache(project)
+    if output.exists() and checksums.checksum(output) == checksums.checksum(library):
+        print(f"{output} is up to date")
+        return
+    publish.publish_file(library, output)
+    checksums.save()
+
+
+def _build_shared_stub_library(
     project: rutils.Project, os: str, target_string: str, stub_path: Path, output: Path
 ) -> None:
-    def get_object_path(arc: str) -> Path:
-        return project.get_build_dir() / f"{os}-simulator-stub-{arch}.o"
+    # The install name would otherwise be the path in `.build/stub-objects`
+    arch_libraries = _compile_stubs(
+        project,
+        os,
+        target_string,
+        stub_path,
+        f"dylib:{output.name}",
+        "stub.dylib",
+        ["-shared", "-fpic", "-install_name", f"@rpath/{output.name}"],
+    )
+    library = _stub_output(
+        project,
+        ["lipo", [str(path) for path in arch_libraries]],
+        output.name,
+        lambda path: rutils.run_command(
+            ["lipo", "-create"]
+            + [str(path) for path in arch_libraries]
+            + ["-output", str(path)]
+        ),
+    )
+    _publish_stub(project, library, output)
 
-    sdk_path = get_sdk_path(f"{os}-sim")
-    arches = ["arm64", "x86_64"]
-    for arch in arches:
-        rutils.run_command(
-            [
-                "clang",
-                "-x",
-                "c",
-                "-target",
-                f"{arch}" + target_string,
-                "-isysroot",
-                str(sdk_path),
-                "-c",
-                str(stub_path),
-                "-o",
-                str(get_object_path(arch)),
-            ]
-        )
 
+def _build_static_stub_library(
+    project: rutils.Project, os: str, target_string: str, stub_path: Path, output: Path
+) -> None:
+    objects = _compile_stubs(
+        project, os, target_string, stub_path, "object", "stub.o", ["-c"]
+    )
     libtool_command: List[str] = ["libtool"]
-    for arch in arches:
-        libtool_command.extend(["-static", str(get_object_path(arch))])
-    libtool_command.extend(["-o", str(output)])
-    rutils.run_command(libtool_command)
+    for path in objects:
+        libtool_command.extend(["-static", str(path)])
+    library = _stub_output(
+        project,
+        ["libtool", [str(path) for path in objects]],
+        output.name,
+        lambda path: rutils.run_command(libtool_command + ["-o", str(path)]),
+    )
+    _publish_stub(project, library, output)
 
 
 def build_stub_library(
@@ -630,6 +1079,7 @@ def build_stub_tvos_simulator_libraries(
     )
 
 
+@tracing.phase("stubs")
 def build_stub_simulator_libraries(
     project: rutils.Project,
     os: str,
@@ -637,10 +1087,13 @@ def build_stub_simulator_libraries(
     header_path: Path,
     library_file_name: str,
 ) -> None:
-    stub_source = generate_stub_library(header_path)
+    stub_source = generate_stub_library(
+        header_path, project.get_build_dir() / "stub-declarations"
+    )
     stub_path = project.get_build_dir() / f"{os}-simulator-stub-library.c"
-    with open(stub_path, "w") as file:
-        file.write(stub_source)
+    if not stub_path.exists() or stub_path.read_text() != stub_source:
+        with open(stub_path, "w") as file:
+            file.write(stub_source)
 
     output_path = (
         get_universal_library_distribution_directory(project, f"{os}-sim", debug)
@@ -0,0 +1,257 @@
+import json
+import mmap
+import struct
+import sys
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from rust_build_utils.publish import StrPath
+
+ELF_MAGIC = b"\x7fELF"
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+EM_386 = 3
+EM_MIPS = 8
+EM_ARM = 40
+EM_X86_64 = 62
+EM_AARCH64 = 183
+EM_RISCV = 243
+
+MACHINE_NAMES = {
+    EM_386: "x86",
+    EM_MIPS: "mips",
+    EM_ARM: "arm",
+    EM_X86_64: "x86_64",
+    EM_AARCH64: "aarch64",
+    EM_RISCV: "riscv",
+}
+
+SHT_NOTE = 7
+SHN_XINDEX = 0xFFFF
+PT_NOTE = 4
+NT_GNU_BUILD_ID = 3
+
+
+class ElfError(Exception):
+    pass
+
+
+@dataclass
+class ElfInfo:
+    machine: int
+    big_endian: bool
+    is_64: bool
+    build_id: Optional[str]
+    # Section name to size in bytes
+    sections: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def machine_name(self) -> str:
+        return MACHINE_NAMES.get(self.machine, f"unknown ({self.machine})")
+
+    @property
+    def endianness(self) -> str:
+        return "big" if self.big_endian else "little"
+
+    @property
+    def has_debug_info(self) -> bool:
+        return any(name.startswith((".debug_", ".zdebug_")) for name in self.sections)
+
+    @property
+    def is_stripped(self) -> bool:
+        """No symbol table and no debug info are left, so there is nothing to strip."""
+        return ".symtab" not in self.sections and not self.has_debug_info
+
+
+def _header(buf: mmap.mmap) -> Tuple[str, bool]:
+    """Returns the struct byte order and whether the file is 64 bit."""
+    if len(buf) < 16 or buf[:4] != ELF_MAGIC:
+        raise ElfError("not an ELF file")
+    elf_class, data = buf[4], buf[5]
+    if elf_class not in (ELFCLASS32, ELFCLASS64) or data not in (
+        ELFDATA2LSB,
+        ELFDATA2MSB,
+    ):
+        raise ElfError(f"unsupported ELF class {elf_class} or data encoding {data}")
+    return ("<" if data == ELFDATA2LSB else ">"), elf_class == ELFCLASS64
+
+
+def _unpack(buf: mmap.mmap, fmt: str, offset: int) -> Tuple:
+    try:
+        return struct.unpack_from(fmt, buf, offset)
+    except struct.error:
+        raise ElfError(f"truncated ELF file at offset {offset}")
+
+
+@dataclass
+class _Section:
+    name_offset: int
+    type: int
+    offset: int
+    size: int
+
+
+def _sections(buf: mmap.mmap, bo: str, is_64: bool) -> Dict[str, _Section]:
+    if is_64:
+        (shoff,) = _unpack(buf, bo + "Q", 0x28)
+        shentsize, shnum, shstrndx = _unpack(buf, bo + "HHH", 0x3A)
+        # sh_offset, sh_size and sh_link follow sh_name, sh_type and sh_flags
+        fmt, offset_field, link_field = bo + "QQI", 0x18, 0x28
+    else:
+        (shoff,) = _unpack(buf, bo + "I", 0x20)
+        shentsize, shnum, shstrndx = _unpack(buf, bo + "HHH", 0x2E)
+        fmt, offset_field, link_field = bo + "III", 0x10, 0x18
+    if not shoff:
+        return {}
+
+    def section(index: int) -> _Section:
+        header = shoff + index * shentsize
+        name_offset, sh_type = _unpack(buf, bo + "II", header)
+        sh_offset, sh_size, _ = _unpack(buf, fmt, header + offset_field)
+        return _Section(name_offset, sh_type, sh_offset, sh_size)
+
+    # Files with many sections keep the real counts in the first section header
+    if shnum == 0:
+        shnum = section(0).size
+    if shstrndx == SHN_XINDEX:
+        (shstrndx,) = _unpack(buf, bo + "I", shoff + link_field)
+
+    sections = [section(i) for i in range(shnum)]
+    if shstrndx >= len(sections):
+        raise ElfError(f"invalid section name table index {shstrndx}")
+    strtab = sections[shstrndx]
+    names: Dict[str, _Section] = {}
+    for s in sections[1:]:
+        start = strtab.offset + s.name_offset
+        end = buf.find(b"\0", start, strtab.offset + strtab.size)
+        if end < 0:
+            raise ElfError(f"invalid section name offset {s.name_offset}")
+        names[buf[start:end].decode("utf-8", errors="replace")] = s
+    return names
+
+
+def _note_segments(buf: mmap.mmap, bo: str, is_64: bool) -> List[Tuple[int, int]]:
+    if is_64:
+        (phoff,) = _unpack(buf, bo + "Q", 0x20)
+        phentsize, phnum = _unpack(buf, bo + "HH", 0x36)
+    else:
+        (phoff,) = _unpack(buf, bo + "I", 0x1C)
+        phentsize, phnum = _unpack(buf, bo + "HH", 0x2A)
+
+    ranges = []
+    for i in range(phnum if phoff else 0):
+        header = phoff + i * phentsize
+        if is_64:
+            p_type, _, p_offset = _unpack(buf, bo + "IIQ", header)
+            (p_filesz,) = _unpack(buf, bo + "Q", header + 0x20)
+        else:
+            p_type, p_offset = _unpack(buf, bo + "II", header)
+            (p_filesz,) = _unpack(buf, bo + "I", header + 0x10)
+        if p_type == PT_NOTE:
+            ranges.append((p_offset, p_filesz))
+    return ranges
+
+
+def _notes(
+    buf: mmap.mmap, bo: str, offset: int, size: int
+) -> Iterator[Tuple[bytes, int, bytes]]:
+    """Yields the (name, type, description) of the notes in a note section."""
+    end = min(offset + size, len(buf))
+    while offset + 12 <= end:
+        namesz, descsz, note_type = _unpack(buf, bo + "III", offset)
+        name_start = offset + 12
+        desc_start = name_start + (namesz + 3) // 4 * 4
+        desc_end = desc_start + descsz
+        if desc_end > end:
+            raise ElfError(f"truncated note at offset {offset}")
+        yield buf[name_start : name_start + namesz], note_type, buf[desc_start:desc_end]
+        offset = desc_start + (descsz + 3) // 4 * 4
+
+
+def _build_id(buf: mmap.mmap, bo: str, ranges: List[Tuple[int, int]]) -> Optional[str]:
+    for offset, size in ranges:
+        for name, note_type, desc in _notes(buf, bo, offset, size):
+            if name.rstrip(b"\0") == b"GNU" and note_type == NT_GNU_BUILD_ID:
+                return desc.hex()
+    return None
+
+
+def read_elf(path: StrPath) -> ElfInfo:
+    """Reads the header, section table and build-id of an ELF file.
+
+    Raises `ElfError` when `path` is not an ELF file (eg. a static library).
+    """
+    with open(path, "rb") as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ElfError("empty file")
+    with buf:
+        bo, is_64 = _header(buf)
+        (machine,) = _unpack(buf, bo + "H", 0x12)
+        sections = _sections(buf, bo, is_64)
+        # Fully stripped files may have no section headers, notes are also
+        # reachable through the program headers
+        notes = [(s.offset, s.size) for s in sections.values() if s.type == SHT_NOTE]
+        build_id = _build_id(buf, bo, notes or _note_segments(buf, bo, is_64))
+        return ElfInfo(
+            machine=machine,
+            big_endian=bo == ">",
+            is_64=is_64,
+            build_id=build_id,
+            sections={name: s.size for name, s in sections.items()},
+        )
+
+
+def read_build_id(path: StrPath) -> Optional[str]:
+    """GNU build-id of an ELF file as a hex string, None when it has none."""
+    return read_elf(path).build_id
+
+
+def is_stripped(path: StrPath) -> bool:
+    """Whether `path` is an ELF file without symbols and debug info, False for
+    other files (eg. static libraries)."""
+    try:
+        return read_elf(path).is_stripped
+    except ElfError:
+        return False
+
+
+def target_arch(info: ElfInfo) -> Optional[str]:
+    """The arch of the binary as named in the linux and openwrt targets."""
+    if info.machine == EM_MIPS:
+        return "mips" if info.big_endian else "mipsel"
+    return {EM_X86_64: "x86_64", EM_AARCH64: "aarch64"}.get(info.machine)
+
+
+if __name__ == "__main__":
+    # Used by the OpenWrt packaging script when readelf is not available:
+    #   python3 -m rust_build_utils.elf arch <binary>   prints the arch, eg. `mipsel`
+    #   python3 -m rust_build_utils.elf info <binary>   prints everything as json
+    if len(sys.argv) != 3 or sys.argv[1] not in ("arch", "info"):
+        sys.exit(f"usage: {sys.argv[0]} arch|info <binary>")
+    try:
+        elf_info = read_elf(sys.argv[2])
+    except (ElfError, OSError) as e:
+        sys.exit(f"ERROR: {sys.argv[2]}: {e}")
+    if sys.argv[1] == "arch":
+        arch = target_arch(elf_info)
+        if arch is None:
+            sys.exit(f"ERROR: unsupported ELF: {elf_info.machine_name}")
+        print(arch)
+    else:
+        print(
+            json.dumps(
+                dict(
+                    asdict(elf_info),
+                    machine_name=elf_info.machine_name,
+                    endianness=elf_info.endianness,
+                    has_debug_info=elf_info.has_debug_info,
+                    is_stripped=elf_info.is_stripped,
+                ),
+                indent=2,
+            )
+        )
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import sys
+from pathlib import Path
+from typing import Any, Iterable, List, Mapping, Optional
+
+import rust_build_utils.publish as publish
+import rust_build_utils.tracing as tracing
+
+# Directories that never contain build inputs
+IGNORED_DIR_NAMES = {".git", "__pycache__"}
+
+# Environment variables that never change what cargo, rustc or a build script
+# produces, but differ between shells, terminals or runs. Everything else is an
+# input, as build scripts and `env!` can read any variable.
+ENV_IGNORED = {
+    "_",
+    "COLUMNS",
+    "LINES",
+    "OLDPWD",
+    "PWD",
+    "SHLVL",
+    "TERM",
+    "TERM_PROGRAM",
+    "TERM_PROGRAM_VERSION",
+    "TERM_SESSION_ID",
+    "COLORTERM",
+    "TMUX",
+    "TMUX_PANE",
+    "WINDOWID",
+    "DISPLAY",
+    "SSH_AUTH_SOCK",
+    "SSH_AGENT_PID",
+    "SSH_CLIENT",
+    "SSH_CONNECTION",
+    "SSH_TTY",
+    "DBUS_SESSION_BUS_ADDRESS",
+    "XDG_SESSION_ID",
+    # Parallelism and jobservers, eg. of `build-matrix`
+    "CARGO_BUILD_JOBS",
+    "CARGO_MAKEFLAGS",
+    "MAKEFLAGS",
+    "MFLAGS",
+    "MAKELEVEL",
+    tracing.TRACE_ENV_VAR,
+}
+
+
+def tree_stats(root: Path, exclude: Iterable[Path] = ()) -> List[List[Any]]:
+    """(relative path, size, mtime) of every file under `root`, sorted.
+
+    Like cargo, changes are detected by modification time, contents aren't read.
+    """
+    excluded = {os.path.normcase(os.path.abspath(p)) for p in exclude}
+    stats: List[List[Any]] = []
+
+    def walk(directory: str) -> None:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name in IGNORED_DIR_NAMES:
+                        continue
+                    if os.path.normcase(os.path.abspath(entry.path)) in excluded:
+                        continue
+                    walk(entry.path)
+                elif entry.is_file():
+                    st = entry.stat()
+                    stats.append(
+                        [
+                            os.path.relpath(entry.path, root),
+                            st.st_size,
+                            st.st_mtime_ns,
+                        ]
+                    )
+
+    if os.path.isdir(root):
+        walk(str(root))
+    return sorted(stats)
+
+
+def file_digest(path: Path) -> Optional[str]:
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def relevant_env(
+    env: Mapping[str, str], ignored: Iterable[str] = ()
+) -> List[List[str]]:
+    """The variables of `env` that are build inputs, except `ignored` ones."""
+    ignored = ENV_IGNORED.union(ignored)
+    return sorted([key, value] for key, value in env.items() if key not in ignored)
+
+
+def digest(inputs: Any) -> str:
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def load(path: Path) -> Optional[dict]:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def save(path: Path, data: dict) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with publish.atomic_write(path) as f:
+        json.dump(data, f)
+
+
+def remove(path: Path) -> None:
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+# Overrides the directory of caches shared by all projects of the user
+CACHE_DIR_ENV_VAR = "RUST_BUILD_UTILS_CACHE_DIR"
+
+
+def get_user_cache_dir() -> Path:
+    """Directory for caches that are not specific to a project, eg. of the
+    installed toolchains."""
+    if os.environ.get(CACHE_DIR_ENV_VAR):
+        return Path(os.environ[CACHE_DIR_ENV_VAR])
+    if sys.platform == "darwin":
+        base = Path.home() / "Library" / "Caches"
+    elif sys.platform == "win32":
+        base = Path(os.environ.get("LOCALAPPDATA", Path.home() / "AppData" / "Local"))
+    else:
+        base = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    return base / "rust_build_utils"
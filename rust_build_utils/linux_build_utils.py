@@ -1,32 +1,38 @@
 from os import path
+import functools
+import os
+from typing import Optional
+import rust_build_utils.elf as elf
 import rust_build_utils.rust_utils as rutils
+import rust_build_utils.symbol_store as symbol_store
 from rust_build_utils.rust_utils_config import GLOBAL_CONFIG
 
 
-def strip(project: rutils.Project, config: rutils.CargoConfig, packages=None):
-    if config.target_os not in ("linux", "openwrt") or config.debug or packages == None:
-        return
-
+def _strip_bin(config: rutils.CargoConfig) -> str:
     strip_bin = GLOBAL_CONFIG[config.target_os]["archs"][config.arch]["strip_path"]
 
     if not path.isfile(strip_bin):
         # fallback to default strip
         strip_bin = "objcopy"
+    return strip_bin
 
-    dist_dir = project.get_distribution_path(
-        config.target_os, config.arch, "", config.debug
-    )
 
-    def _create_debug_symbols(bin_path: str):
+def _strip_binary(
+    config: rutils.CargoConfig,
+    strip_bin: str,
+    store: Optional[symbol_store.SymbolStore],
+    bin_path: str,
+):
+    def _extract_debug_symbols(bin_path: str, output: str, compression: str = "zlib"):
         if strip_bin.endswith("objcopy"):
             create_debug_symbols_cmd = [
                 f"{strip_bin}",
                 "--only-keep-debug",
-                "--compress-debug-sections=zlib",
+                f"--compress-debug-sections={compression}",
                 f"{bin_path}",
-                f"{bin_path}.debug",
+                f"{output}",
             ]
-            rutils.run_command(create_debug_symbols_cmd)
+            rutils.run_command(create_debug_symbols_cmd, env=config.env)
         elif strip_bin.endswith("mipsel-linux-muslsf-strip") or strip_bin.endswith(
             "mips-linux-muslsf-strip"
         ):
@@ -35,14 +41,25 @@ def strip(project: rutils.Project, config: rutils.CargoConfig, packages=None):
                 "--only-keep-debug",
                 f"{bin_path}",
                 "-o",
-                f"{bin_path}.debug",
+                f"{output}",
             ]
-            rutils.run_command(create_debug_symbols_cmd)
+            rutils.run_command(create_debug_symbols_cmd, env=config.env)
         else:
             raise ValueError(f"Unsupported strip binary: {strip_bin}")
 
-        set_read_only_cmd = ["chmod", "0444", f"{bin_path}.debug"]
-        rutils.run_command(set_read_only_cmd)
+    def _create_debug_symbols(bin_path: str):
+        if store and store.deposit(
+            bin_path,
+            lambda output, compression: _extract_debug_symbols(
+                bin_path, str(output), compression
+            ),
+        ):
+            if path.exists(f"{bin_path}.debug"):
+                os.remove(f"{bin_path}.debug")
+            return
+
+        _extract_debug_symbols(bin_path, f"{bin_path}.debug")
+        os.chmod(f"{bin_path}.debug", 0o444)
 
     def _strip_debug_symbols(bin_path: str):
         strip_cmd = [
@@ -50,10 +67,41 @@ def strip(project: rutils.Project, config: rutils.CargoConfig, packages=None):
             "--strip-unneeded" if bin_path.endswith(".a") else "--strip-all",
             f"{bin_path}",
         ]
-        rutils.run_command(strip_cmd)
+        rutils.run_command(strip_cmd, env=config.env)
+
+    # Eg. when the hook runs again on the same dist directory
+    if elf.is_stripped(bin_path):
+        print(f"{bin_path} is already stripped, skipping")
+        return
+    _create_debug_symbols(bin_path)
+    _strip_debug_symbols(bin_path)
 
-    for _, bins in packages.items():
-        for _, bin in bins.items():
-            bin_path = f"{dist_dir}/{bin}"
-            _create_debug_symbols(bin_path)
-            _strip_debug_symbols(bin_path)
+
+def strip(project: rutils.Project, config: rutils.CargoConfig, packages=None):
+    if config.target_os not in ("linux", "openwrt") or config.debug or packages == None:
+        return
+
+    strip_bin = _strip_bin(config)
+    dist_dir = project.get_distribution_path(
+        config.target_os, config.arch, "", config.debug
+    )
+    store = symbol_store.from_env()
+
+    # Binaries are independent, so they are processed concurrently
+    rutils.run_in_parallel(
+        {
+            bin: functools.partial(
+                _strip_binary, config, strip_bin, store, f"{dist_dir}/{bin}"
+            )
+            for bins in packages.values()
+            for bin in bins.values()
+        },
+        "strip",
+    )
+
+
+def strip_artifact(project: rutils.Project, config: rutils.CargoConfig, bin_path: str):
+    """`post_artifact` variant of `strip`, for a single published binary."""
+    if config.target_os not in ("linux", "openwrt") or config.debug:
+        return
+    _strip_binary(config, _strip_bin(config), symbol_store.from_env(), bin_path)
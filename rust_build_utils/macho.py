@@ -0,0 +1,358 @@
+import mmap
+import os
+import shutil
+import struct
+import sys
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import rust_build_utils.publish as publish
+from rust_build_utils.publish import StrPath
+
+FAT_MAGIC = 0xCAFEBABE
+FAT_MAGIC_64 = 0xCAFEBABF
+MH_MAGIC = 0xFEEDFACE
+MH_MAGIC_64 = 0xFEEDFACF
+AR_MAGIC = b"!<arch>\n"
+
+LC_VERSION_MIN_MACOSX = 0x24
+LC_VERSION_MIN_IPHONEOS = 0x25
+LC_VERSION_MIN_TVOS = 0x2F
+LC_VERSION_MIN_WATCHOS = 0x30
+LC_BUILD_VERSION = 0x32
+
+VERSION_COMMANDS = {
+    LC_VERSION_MIN_MACOSX: "LC_VERSION_MIN_MACOSX",
+    LC_VERSION_MIN_IPHONEOS: "LC_VERSION_MIN_IPHONEOS",
+    LC_VERSION_MIN_TVOS: "LC_VERSION_MIN_TVOS",
+    LC_VERSION_MIN_WATCHOS: "LC_VERSION_MIN_WATCHOS",
+    LC_BUILD_VERSION: "LC_BUILD_VERSION",
+}
+
+_CPU_ARCH_ABI64 = 0x01000000
+_CPU_ARCH_ABI64_32 = 0x02000000
+CPU_TYPE_X86 = 7
+CPU_TYPE_ARM = 12
+CPU_TYPE_X86_64 = CPU_TYPE_X86 | _CPU_ARCH_ABI64
+CPU_TYPE_ARM64 = CPU_TYPE_ARM | _CPU_ARCH_ABI64
+CPU_TYPE_ARM64_32 = CPU_TYPE_ARM | _CPU_ARCH_ABI64_32
+
+# (cputype, cpusubtype without capability bits) -> name, as printed by `lipo -archs`
+ARCH_NAMES = {
+    (CPU_TYPE_X86, 3): "i386",
+    (CPU_TYPE_X86_64, 3): "x86_64",
+    (CPU_TYPE_X86_64, 8): "x86_64h",
+    (CPU_TYPE_ARM, 9): "armv7",
+    (CPU_TYPE_ARM, 11): "armv7s",
+    (CPU_TYPE_ARM, 12): "armv7k",
+    (CPU_TYPE_ARM64, 0): "arm64",
+    (CPU_TYPE_ARM64, 2): "arm64e",
+    (CPU_TYPE_ARM64_32, 1): "arm64_32",
+}
+_CPU_SUBTYPE_MASK = 0x00FFFFFF
+
+
+class MachOError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class VersionCommand:
+    """A LC_BUILD_VERSION or LC_VERSION_MIN_* load command.
+
+    Versions are formatted like otool does, eg. '11.0' or '10.12.1'. The
+    minimum OS version is `minos` for LC_BUILD_VERSION and `version` otherwise.
+    """
+
+    name: str
+    version: str
+    sdk: str
+    platform: Optional[int] = None
+
+    @property
+    def version_key(self) -> str:
+        return "minos" if self.name == "LC_BUILD_VERSION" else "version"
+
+    def get(self, key: str) -> Optional[str]:
+        return {self.version_key: self.version, "sdk": self.sdk}.get(key)
+
+
+@dataclass
+class Slice:
+    """Version load commands of one architecture of a file. Static libraries
+    contain one Mach-O object per archive member."""
+
+    arch: str
+    commands: List[VersionCommand] = field(default_factory=list)
+
+
+def format_version(version: int) -> str:
+    """Decodes a nibble encoded xxxx.yy.zz version, dropping a zero patch."""
+    major, minor, patch = version >> 16, (version >> 8) & 0xFF, version & 0xFF
+    return f"{major}.{minor}.{patch}" if patch else f"{major}.{minor}"
+
+
+def arch_name(cputype: int, cpusubtype: int) -> str:
+    return ARCH_NAMES.get(
+        (cputype, cpusubtype & _CPU_SUBTYPE_MASK), f"cputype{cputype}"
+    )
+
+
+def _macho_header(buf: mmap.mmap, offset: int) -> Optional[Tuple[str, bool]]:
+    """Returns the struct byte order and whether the header is 64 bit, None when
+    there is no Mach-O header at `offset`."""
+    if offset + 4 > len(buf):
+        return None
+    for byte_order in ("<", ">"):
+        (magic,) = struct.unpack_from(f"{byte_order}I", buf, offset)
+        if magic in (MH_MAGIC, MH_MAGIC_64):
+            return byte_order, magic == MH_MAGIC_64
+    return None
+
+
+def _parse_macho(buf: mmap.mmap, offset: int, end: int) -> Slice:
+    header = _macho_header(buf, offset)
+    if header is None:
+        raise MachOError(f"no Mach-O header at offset {offset}")
+    byte_order, is_64 = header
+    if offset + 28 > end:
+        raise MachOError(f"truncated Mach-O header at offset {offset}")
+    _, cputype, cpusubtype, _, ncmds, sizeofcmds, _ = struct.unpack_from(
+        f"{byte_order}7I", buf, offset
+    )
+    result = Slice(arch_name(cputype, cpusubtype))
+
+    position = offset + (32 if is_64 else 28)
+    commands_end = position + sizeofcmds
+    if commands_end > end:
+        raise MachOError(f"load commands exceed the Mach-O at offset {offset}")
+    for _ in range(ncmds):
+        if position + 8 > commands_end:
+            raise MachOError(f"truncated load command at offset {position}")
+        cmd, cmdsize = struct.unpack_from(f"{byte_order}2I", buf, position)
+        if cmdsize < 8 or position + cmdsize > commands_end:
+            raise MachOError(f"invalid load command size at offset {position}")
+
+        if cmd == LC_BUILD_VERSION and cmdsize >= 24:
+            platform, minos, sdk = struct.unpack_from(
+                f"{byte_order}3I", buf, position + 8
+            )
+            result.commands.append(
+                VersionCommand(
+                    VERSION_COMMANDS[cmd],
+                    format_version(minos),
+                    format_version(sdk),
+                    platform,
+                )
+            )
+        elif cmd in VERSION_COMMANDS and cmd != LC_BUILD_VERSION and cmdsize >= 16:
+            version, sdk = struct.unpack_from(f"{byte_order}2I", buf, position + 8)
+            result.commands.append(
+                VersionCommand(
+                    VERSION_COMMANDS[cmd], format_version(version), format_version(sdk)
+                )
+            )
+        position += cmdsize
+    return result
+
+
+def _archive_members(
+    buf: mmap.mmap, offset: int, end: int
+) -> Iterator[Tuple[int, int]]:
+    """Yields the data range of every member of the `ar` archive at `offset`."""
+    position = offset + len(AR_MAGIC)
+    while position + 60 <= end:
+        name = bytes(buf[position : position + 16])
+        try:
+            size = int(bytes(buf[position + 48 : position + 58]).decode().strip())
+        except ValueError:
+            raise MachOError(f"invalid archive member header at offset {position}")
+        if bytes(buf[position + 58 : position + 60]) != b"`\n":
+            raise MachOError(f"invalid archive member header at offset {position}")
+        data = position + 60
+        # BSD archives store long names at the start of the member data
+        if name.startswith(b"#1/"):
+            data += int(name[3:].decode().strip())
+        yield data, min(position + 60 + size, end)
+        position += 60 + size + (size % 2)
+
+
+def _parse_slice(buf: mmap.mmap, offset: int, end: int, arch: str) -> Slice:
+    """Parses a thin Mach-O or the Mach-O objects of a static library."""
+    if bytes(buf[offset : offset + len(AR_MAGIC)]) != AR_MAGIC:
+        return _parse_macho(buf, offset, end)
+
+    result = Slice(arch)
+    for member, member_end in _archive_members(buf, offset, end):
+        # Symbol tables (__.SYMDEF) and eg. bitcode members aren't Mach-O objects
+        if _macho_header(buf, member) is None:
+            continue
+        member_slice = _parse_macho(buf, member, member_end)
+        result.arch = arch or member_slice.arch
+        result.commands.extend(member_slice.commands)
+    return result
+
+
+def _fat_slices(buf: mmap.mmap) -> Optional[List[Tuple[str, int, int]]]:
+    """(arch, offset, size) of every slice of a fat file, None for thin files."""
+    (magic, count) = struct.unpack_from(">2I", buf, 0)
+    if magic not in (FAT_MAGIC, FAT_MAGIC_64):
+        return None
+    # Java class files share the magic, they have a version number instead
+    if count > 64:
+        return None
+
+    slices = []
+    for i in range(count):
+        if magic == FAT_MAGIC_64:
+            cputype, cpusubtype, offset, size, _, _ = struct.unpack_from(
+                ">2i2Q2I", buf, 8 + i * 32
+            )
+        else:
+            cputype, cpusubtype, offset, size, _ = struct.unpack_from(
+                ">2i3I", buf, 8 + i * 20
+            )
+        if offset + size > len(buf):
+            raise MachOError(f"slice {i} exceeds the file")
+        slices.append((arch_name(cputype, cpusubtype), offset, size))
+    return slices
+
+
+def read_slices(path: StrPath) -> List[Slice]:
+    """Reads the version load commands of every architecture of a thin or fat
+    Mach-O file or static library. Only the headers are read."""
+    with open(path, "rb") as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise MachOError(f"{path} is empty")
+    with buf:
+        if len(buf) < 8:
+            raise MachOError(f"{path} is not a Mach-O file")
+        fat_slices = _fat_slices(buf)
+        if fat_slices is None:
+            return [_parse_slice(buf, 0, len(buf), "")]
+        return [
+            _parse_slice(buf, offset, offset + size, arch)
+            for arch, offset, size in fat_slices
+        ]
+
+
+def version_commands(path: StrPath) -> List[VersionCommand]:
+    """Version load commands of all architectures and objects of a file, in the
+    order `otool -l` prints them."""
+    return [command for s in read_slices(path) for command in s.commands]
+
+
+def _cpu_type(buf: mmap.mmap, path: StrPath) -> Tuple[int, int]:
+    """cputype and cpusubtype of a thin Mach-O file or static library."""
+    if _fat_slices(buf) is not None:
+        raise MachOError(f"{path} is already a fat file")
+    offset = 0
+    if bytes(buf[: len(AR_MAGIC)]) == AR_MAGIC:
+        member = next(
+            (m for m, _ in _archive_members(buf, 0, len(buf)) if _macho_header(buf, m)),
+            None,
+        )
+        if member is None:
+            raise MachOError(f"{path} contains no Mach-O objects")
+        offset = member
+    header = _macho_header(buf, offset)
+    if header is None:
+        raise MachOError(f"{path} is not a Mach-O file or static library")
+    _, cputype, cpusubtype = struct.unpack_from(f"{header[0]}3I", buf, offset)
+    return cputype, cpusubtype
+
+
+def _slice_alignment(cputype: int) -> int:
+    """Alignment (power of 2) of a slice in a fat file, the page size of the arch."""
+    return (
+        14 if cputype & ~_CPU_ARCH_ABI64 & ~_CPU_ARCH_ABI64_32 == CPU_TYPE_ARM else 12
+    )
+
+
+def _copy_range(src_fd: int, dst_fd: int, size: int, dst_offset: int) -> None:
+    """Copies `size` bytes from the start of `src_fd` to `dst_offset`, kernel side
+    where possible."""
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < size:
+                n = os.copy_file_range(
+                    src_fd, dst_fd, size - copied, copied, dst_offset + copied
+                )
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            pass
+    if copied < size and sys.platform.startswith("linux"):
+        try:
+            os.lseek(dst_fd, dst_offset + copied, os.SEEK_SET)
+            while copied < size:
+                n = os.sendfile(dst_fd, src_fd, copied, size - copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            pass
+    while copied < size:
+        chunk = os.pread(src_fd, min(size - copied, 1 << 20), copied)
+        if not chunk:
+            raise MachOError(f"unexpected end of file after {copied} bytes")
+        copied += os.pwrite(dst_fd, chunk, dst_offset + copied)
+
+
+def write_fat(slices: Sequence[StrPath], output: StrPath) -> None:
+    """Creates a fat (universal) file from thin Mach-O files or static libraries,
+    like `lipo -create`. Each slice is page aligned for its arch."""
+    if not slices:
+        raise MachOError("no slices given")
+
+    headers: List[Tuple[int, int, int, int, int]] = []
+    for path in slices:
+        with open(path, "rb") as f:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    cputype, cpusubtype = _cpu_type(buf, path)
+            except ValueError:
+                raise MachOError(f"{path} is empty")
+            size = os.fstat(f.fileno()).st_size
+        for other_path, (other_cputype, other_cpusubtype, *_) in zip(slices, headers):
+            if (other_cputype, other_cpusubtype & _CPU_SUBTYPE_MASK) == (
+                cputype,
+                cpusubtype & _CPU_SUBTYPE_MASK,
+            ):
+                raise MachOError(
+                    f"{path} and {other_path} have the same architecture "
+                    f"({arch_name(cputype, cpusubtype)})"
+                )
+        headers.append((cputype, cpusubtype, 0, size, _slice_alignment(cputype)))
+
+    # Without 64 bit offsets every slice must start and end below 4GiB
+    offset = 8 + 32 * len(headers)
+    is_64 = False
+    for i, (cputype, cpusubtype, _, size, align) in enumerate(headers):
+        offset = (offset + (1 << align) - 1) & ~((1 << align) - 1)
+        headers[i] = (cputype, cpusubtype, offset, size, align)
+        offset += size
+        is_64 = is_64 or offset >= 1 << 32
+
+    if is_64:
+        header = struct.pack(">2I", FAT_MAGIC_64, len(headers)) + b"".join(
+            struct.pack(">2I2Q2I", *h, 0) for h in headers
+        )
+    else:
+        header = struct.pack(">2I", FAT_MAGIC, len(headers)) + b"".join(
+            struct.pack(">5I", *h) for h in headers
+        )
+
+    with publish.atomic_path(output) as tmp_path:
+        with open(tmp_path, "wb") as out:
+            out.write(header)
+            out.truncate(offset)
+            out.flush()
+            for path, (_, _, slice_offset, size, _) in zip(slices, headers):
+                with open(path, "rb") as f:
+                    _copy_range(f.fileno(), out.fileno(), size, slice_offset)
+        shutil.copymode(slices[0], tmp_path)
@@ -1,9 +1,14 @@
+import contextlib
 import os
 import re
 import shutil
 import subprocess
+import threading
 from pathlib import Path
-from typing import Optional
+from typing import Any, Callable, Dict, Iterator, Mapping, Optional
+
+import rust_build_utils.fingerprint as fingerprint
+import rust_build_utils.tracing as tracing
 
 EDITION_PREFERENCES = [
     "BuildTools",
@@ -16,10 +21,19 @@ MSV_PATHS = [
     Path(r"C:\Program Files (x86)\Microsoft Visual Studio"),
     Path(r"C:\Program Files\Microsoft Visual Studio"),
 ]
+# Bumped when the format of the cached vcvarsall environments changes
+VCVARSALL_CACHE_VERSION = 1
+# Separator of list variables like PATH, INCLUDE and LIB
+_LIST_SEPARATOR = ";"
+
+# Runs vcvarsall.bat for an arch in an environment, returns the resulting environment
+VcvarsallRunner = Callable[[Path, str, Mapping[str, str]], Dict[str, str]]
 
 
-def is_msvc_active() -> bool:
-    return "VisualStudioVersion" in os.environ
+def is_msvc_active(env: Optional[Mapping[str, str]] = None) -> bool:
+    if env is None:
+        return "VisualStudioVersion" in os.environ
+    return any(key.upper() == "VISUALSTUDIOVERSION" for key in env)
 
 
 def is_msv_version(path: Path):
@@ -82,7 +96,80 @@ def activate_msvc(
     print(subprocess.run("cl"))
     deactivate_msvc(orig_env)
     """
+    vcvarsall = _find_vcvarsall(version_preference, edition_preference)
+
+    original_env = {}
+    # When setting the environment we save the old values so they can be restored after exiting the context.
+    for env_var, env_new_val in _cached_vcvarsall(
+        vcvarsall, _vcvarsall_arch(arch, direct_pass_arch), os.environ
+    ).items():
+        env_old_val = os.environ.get(env_var, None)
+        if env_old_val != env_new_val:
+            original_env[env_var] = env_old_val
+            os.environ[env_var] = env_new_val
+    return original_env
+
 
+def msvc_env(
+    arch: str,
+    version_preference: Optional[str] = None,
+    edition_preference: Optional[str] = None,
+    direct_pass_arch: bool = False,
+    base_env: Optional[Mapping[str, str]] = None,
+) -> Dict[str, str]:
+    """Same as `activate_msvc`, but returns the activated environment instead of
+    modifying `os.environ`.
+
+    Arguments:
+    base_env (optional): environment to activate MSVC tools in, defaults to `os.environ`
+
+    Returns:
+    a copy of `base_env` with the changes made by vcvarsall.bat script
+    """
+    vcvarsall = _find_vcvarsall(version_preference, edition_preference)
+    base_env = os.environ if base_env is None else base_env
+    env = {_env_key(key): value for key, value in base_env.items()}
+    for key, value in _cached_vcvarsall(
+        vcvarsall, _vcvarsall_arch(arch, direct_pass_arch), base_env
+    ).items():
+        env[_env_key(key)] = value
+    return env
+
+
+@contextlib.contextmanager
+def msvc_environment(
+    arch: str,
+    version_preference: Optional[str] = None,
+    edition_preference: Optional[str] = None,
+    direct_pass_arch: bool = False,
+    base_env: Optional[Mapping[str, str]] = None,
+) -> Iterator[Dict[str, str]]:
+    """Context manager version of `activate_msvc` that leaves `os.environ` alone.
+
+    Yields the environment to pass to the MSVC tools, which is a copy of
+    `base_env` when MSVC tools are already active in it.
+
+    Example usage:
+    with msvc_environment('arm64') as env:
+        subprocess.run("link", env=env)
+    """
+    base_env = os.environ if base_env is None else base_env
+    if is_msvc_active(base_env):
+        yield dict(base_env)
+    else:
+        yield msvc_env(
+            arch, version_preference, edition_preference, direct_pass_arch, base_env
+        )
+
+
+def _env_key(key: str) -> str:
+    # Environment variable names are case insensitive on windows ("Path" and "PATH")
+    return key.upper() if os.name == "nt" else key
+
+
+def _find_vcvarsall(
+    version_preference: Optional[str], edition_preference: Optional[str]
+) -> Path:
     # Sample location of vcvarsall script:
     # "C:\Program Files\Microsoft Visual Studio\2022\Community\VC\Auxiliary\Build\vcvarsall.bat"
     # We begin by finding microsoft visual studio installation.
@@ -142,7 +229,10 @@ def activate_msvc(
         )
     msv = msv_editions[0]
     vcvarsall = msv.joinpath(r"VC\Auxiliary\Build\vcvarsall.bat")
+    return vcvarsall
+
 
+def _vcvarsall_arch(arch: str, direct_pass_arch: bool) -> str:
     # architecture string that will be passed to vcvarsall
     if not direct_pass_arch and arch == "aarch64":
         arch = "arm64"
@@ -153,44 +243,161 @@ def activate_msvc(
         if direct_pass_arch or arch in ("amd64", "x64")
         else "amd64_{}".format(arch)
     )
+    return arch
 
-    original_env = {}
+
+def _run_vcvarsall(
+    vcvarsall: Path, arch: str, env: Mapping[str, str]
+) -> Dict[str, str]:
     # Execute vcvarsall in a shell and print the environment after modification.
     # Because the change happens in a separate process, after it exits the changes made to the env are lost.
-    # We collect the process output (modified environment) and set current environment to those values.
-    # When setting the environment we save the old values so they can be restored after exiting the context.
+    # We collect the process output (modified environment) and return it to the caller.
     #
     # `chcp 65001` changes output encoding to utf-8.
     # https://learn.microsoft.com/en-gb/windows/win32/intl/code-page-identifiers?redirectedfrom=MSDN
-    p = subprocess.run(
+    _, output = tracing.run(
         ["chcp", "65001", "&", str(vcvarsall), arch, "&", "set"],
+        env,
+        capture=True,
         shell=True,
-        check=True,
-        capture_output=True,
     )
+    assert output is not None
     # Find ARG=VALUE pairs and capture them. Because the value might contain '=',
     # we match until the first '=' character.
-    for m in re.finditer(r"^([^=]*)=(.*)$", p.stdout.decode("utf-8"), flags=re.M):
-        env_var = m.group(1)
-        env_new_val = m.group(2).strip()
-        env_old_val = os.environ.get(env_var, None)
-        if env_old_val != env_new_val:
-            original_env[env_var] = env_old_val
-            os.environ[env_var] = env_new_val
-    return original_env
+    return {
+        m.group(1): m.group(2).strip()
+        for m in re.finditer(r"^([^=]*)=(.*)$", output.decode("utf-8"), flags=re.M)
+    }
+
+
+_vcvarsall_lock = threading.Lock()
+_vcvarsall_diffs: Dict[str, Dict[str, Dict[str, str]]] = {}
+
+
+def _env_diff(
+    base_env: Mapping[str, str], env: Mapping[str, str]
+) -> Dict[str, Dict[str, str]]:
+    # vcvarsall.bat mostly extends lists like PATH, INCLUDE and LIB, so a change
+    # is stored as what was added around the old value. That way a cached diff
+    # also applies when the base environment differs, eg. PATH of another shell.
+    base = {_env_key(key): value for key, value in base_env.items()}
+    diff = {}
+    for key, value in env.items():
+        # `set` also prints cmd's per drive working directories ("=C:=C:\...")
+        if not key:
+            continue
+        old = base.get(_env_key(key))
+        if old == value:
+            continue
+        index = value.find(old) if old else -1
+        if old is None or index < 0:
+            diff[key] = {"set": value}
+            continue
+        prepend, append = value[:index], value[index + len(old) :]
+        # Only whole list entries were added, otherwise the old value is part of
+        # a new one, eg. "1" of "17.0"
+        if (prepend and not prepend.endswith(_LIST_SEPARATOR)) or (
+            append and not append.startswith(_LIST_SEPARATOR)
+        ):
+            diff[key] = {"set": value}
+        else:
+            diff[key] = {"prepend": prepend, "append": append}
+    return diff
+
+
+def _is_env_diff(diff: Any) -> bool:
+    """Whether a cached diff is well formed, cache files may be corrupted or
+    written by another version."""
+    return isinstance(diff, dict) and all(
+        isinstance(change, dict)
+        and (set(change) == {"set"} or set(change) == {"prepend", "append"})
+        and all(isinstance(value, str) for value in change.values())
+        for change in diff.values()
+    )
 
 
-def check_for_static_runtime(dll_path: Path, should_link_statically: bool) -> bool:
-    """Checks a DLL for dynamic dependencies on common C/C++ runtime libraries using dumpbin.exe."""
+def _apply_env_diff(
+    base_env: Mapping[str, str], diff: Mapping[str, Mapping[str, str]]
+) -> Dict[str, str]:
+    base = {_env_key(key): value for key, value in base_env.items()}
+    env = {}
+    for key, change in diff.items():
+        if "set" in change:
+            env[key] = change["set"]
+        else:
+            env[key] = (
+                change["prepend"] + base.get(_env_key(key), "") + change["append"]
+            )
+    return env
+
+
+def _cached_vcvarsall(
+    vcvarsall: Path,
+    arch: str,
+    env: Mapping[str, str],
+    runner: VcvarsallRunner = _run_vcvarsall,
+    cache_dir: Optional[Path] = None,
+) -> Dict[str, str]:
+    """Same as `runner`, but the changes made by vcvarsall.bat are cached on
+    disk, as running it takes seconds.
+
+    The cache is keyed by the path and modification time of vcvarsall.bat, the
+    Visual Studio version and edition and the arch, so updating Visual Studio
+    invalidates it.
+    """
+    # ...\Microsoft Visual Studio\<version>\<edition>\VC\Auxiliary\Build\vcvarsall.bat
+    edition = vcvarsall.parents[3]
+    key = fingerprint.digest(
+        {
+            "version": VCVARSALL_CACHE_VERSION,
+            "vcvarsall": str(vcvarsall),
+            "mtime": vcvarsall.stat().st_mtime_ns,
+            "vs_version": edition.parent.name,
+            "vs_edition": edition.name,
+            "arch": arch,
+        }
+    )
+    cache_file = (
+        cache_dir or fingerprint.get_user_cache_dir() / "vcvarsall"
+    ) / f"{key}.json"
+
+    # Held while vcvarsall.bat runs, so parallel builds run it only once
+    with _vcvarsall_lock:
+        diff = _vcvarsall_diffs.get(key)
+        if diff is None:
+            cached = fingerprint.load(cache_file)
+            if isinstance(cached, dict) and _is_env_diff(cached.get("diff")):
+                print(f"Using cached environment of {vcvarsall} {arch}")
+                diff = cached["diff"]
+            else:
+                diff = _env_diff(env, runner(vcvarsall, arch, env))
+                fingerprint.save(cache_file, {"diff": diff})
+            _vcvarsall_diffs[key] = diff
+    return _apply_env_diff(env, diff)
+
+
+def check_for_static_runtime(
+    dll_path: Path,
+    should_link_statically: bool,
+    env: Optional[Mapping[str, str]] = None,
+) -> bool:
+    """Checks a DLL for dynamic dependencies on common C/C++ runtime libraries using dumpbin.exe.
+
+    `env` is the environment with MSVC tools active (eg. from `msvc_environment`),
+    defaults to `os.environ`.
+    """
 
-    if not is_msvc_active():
+    if not is_msvc_active(env):
         print("Please activate MSVC shell")
         return False
 
     if not os.path.isfile(dll_path):
         return False
 
-    dumpbin_exe = shutil.which("dumpbin.exe")
+    path = None
+    if env is not None:
+        path = next((v for k, v in env.items() if k.upper() == "PATH"), None)
+    dumpbin_exe = shutil.which("dumpbin.exe", path=path)
     if not dumpbin_exe:
         print("dumpbin.exe not found in your PATH.")
         print(
@@ -202,13 +409,12 @@ def check_for_static_runtime(dll_path: Path, should_link_statically: bool) -> bo
         return False
 
     try:
-        process = subprocess.run(
-            [dumpbin_exe, "/dependents", dll_path],
-            capture_output=True,
-            text=True,
+        returncode, output = tracing.run(
+            [dumpbin_exe, "/dependents", str(dll_path)],
+            env,
+            capture=True,
             check=False,  # We will check returncode manually
-            encoding="oem",  # Try OEM codepage first for console tools
-            errors="replace",  # Replace characters that cannot be decoded
+            stderr=subprocess.DEVNULL,
         )
     except FileNotFoundError:  # Should be caught by shutil.which, but as a fallback
         print(
@@ -219,9 +425,11 @@ def check_for_static_runtime(dll_path: Path, should_link_statically: bool) -> bo
         print(f"An unexpected error occurred while trying to run dumpbin.exe: {e}")
         return False
 
-    dumpbin_output_text = process.stdout
+    assert output is not None
+    # Try OEM codepage first for console tools, replace characters that cannot be decoded
+    dumpbin_output_text = output.decode("oem", errors="replace")
     dumpbin_error_pattern = r"LINK : fatal error|Error opening file|invalid or corrupt file|cannot open input file"
-    if process.returncode != 0 or re.search(
+    if returncode != 0 or re.search(
         dumpbin_error_pattern, dumpbin_output_text, re.IGNORECASE
     ):
         print(
@@ -0,0 +1,234 @@
+"""Copying build outputs into `dist/` and the caches without exposing partial files.
+
+Binaries are published into `dist/` one file at a time, each replaced atomically
+as soon as it is built, instead of staging the whole directory and swapping it
+in at the end. Incremental builds only rewrite what changed and leave the other
+files untouched. `staged_directory` is still used where a directory has to be
+replaced as a whole, eg. xcframeworks.
+"""
+
+import contextlib
+import ctypes
+import os
+import shutil
+import sys
+import threading
+from pathlib import Path
+from typing import IO, Iterator, Optional, Union
+
+StrPath = Union[str, Path]
+
+# <linux/fs.h>: _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+_AT_FDCWD = -100
+# renameat2(2) RENAME_EXCHANGE on linux, renamex_np(2) RENAME_SWAP on macOS
+_RENAME_EXCHANGE = 2
+_RENAME_SWAP = 2
+
+_libc: Optional[ctypes.CDLL] = None
+
+
+def _get_libc() -> Optional[ctypes.CDLL]:
+    global _libc
+    if _libc is None and os.name == "posix":
+        _libc = ctypes.CDLL(None, use_errno=True)
+    return _libc
+
+
+def clone_file(src: StrPath, dst: StrPath) -> bool:
+    """Copy-on-write clone of `src` to a not yet existing `dst` (reflink on btrfs/xfs,
+    clonefile on APFS). Returns False when the filesystem doesn't support it."""
+    libc = _get_libc()
+    if sys.platform == "darwin" and libc is not None and hasattr(libc, "clonefile"):
+        return libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) == 0
+
+    if sys.platform.startswith("linux"):
+        import fcntl
+
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+                return True
+            except OSError:
+                pass
+        os.remove(dst)
+    return False
+
+
+def _copy_file_range(src: StrPath, dst: StrPath) -> bool:
+    if not hasattr(os, "copy_file_range"):
+        return False
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                pass
+            return True
+        except OSError:
+            pass
+    os.remove(dst)
+    return False
+
+
+def copy_file(src: StrPath, dst: StrPath, allow_hardlink: bool = False) -> str:
+    """Copies `src` to `dst` (file path) with the cheapest available method,
+    preserving permissions and timestamps like `shutil.copy2`.
+
+    Hardlinks share the data with `src`, so only allow them when neither side is
+    modified in place afterwards.
+
+    Returns the method used: "clone", "hardlink", "copy_file_range" or "copy".
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if clone_file(src, dst):
+        method = "clone"
+    elif allow_hardlink and _try_link(src, dst):
+        return "hardlink"
+    elif _copy_file_range(src, dst):
+        method = "copy_file_range"
+    else:
+        shutil.copyfile(src, dst)
+        method = "copy"
+    shutil.copystat(src, dst)
+    return method
+
+
+@contextlib.contextmanager
+def atomic_path(path: StrPath) -> Iterator[Path]:
+    """Yields a temporary sibling of `path` which is renamed over `path` when the
+    block finishes successfully, so `path` is never missing or partially written.
+    On error the temporary file is removed and `path` is left untouched."""
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.tmp-{os.getpid()}-{threading.get_ident()}")
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def atomic_write(path: StrPath, mode: str = "w") -> Iterator[IO]:
+    """`open(path, mode)` through `atomic_path`."""
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, mode) as f:
+            yield f
+
+
+def publish_file(src: StrPath, dst: StrPath) -> str:
+    """`copy_file` through `atomic_path`."""
+    with atomic_path(dst) as tmp_path:
+        return copy_file(src, tmp_path)
+
+
+def _try_link(src: StrPath, dst: StrPath) -> bool:
+    try:
+        os.link(src, dst)
+        return True
+    except OSError:
+        return False
+
+
+def copy_tree(src: StrPath, dst: StrPath, allow_hardlink: bool = False) -> None:
+    """`shutil.copytree(src, dst, dirs_exist_ok=True)` using `copy_file`."""
+    shutil.copytree(
+        src,
+        dst,
+        symlinks=True,
+        dirs_exist_ok=True,
+        copy_function=lambda s, d: copy_file(s, d, allow_hardlink),
+    )
+
+
+def sync_tree(src: StrPath, dst: StrPath) -> None:
+    """Makes `dst` a copy of `src`, removing what is not in `src`.
+
+    Only files whose size or modification time differ are copied, so tools
+    checking their inputs by timestamp (eg. gradle) see unchanged files as
+    unchanged.
+    """
+    expected = set()
+    for root, dirs, files in os.walk(src):
+        dst_root = os.path.normpath(os.path.join(dst, os.path.relpath(root, src)))
+        os.makedirs(dst_root, exist_ok=True)
+        expected.add(dst_root)
+        for file in files:
+            src_path = os.path.join(root, file)
+            dst_path = os.path.join(dst_root, file)
+            expected.add(dst_path)
+            src_stat = os.stat(src_path)
+            try:
+                dst_stat = os.stat(dst_path)
+            except FileNotFoundError:
+                dst_stat = None
+            if (
+                dst_stat is None
+                or dst_stat.st_size != src_stat.st_size
+                or dst_stat.st_mtime_ns != src_stat.st_mtime_ns
+            ):
+                copy_file(src_path, dst_path)
+
+    for root, dirs, files in os.walk(dst, topdown=False):
+        for name in files + dirs:
+            path = os.path.normpath(os.path.join(root, name))
+            if path in expected:
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+
+def _exchange(a: StrPath, b: StrPath) -> bool:
+    """Atomically swaps two existing paths."""
+    libc = _get_libc()
+    if libc is None:
+        return False
+    if sys.platform.startswith("linux") and hasattr(libc, "renameat2"):
+        return (
+            libc.renameat2(
+                _AT_FDCWD, os.fsencode(a), _AT_FDCWD, os.fsencode(b), _RENAME_EXCHANGE
+            )
+            == 0
+        )
+    if sys.platform == "darwin" and hasattr(libc, "renamex_np"):
+        return libc.renamex_np(os.fsencode(a), os.fsencode(b), _RENAME_SWAP) == 0
+    return False
+
+
+def replace_directory(staging_dir: StrPath, directory: StrPath) -> None:
+    """Moves `staging_dir` to `directory`, replacing its current contents.
+
+    Where supported both directories are exchanged with a single rename, so
+    `directory` is never missing or partially populated.
+    """
+    if not os.path.exists(directory):
+        os.rename(staging_dir, directory)
+    elif _exchange(staging_dir, directory):
+        shutil.rmtree(staging_dir)
+    else:
+        old_dir = f"{staging_dir}.old"
+        os.rename(directory, old_dir)
+        os.rename(staging_dir, directory)
+        shutil.rmtree(old_dir)
+
+
+@contextlib.contextmanager
+def staged_directory(directory: StrPath) -> Iterator[Path]:
+    """Yields an empty sibling directory of `directory` which replaces it when the
+    block finishes successfully. On error `directory` is left untouched."""
+    directory = Path(directory)
+    directory.parent.mkdir(parents=True, exist_ok=True)
+    staging_dir = directory.parent / f".{directory.name}.staging-{os.getpid()}"
+    if staging_dir.exists():
+        shutil.rmtree(staging_dir)
+    staging_dir.mkdir()
+    try:
+        yield staging_dir
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    replace_directory(staging_dir, directory)
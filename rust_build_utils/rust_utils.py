@@ -1,17 +1,29 @@
 import argparse
-import hashlib
+import contextlib
 import subprocess
 import os
 import shutil
 import importlib
-from typing import Any, Dict, List, Optional, Tuple
-from dataclasses import dataclass
+import json
+import sys
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import MappingProxyType
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Tuple
+from dataclasses import dataclass, field, replace
 from rust_build_utils.rust_utils_config import GLOBAL_CONFIG
 from pathlib import Path
-from rust_build_utils.msvc import activate_msvc, deactivate_msvc, is_msvc_active
+from rust_build_utils.msvc import is_msvc_active, msvc_env
+import rust_build_utils.cargo_timings as cargo_timings
+import rust_build_utils.checksum as checksum
+import rust_build_utils.fingerprint as fingerprint
+import rust_build_utils.publish as publish
+import rust_build_utils.rustup as rustup
+import rust_build_utils.tracing as tracing
 
 
 PackageList = Dict[str, Dict[str, str]]
+EnvSpec = Dict[str, Tuple[List[str], str]]
 
 LIPO_TARGET_OSES = ["macos", "ios", "ios-sim", "tvos", "tvos-sim"]
 XCFRAMEWORK_TARGET_OSES = ["macos", "ios", "ios-sim", "tvos", "tvos-sim"]
@@ -21,12 +33,21 @@ RUST_NIGHTLY_VERSION = "2025-06-20"  # 1.89.0 was branched on this day, see top
 
 @dataclass
 class CargoConfig:
-    """Arch 'arm64' (eg. the macos arch on arm) will be replaced with 'aarch64'."""
+    """Arch 'arm64' (eg. the macos arch on arm) will be replaced with 'aarch64'.
+
+    `env` is the resolved environment every command of the build runs with, see
+    `resolve_env`. When it's not given, `_cargo` resolves it from GLOBAL_CONFIG.
+
+    With `timings` set, a compile time report of the build is written to
+    `.build/timings/`.
+    """
 
     target_os: str
     arch: str
     debug: bool
     rust_target: str = ""
+    env: Optional[Mapping[str, str]] = field(default=None, compare=False, repr=False)
+    timings: bool = field(default=False, compare=False)
 
     def __post_init__(self):
         if self.arch == "arm64":
@@ -62,7 +83,12 @@ class Project:
         build_dir.resolve().mkdir(exist_ok=True)
         return build_dir
 
-    def get_cargo_target_dir(self) -> str:
+    def get_cargo_target_dir(self, env: Optional[Mapping[str, str]] = None) -> str:
+        """Target dir of cargo, `env` is the environment of the build and
+        defaults to `os.environ`."""
+        env = os.environ if env is None else env
+        if "CARGO_TARGET_DIR" in env:
+            return os.path.normpath(env["CARGO_TARGET_DIR"])
         if self.working_dir:
             return os.path.normpath(self.working_dir + "/target/")
         else:
@@ -74,8 +100,14 @@ class Project:
     def get_distribution_dir(self) -> str:
         return os.path.normpath(self.root_dir + "/dist/")
 
-    def get_cargo_path(self, target: str, path: str, debug: bool) -> str:
-        cargo_dir = self.get_cargo_target_dir()
+    def get_cargo_path(
+        self,
+        target: str,
+        path: str,
+        debug: bool,
+        env: Optional[Mapping[str, str]] = None,
+    ) -> str:
+        cargo_dir = self.get_cargo_target_dir(env)
         if debug:
             return os.path.normpath(f"{cargo_dir}/{target}/debug/{path}")
         return os.path.normpath(f"{cargo_dir}/{target}/release/{path}")
@@ -101,6 +133,79 @@ class Project:
         return f"{self.get_distribution_dir()}/darwin"
 
 
+def _env_values(values) -> List[str]:
+    return [values] if isinstance(values, str) else list(values)
+
+
+def _merge_env_specs(global_env: Dict[str, Any], local_env: Dict[str, Any]) -> EnvSpec:
+    merged = {key: (_env_values(v[0]), v[1]) for key, v in global_env.items()}
+    for key, (values, mode) in local_env.items():
+        if key in merged and mode == "append":
+            merged_values = merged[key][0]
+            merged_values.extend(
+                v for v in _env_values(values) if v not in merged_values
+            )
+        else:
+            merged[key] = (_env_values(values), mode)
+    return merged
+
+
+def resolve_env(
+    config: CargoConfig,
+    local_config: Optional[Dict[str, Any]] = None,
+    base: Optional[Mapping[str, str]] = None,
+) -> Mapping[str, str]:
+    """Resolve the environment for building `config` without touching `os.environ`.
+
+    Environment variables of GLOBAL_CONFIG and `local_config` (eg. a project's
+    own config, same structure) are merged the same way `config_local_env_vars`
+    and `set_env_var` do it: "set" variables are cleared and all values are
+    concatenated, os specific ones first, arch specific ones after.
+
+    Args:
+        config (CargoConfig): target being built
+        local_config (dict): optional project config keyed by target os
+        base (Mapping): environment to start from, defaults to `os.environ`
+    """
+    local_os_config = (local_config or {}).get(config.target_os, {})
+    global_os_config = GLOBAL_CONFIG[config.target_os]
+    specs = [
+        _merge_env_specs(
+            global_os_config.get("env", {}), local_os_config.get("env", {})
+        ),
+        _merge_env_specs(
+            global_os_config["archs"].get(config.arch, {}).get("env", {}),
+            local_os_config.get("archs", {}).get(config.arch, {}).get("env", {}),
+        ),
+    ]
+
+    env = dict(os.environ if base is None else base)
+    for spec in specs:
+        for key, (_, mode) in spec.items():
+            if mode == "set":
+                env[key] = ""
+    for spec in specs:
+        for key, (values, _) in spec.items():
+            env[key] = env.get(key, "") + "".join(values)
+    return MappingProxyType(env)
+
+
+def _apply_env_hooks(config: CargoConfig, env: Mapping[str, str]) -> Mapping[str, str]:
+    hooks = GLOBAL_CONFIG[config.target_os].get("env_hooks", [])
+    if not hooks:
+        return env
+    # Hooks see the environment resolved so far in `config.env`
+    resolved = replace(config, env=env)
+    updated = dict(env)
+    for function in hooks:
+        updated.update(str_to_func_call(function)(resolved))
+    return MappingProxyType(updated)
+
+
+# The functions below mutate `os.environ` and GLOBAL_CONFIG. They are kept for
+# compatibility only, builds use `resolve_env` and pass the result to commands.
+
+
 def concatenate_env_variable(env_var: str, value_array):
     for value in value_array:
         os.environ[env_var] += value
@@ -120,15 +225,7 @@ def clear_env_variables(config):
 
 
 def set_env_var(config):
-    clear_env_variables(config)
-    if "env" in GLOBAL_CONFIG[config.target_os]:
-        for key, value in GLOBAL_CONFIG[config.target_os]["env"].items():
-            concatenate_env_variable(key, value[0])
-    if "env" in GLOBAL_CONFIG[config.target_os]["archs"].get(config.arch, {}):
-        for key, value in GLOBAL_CONFIG[config.target_os]["archs"][config.arch][
-            "env"
-        ].items():
-            concatenate_env_variable(key, value[0])
+    os.environ.update(resolve_env(config))
 
 
 def config_local_env_vars(config, local_config):
@@ -184,6 +281,12 @@ def check_config(config):
 
 def create_cli_parser() -> Any:
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--trace",
+        type=str,
+        metavar="FILE",
+        help=f"Write a Chrome trace of every spawned command to FILE and print a summary (also enabled by {tracing.TRACE_ENV_VAR}=FILE)",
+    )
     subparsers = parser.add_subparsers(dest="command")
     subparsers.required = True
 
@@ -192,6 +295,44 @@ def create_cli_parser() -> Any:
     build_parser.add_argument("arch", type=str)
     build_parser.add_argument("--target", type=str)
     build_parser.add_argument("--debug", action="store_true", help="Create debug build")
+    build_parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="Write a per-crate compile time report to .build/timings/",
+    )
+
+    matrix_parser = subparsers.add_parser(
+        "build-matrix", help="build multiple os/arch pairs concurrently"
+    )
+    matrix_parser.add_argument(
+        "targets",
+        type=str,
+        nargs="+",
+        help="'os:arch' pairs to build, a bare 'os' builds all of its archs",
+    )
+    matrix_parser.add_argument(
+        "--debug", action="store_true", help="Create debug builds"
+    )
+    matrix_parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="Write a per-crate compile time report of every build to .build/timings/",
+    )
+    matrix_parser.add_argument(
+        "--jobs",
+        type=int,
+        help="Total number of compile jobs shared by all builds (default: number of CPUs)",
+    )
+    matrix_parser.add_argument(
+        "--parallel",
+        type=int,
+        help="Maximum number of targets built at the same time (default: all)",
+    )
+    matrix_parser.add_argument(
+        "--shared-target-dir",
+        action="store_true",
+        help="Use the project cargo target dir for every build instead of one per target",
+    )
 
     subparsers.add_parser("bindings", help="generate uniffi bindings")
 
@@ -261,6 +402,24 @@ def create_cli_parser() -> Any:
         help="Path to init.gradle template to be used instead of the default one",
         required=False,
     )
+    aar_parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="""Run gradle only when the bindings or templates change and add the
+        native libraries to the AAR directly, recompressing only changed ones""",
+    )
+    aar_parser.add_argument(
+        "--warm-gradle",
+        action="store_true",
+        help="""Keep the gradle project, daemon and a local build cache between runs
+        so that unchanged bindings are not compiled again""",
+    )
+    aar_parser.add_argument(
+        "--gradle-heap",
+        type=str,
+        default="1g",
+        help="Maximum heap size of the gradle JVM, eg. '2g'",
+    )
 
     ios_sim_parser = subparsers.add_parser(
         "build-ios-simulator-stubs",
@@ -298,17 +457,25 @@ def create_cli_parser() -> Any:
 
 
 def parse_cli():
-    return create_cli_parser().parse_args()
+    args = create_cli_parser().parse_args()
+    if args.trace:
+        tracing.enable(args.trace)
+    else:
+        tracing.enable_from_env()
+    return args
 
 
 def _build_packages(
-    config, packages: List[str], extra_args: Optional[List[str]], subcommand: str
+    project: Project,
+    config: CargoConfig,
+    packages: List[str],
+    extra_args: Optional[List[str]],
+    subcommand: str,
+    on_artifact: Callable[[str], None] = lambda path: None,
 ) -> None:
-    if (
-        "tvos" in config.target_os
-        or config.rust_target == "mipsel-unknown-linux-musl"
-        or config.rust_target == "mips-unknown-linux-musl"
-    ):
+    """Runs cargo, calling `on_artifact` with the path of every artifact as soon
+    as cargo reports it."""
+    if _uses_nightly(config):
         args = [
             "cargo",
             f"+nightly-{RUST_NIGHTLY_VERSION}",
@@ -334,9 +501,48 @@ def _build_packages(
     for p in packages:
         args.append("--package")
         args.append(p)
+    # cargo's own flags go before `extra_args`, which may pass flags to rustc
+    # after a `--`
+    args.append("--message-format=json-render-diagnostics")
+    if config.timings:
+        args.append("--timings")
     args.extend(extra_args or [])
 
-    run_command(args)
+    fresh_units = 0
+    with tracing.phase("cargo"):
+        for line in run_command_streaming(args, env=config.env):
+            if not line.startswith("{"):
+                print(line, end="")
+                continue
+            message = json.loads(line)
+            if message.get("reason") != "compiler-artifact":
+                continue
+            fresh_units += bool(message.get("fresh"))
+            for filename in message.get("filenames", []):
+                on_artifact(filename)
+
+    if config.timings:
+        _write_timings_report(project, config, fresh_units)
+
+
+def _write_timings_report(
+    project: Project, config: CargoConfig, fresh_units: int
+) -> None:
+    report_path = (
+        project.get_build_dir()
+        / "timings"
+        / f"{config.target_os}-{config.arch}-{'debug' if config.debug else 'release'}.json"
+    )
+    report = cargo_timings.write_report(
+        cargo_timings.timings_html_path(project.get_cargo_target_dir(config.env)),
+        report_path,
+        fresh_units,
+    )
+    if report is None:
+        print("cargo did not write a timings report\n")
+    else:
+        print(cargo_timings.format_report(report))
+        print(f"|TIMINGS| report written to {report_path}\n")
 
 
 def build(
@@ -393,83 +599,367 @@ def _cargo(
         else GLOBAL_CONFIG[config.target_os]["archs"][config.arch]["dist"]
     )
 
-    pre_build(config)
+    config = _resolve_build_config(config)
     distribution_dir = project.get_distribution_path(
         config.target_os, arch, "", config.debug
     )
 
-    if os.path.isdir(distribution_dir):
-        shutil.rmtree(distribution_dir)
-    os.makedirs(distribution_dir)
+    _provision_toolchain(project, config)
 
-    if (
+    fingerprint_path = (
+        project.get_build_dir()
+        / "fingerprints"
+        / f"{config.target_os}-{arch}-{'debug' if config.debug else 'release'}.json"
+    )
+    inputs = _build_inputs_digest(project, config, subcommand, packages, extra_args)
+    previous = fingerprint.load(fingerprint_path)
+    if _is_up_to_date(previous, inputs, distribution_dir):
+        print(f"{distribution_dir} is up to date, skipping build\n")
+        return
+    fingerprint.remove(fingerprint_path)
+
+    config = _with_msvc_env(config, arch)
+
+    # dist file name -> (package, bin name, bin)
+    artifacts = {
+        os.path.basename(bin): (package, name, bin)
+        for package, bins in packages.items()
+        for name, bin in bins.items()
+    }
+    os.makedirs(distribution_dir, exist_ok=True)
+    _prune_stale_artifacts(distribution_dir, previous, artifacts)
+
+    checksum_cache = get_checksum_cache(project)
+    published: Dict[str, Future] = {}
+    try:
+        # Artifacts are published and post processed as soon as cargo reports
+        # them, while cargo is still building the others
+        workers = min(len(artifacts), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+
+            def publish_artifact(name: str, cargo_bin_path: str) -> None:
+                published[name] = executor.submit(
+                    _publish_artifact,
+                    project,
+                    config,
+                    checksum_cache,
+                    distribution_dir,
+                    cargo_bin_path,
+                )
+
+            def on_artifact(path: str) -> None:
+                name = os.path.basename(path)
+                if name in artifacts and name not in published:
+                    publish_artifact(name, path)
+
+            _build_packages(
+                project,
+                config,
+                list(packages.keys()),
+                extra_args,
+                subcommand,
+                on_artifact,
+            )
+            # Artifacts cargo didn't report are expected at their usual location
+            for name, (_, _, bin) in artifacts.items():
+                if name not in published:
+                    publish_artifact(
+                        name,
+                        project.get_cargo_path(
+                            config.rust_target, bin, config.debug, config.env
+                        ),
+                    )
+        # dist file name -> (checksum file, checksum) of the changed artifacts
+        changed = {
+            name: result
+            for name in artifacts
+            if (result := published[name].result()) is not None
+        }
+
+        if changed:
+            post_build(project, config, packages)
+        else:
+            print(
+                "Skipping post build steps since none of the built binaries have changed"
+            )
+        # Checksums are only recorded once post build steps succeeded, so a failed
+        # post build step is retried by the next build
+        for cksum_path, cksum in changed.values():
+            with open(cksum_path, "w") as f:
+                f.write(cksum)
+    finally:
+        checksum_cache.save()
+
+    fingerprint.save(
+        fingerprint_path,
+        {
+            "inputs": inputs,
+            "dist": fingerprint.tree_stats(Path(distribution_dir)),
+            "artifacts": sorted(artifacts),
+        },
+    )
+
+
+def _publish_artifact(
+    project: Project,
+    config: CargoConfig,
+    checksum_cache: checksum.ChecksumCache,
+    distribution_dir: str,
+    cargo_bin_path: str,
+) -> Optional[Tuple[str, str]]:
+    """Publishes a single artifact to the dist directory and runs the
+    `post_artifact` hooks for it, unless it didn't change since it was last
+    published.
+
+    Returns the checksum file of the artifact and its new checksum, or None when
+    the artifact didn't change.
+    """
+    cksum = checksum_cache.checksum(cargo_bin_path)
+    cksum_path = f"{cargo_bin_path}.sha256"
+    cksum_old = (
+        (path.read_text().strip() or None)
+        if (path := Path(cksum_path)).exists()
+        else None
+    )
+    dist_bin_path = os.path.join(distribution_dir, os.path.basename(cargo_bin_path))
+    if cksum_old == cksum and os.path.isfile(dist_bin_path):
+        print(f"{cargo_bin_path} has not changed")
+        return None
+    print(f"{cargo_bin_path} has changed, new checksum: {cksum} vs old: {cksum_old}")
+
+    # copies executable permissions, no hardlinks since post build steps (eg.
+    # strip) modify the published binaries in place
+    publish.publish_file(cargo_bin_path, dist_bin_path)
+    # A copy has the same checksum, no need to read it again
+    checksum_cache.record(dist_bin_path, cksum)
+    post_artifact(project, config, dist_bin_path)
+    return cksum_path, cksum
+
+
+def _prune_stale_artifacts(
+    distribution_dir: str, previous: Optional[dict], artifacts: Dict[str, Any]
+) -> None:
+    """Removes artifacts published by the previous build that are no longer built,
+    together with files derived from them (eg. `<bin>.debug`)."""
+    stale = [a for a in (previous or {}).get("artifacts", []) if a not in artifacts]
+    for entry in os.listdir(distribution_dir) if stale else []:
+        if entry in artifacts:
+            continue
+        if any(entry == a or entry.startswith(f"{a}.") for a in stale):
+            print(f"Removing stale {entry} from {distribution_dir}")
+            remove_tree_or_file(os.path.join(distribution_dir, entry))
+
+
+def _build_inputs_digest(
+    project: Project,
+    config: CargoConfig,
+    subcommand: str,
+    packages: PackageList,
+    extra_args: Optional[List[str]],
+) -> Optional[str]:
+    """Digest of everything that affects the output of a build, None when it
+    can't be determined."""
+    workspace_dir = Path(project.working_dir or project.root_dir)
+    dependency_dirs = _local_dependency_dirs(workspace_dir, config.env)
+    if dependency_dirs is None:
+        return None
+    rustup_state = rustup.load_state(
+        project.get_build_dir() / "rustup-state.json", config.env
+    )
+    return fingerprint.digest(
+        {
+            "subcommand": subcommand,
+            "rust_target": config.rust_target,
+            "debug": config.debug,
+            "packages": packages,
+            "extra_args": extra_args or [],
+            "toolchain": (
+                f"nightly-{RUST_NIGHTLY_VERSION}"
+                if _uses_nightly(config)
+                else project.rust_version
+            ),
+            "rustup": rustup_state["fingerprint"],
+            "env": fingerprint.relevant_env(
+                config.env or {}, ignored=[TOOLCHAIN_PROVISIONED_ENV_VAR]
+            ),
+            "hooks": [
+                GLOBAL_CONFIG[config.target_os].get(hook, [])
+                for hook in ("pre_build", "env_hooks", "post_artifact", "post_build")
+            ],
+            "cargo_lock": fingerprint.file_digest(workspace_dir / "Cargo.lock"),
+            "sources": fingerprint.tree_stats(
+                workspace_dir,
+                exclude=[
+                    Path(project.get_cargo_target_dir(config.env)),
+                    workspace_dir / "target",
+                    Path(project.get_distribution_dir()),
+                    project.get_build_dir(),
+                    Path(project.root_dir) / "android_aar",
+                ],
+            ),
+            "dependency_sources": {
+                path: fingerprint.tree_stats(
+                    Path(path), exclude=[Path(path) / "target"]
+                )
+                for path in dependency_dirs
+            },
+        }
+    )
+
+
+def _local_dependency_dirs(
+    workspace_dir: Path, env: Optional[Mapping[str, str]]
+) -> Optional[List[str]]:
+    """Directories of path dependencies and `[patch]` targets outside of the
+    workspace, None when cargo can't resolve the dependencies."""
+    try:
+        code, output = tracing.run(
+            [
+                "cargo",
+                "metadata",
+                "--format-version",
+                "1",
+                "--offline",
+                "--manifest-path",
+                str(workspace_dir / "Cargo.toml"),
+            ],
+            env,
+            capture=True,
+            check=False,
+            # Failures only make the build skip the fingerprint check
+            stderr=subprocess.DEVNULL,
+        )
+    except OSError:
+        return None
+    if code != 0 or output is None:
+        return None
+    workspace_dir = workspace_dir.resolve()
+    dirs: List[str] = []
+    # Packages without a source are local ones, sorted so nested directories
+    # come after the directory containing them
+    for package_dir in sorted(
+        Path(package["manifest_path"]).parent.resolve()
+        for package in json.loads(output)["packages"]
+        if package["source"] is None
+    ):
+        if package_dir.is_relative_to(workspace_dir) or any(
+            package_dir.is_relative_to(d) for d in dirs
+        ):
+            continue
+        dirs.append(str(package_dir))
+    return dirs
+
+
+def _is_up_to_date(
+    record: Optional[dict], inputs: Optional[str], distribution_dir: str
+) -> bool:
+    """True when the inputs and the dist contents match the last successful build."""
+    if record is None or inputs is None or record.get("inputs") != inputs:
+        return False
+    dist = fingerprint.tree_stats(Path(distribution_dir))
+    return bool(dist) and record.get("dist") == dist
+
+
+def _uses_nightly(config: CargoConfig) -> bool:
+    # These targets are built with `-Z build-std`
+    return (
         "tvos" in config.target_os
         or config.rust_target == "mipsel-unknown-linux-musl"
         or config.rust_target == "mips-unknown-linux-musl"
-    ):
-        run_command(
-            ["rustup", "toolchain", "install", f"nightly-{RUST_NIGHTLY_VERSION}"]
+    )
+
+
+def _toolchain_commands(
+    project: Project, configs: List[CargoConfig], state: Dict
+) -> List[List[str]]:
+    commands: List[List[str]] = []
+    targets = [config.rust_target for config in configs if not _uses_nightly(config)]
+    if targets:
+        commands += rustup.missing_commands(
+            state,
+            project.rust_version,
+            targets=targets,
+            components=["rustfmt"],
+            make_default=True,
         )
-        run_command(
-            [
-                "rustup",
-                "component",
-                "add",
-                "rust-src",
-                "--toolchain",
-                f"nightly-{RUST_NIGHTLY_VERSION}",
-            ]
+    if len(targets) < len(configs):
+        commands += rustup.missing_commands(
+            state, f"nightly-{RUST_NIGHTLY_VERSION}", components=["rust-src"]
         )
-    else:
-        run_command(["rustup", "default", project.rust_version])
-        run_command(["rustup", "target", "add", config.rust_target])
-    run_command(["rustup", "component", "add", "rustfmt"])
-
-    msvc_context = None
-    if config.rust_target.endswith("-msvc") and not is_msvc_active():
-        # For msvc based toolchains msvc development environment needs activation
-        msvc_context = activate_msvc(arch)
-
-    _build_packages(config, list(packages.keys()), extra_args, subcommand)
-
-    any_changed = False
-    for _, bins in packages.items():
-        for _, bin in bins.items():
-            cargo_bin_path = project.get_cargo_path(
-                config.rust_target, bin, config.debug
-            )
-            cksum = compute_sha256(cargo_bin_path)
-            cksum_path = f"{cargo_bin_path}.sha256"
-            cksum_old = (
-                (path.read_text().strip() or None)
-                if (path := Path(cksum_path)).exists()
-                else None
+        # rustfmt is needed by the active (default) toolchain, which is
+        # provisioned above when there are stable builds too
+        if targets:
+            return commands
+        if state["default_toolchain"]:
+            commands += rustup.missing_commands(
+                state, state["default_toolchain"], components=["rustfmt"]
             )
-            if cksum_old != cksum:
-                print(
-                    f"{cargo_bin_path} has changed, new checksum: {cksum} vs old: {cksum_old}"
-                )
-                any_changed = True
-                with open(cksum_path, "w") as f:
-                    f.write(cksum)
-            # copies executable permissions
-            shutil.copy2(cargo_bin_path, distribution_dir)
-
-    if any_changed:
-        post_build(project, config, packages)
+        else:
+            commands.append(["rustup", "component", "add", "rustfmt"])
+    return commands
+
+
+def provision_toolchains(
+    project: Project,
+    configs: List[CargoConfig],
+    env: Optional[Mapping[str, str]] = None,
+) -> None:
+    """Makes sure the toolchains, targets and components of all builds are installed.
+
+    Installed state is cached in `.build/rustup-state.json` and only refreshed when
+    the rustup home changes, so rustup is spawned only for what is actually missing.
+    """
+    cache_file = project.get_build_dir() / "rustup-state.json"
+    with tracing.phase("rustup"):
+        state = rustup.load_state(cache_file, env)
+
+    commands = _toolchain_commands(project, configs, state)
+    with tracing.phase("rustup"):
+        for command in commands:
+            run_command(command, env=env)
+    if commands:
+        rustup.invalidate(cache_file)
     else:
-        print("Skipping post build steps since none of the built binaries have changed")
+        targets = ", ".join(config.rust_target for config in configs)
+        print(f"Rust toolchain for {targets} is already provisioned\n")
+
+
+def _provision_toolchain(project: Project, config: CargoConfig) -> None:
+    env = config.env if config.env is not None else os.environ
+    if env.get(TOOLCHAIN_PROVISIONED_ENV_VAR):
+        # Done by the parent `build_matrix`, concurrent rustup runs would race
+        return
+    provision_toolchains(project, [config], config.env)
+
+
+def _resolve_build_config(config: CargoConfig) -> CargoConfig:
+    """Returns a copy of `config` carrying the complete environment of the build."""
+    _run_pre_build_hooks(config)
+    env = config.env if config.env is not None else resolve_env(config)
+    return replace(config, env=_apply_env_hooks(config, env))
 
-    if msvc_context is not None:
-        deactivate_msvc(msvc_context)
+
+def _with_msvc_env(config: CargoConfig, arch: str) -> CargoConfig:
+    env = config.env if config.env is not None else os.environ
+    if not config.is_msvc() or is_msvc_active(env):
+        return config
+    # For msvc based toolchains msvc development environment needs activation
+    return replace(config, env=MappingProxyType(msvc_env(arch, base_env=env)))
 
 
 def compute_sha256(file_path):
-    sha256 = hashlib.sha256()
-    with open(file_path, "rb") as f:
-        while chunk := f.read(8192):
-            sha256.update(chunk)
-    return sha256.hexdigest()
+    return checksum.sha256_file(file_path)
+
+
+_checksum_caches: Dict[str, checksum.ChecksumCache] = {}
+
+
+def get_checksum_cache(project: Project) -> checksum.ChecksumCache:
+    """Checksum cache of the project, persisted in `.build/checksums.json`."""
+    path = project.get_build_dir() / "checksums.json"
+    if str(path) not in _checksum_caches:
+        _checksum_caches[str(path)] = checksum.ChecksumCache(path)
+    return _checksum_caches[str(path)]
 
 
 def str_to_func_call(func_string):
@@ -482,7 +972,13 @@ def str_to_func_call(func_string):
 
 
 def pre_build(config):
+    """Legacy pre build step, applies the build environment to `os.environ`."""
     set_env_var(config)
+    _run_pre_build_hooks(config)
+    os.environ.update(_apply_env_hooks(config, os.environ))
+
+
+def _run_pre_build_hooks(config):
     if "pre_build" in GLOBAL_CONFIG[config.target_os]:
         pre_array = GLOBAL_CONFIG[config.target_os]["pre_build"]
         for function in pre_array:
@@ -490,23 +986,53 @@ def pre_build(config):
             func_call(config)
 
 
+def post_artifact(project: Project, config: CargoConfig, bin_path: str) -> None:
+    """Runs the post artifact hooks of the target os for a single published binary.
+
+    Called from the publishing threads while cargo is still building, so hooks run
+    concurrently for different binaries.
+    """
+    for function in GLOBAL_CONFIG[config.target_os].get("post_artifact", []):
+        func_call = str_to_func_call(function)
+        with tracing.phase("post_artifact"), tracing.span(function):
+            func_call(project, config, bin_path)
+
+
 def post_build(project: Project, config: CargoConfig, packages: PackageList) -> None:
+    """Runs the post build hooks of the target os with all `packages`, once cargo
+    finished and the post artifact hooks of all changed binaries returned."""
     if "post_build" in GLOBAL_CONFIG[config.target_os]:
         post_array = GLOBAL_CONFIG[config.target_os]["post_build"]
         for function in post_array:
             func_call = str_to_func_call(function)
-            func_call(project, config, packages)
+            with tracing.phase("post_build"), tracing.span(function):
+                func_call(project, config, packages)
+
+
+def _subprocess_env(env: Optional[Mapping[str, str]]) -> Optional[Dict[str, str]]:
+    return None if env is None else dict(env)
+
+
+def run_command(command, env: Optional[Mapping[str, str]] = None):
+    print("|EXECUTE| {}".format(" ".join(command)))
+    tracing.check_call(command, env=_subprocess_env(env))
+    print("")
 
 
-def run_command(command):
+def run_command_streaming(
+    command, env: Optional[Mapping[str, str]] = None
+) -> Iterator[str]:
+    """Yields the output of the command line by line while it is running."""
     print("|EXECUTE| {}".format(" ".join(command)))
-    subprocess.check_call(command)
+    yield from tracing.stream(command, env=env)
     print("")
 
 
-def run_command_with_output(command, hide_output=False):
+def run_command_with_output(
+    command, hide_output=False, env: Optional[Mapping[str, str]] = None
+):
     print("|EXECUTE| {}".format(" ".join(command)))
-    result = subprocess.check_output(command).decode("utf-8")
+    result = tracing.check_output(command, env=_subprocess_env(env)).decode("utf-8")
     if hide_output:
         print("(OUTPUT HIDDEN)\n")
     else:
@@ -514,6 +1040,53 @@ def run_command_with_output(command, hide_output=False):
     return result
 
 
+def run_in_parallel(
+    tasks: Dict[str, Callable[[], Any]],
+    step: str,
+    max_workers: Optional[int] = None,
+) -> Dict[str, float]:
+    """Runs independent tasks in a bounded thread pool and reports their durations.
+
+    Args:
+        tasks (Dict[str, Callable]): task name to function
+        step (str): name of the step, used when reporting timings
+        max_workers (int): size of the pool, defaults to the number of CPUs
+
+    Returns the duration of every task in seconds. All tasks are run to
+    completion, afterwards the first failure is raised.
+    """
+
+    # Tasks run in the caller's phase, threads don't inherit context variables
+    phase = tracing.current_phase()
+
+    def timed(name: str, task: Callable[[], Any]) -> float:
+        start = time.monotonic()
+        with tracing.phase(phase), tracing.span(f"{step} {name}"):
+            task()
+        return time.monotonic() - start
+
+    start = time.monotonic()
+    workers = max(1, min(len(tasks), max_workers or os.cpu_count() or 1))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            name: executor.submit(timed, name, task) for name, task in tasks.items()
+        }
+
+    durations: Dict[str, float] = {}
+    error: Optional[BaseException] = None
+    for name, future in futures.items():
+        if future.exception() is not None:
+            error = error or future.exception()
+            print(f"|TIMING| {step} {name}: failed")
+        else:
+            durations[name] = future.result()
+            print(f"|TIMING| {step} {name}: {durations[name]:.2f}s")
+    print(f"|TIMING| {step}: {time.monotonic() - start:.2f}s total\n")
+    if error is not None:
+        raise error
+    return durations
+
+
 def copy_tree_or_file(src, dst):
     try:
         shutil.copytree(
@@ -534,6 +1107,256 @@ def remove_tree_or_file(path):
         os.remove(path)
 
 
+MATRIX_STATUS_INTERVAL = 30.0
+# Set for the builds spawned by `build_matrix`, which provisions all toolchains up front
+TOOLCHAIN_PROVISIONED_ENV_VAR = "RUST_BUILD_UTILS_TOOLCHAIN_PROVISIONED"
+MATRIX_LOG_TAIL_LINES = 40
+
+
+@dataclass
+class MatrixJob:
+    """A single target of a `build_matrix` invocation."""
+
+    config: CargoConfig
+    command: List[str]
+    log_path: Path
+    status: str = "pending"
+    returncode: Optional[int] = None
+    started: float = 0.0
+    duration: float = 0.0
+
+    @property
+    def name(self) -> str:
+        return f"{self.config.target_os}/{self.config.arch}" + (
+            " (debug)" if self.config.debug else ""
+        )
+
+
+@dataclass
+class MatrixResult:
+    jobs: List[MatrixJob]
+    duration: float
+
+    def succeeded(self) -> bool:
+        return all(job.returncode == 0 for job in self.jobs)
+
+    def failed(self) -> List[MatrixJob]:
+        return [job for job in self.jobs if job.returncode != 0]
+
+
+def parse_matrix_targets(
+    targets: List[str], debug: bool, timings: bool = False
+) -> List[CargoConfig]:
+    """Converts 'os:arch' (or bare 'os' for all of its archs) specs into configs."""
+    configs: List[CargoConfig] = []
+    for spec in targets:
+        target_os, _, arch = spec.partition(":")
+        if target_os not in GLOBAL_CONFIG:
+            raise Exception(
+                f"invalid os '{target_os}', expected {str(list(GLOBAL_CONFIG.keys()))}"
+            )
+        archs = [arch] if arch else list(GLOBAL_CONFIG[target_os]["archs"].keys())
+        for a in archs:
+            config = CargoConfig(target_os, a, debug, timings=timings)
+            check_config(config)
+            if config not in configs:
+                configs.append(config)
+    return configs
+
+
+def default_matrix_command(config: CargoConfig) -> List[str]:
+    """Re-invokes the running build script with `build <os> <arch>` for `config`."""
+    script = getattr(sys.modules["__main__"], "__file__", None) or sys.argv[0]
+    command = [
+        sys.executable,
+        os.path.abspath(script),
+        "build",
+        config.target_os,
+        config.arch,
+    ]
+    if config.debug:
+        command.append("--debug")
+    if config.timings:
+        command.append("--timings")
+    return command
+
+
+@contextlib.contextmanager
+def _matrix_job_budget(
+    jobs: int, parallel: int, directory: Path
+) -> Iterator[Dict[str, str]]:
+    """Yields environment variables that make all builds share `jobs` job slots.
+
+    On POSIX hosts a GNU make compatible jobserver (named pipe) is created, which
+    cargo, rustc and cc-rs inherit from `MAKEFLAGS`. Every cargo process owns one
+    implicit slot, so the pipe holds `jobs - parallel` tokens. Elsewhere the
+    budget is split evenly via `CARGO_BUILD_JOBS`.
+    """
+    if not hasattr(os, "mkfifo"):
+        yield {"CARGO_BUILD_JOBS": str(max(1, jobs // parallel))}
+        return
+
+    fifo = directory / f"jobserver-{os.getpid()}"
+    if fifo.exists():
+        fifo.unlink()
+    os.mkfifo(fifo)
+    # Keep the pipe open for the whole matrix, otherwise unread tokens are lost
+    fd = os.open(fifo, os.O_RDWR | os.O_NONBLOCK)
+    try:
+        os.write(fd, b"+" * max(0, jobs - parallel))
+        yield {"MAKEFLAGS": f"-j{jobs} --jobserver-auth=fifo:{fifo}"}
+    finally:
+        os.close(fd)
+        fifo.unlink()
+
+
+def _tail(path: Path, lines: int) -> List[str]:
+    try:
+        with open(path, "r", errors="replace") as f:
+            return f.read().splitlines()[-lines:]
+    except FileNotFoundError:
+        return []
+
+
+def _print_matrix_status(jobs: List[MatrixJob], details: bool = True) -> None:
+    done = [j for j in jobs if j.status in ("ok", "failed")]
+    running = [j for j in jobs if j.status == "running"]
+    failed = [j for j in jobs if j.status == "failed"]
+    print(
+        f"|MATRIX| {len(done)}/{len(jobs)} done, {len(running)} running, {len(failed)} failed"
+    )
+    if not details:
+        return
+    now = time.monotonic()
+    for job in running:
+        last_line = next(
+            (line for line in reversed(_tail(job.log_path, 5)) if line.strip()), ""
+        )
+        print(f"|MATRIX|   {job.name} [{now - job.started:.0f}s] {last_line.strip()}")
+
+
+def build_matrix(
+    project: Project,
+    configs: List[CargoConfig],
+    jobs: Optional[int] = None,
+    parallel: Optional[int] = None,
+    command: Callable[[CargoConfig], List[str]] = default_matrix_command,
+    isolate_target_dirs: bool = True,
+) -> MatrixResult:
+    """Builds several targets at once, each in its own process.
+
+    Args:
+        project (Project): Project object
+        configs (List[CargoConfig]): targets to build
+        jobs (int): compile job budget shared by all builds, defaults to the CPU count
+        parallel (int): maximum number of concurrently running builds, defaults to all
+        command (Callable): returns the command line building a single config
+        isolate_target_dirs (bool): give every build its own `CARGO_TARGET_DIR`.
+            Cargo locks the host part of a target dir for the whole build, so
+            builds sharing a target dir would run one after another.
+
+    Missing toolchains, targets and components of all configs are installed before
+    the builds start, the builds themselves skip provisioning, as concurrent rustup
+    invocations race on the shared rustup home.
+
+    Output of each build is written to `.build/matrix/<os>-<arch>-<profile>.log`.
+    """
+    if not configs:
+        raise ValueError("No targets specified")
+
+    jobs = max(1, jobs or os.cpu_count() or 1)
+    parallel = max(1, min(parallel or len(configs), len(configs), jobs))
+    log_dir = project.get_build_dir() / "matrix"
+    log_dir.mkdir(exist_ok=True)
+
+    matrix_jobs = [
+        MatrixJob(
+            config=config,
+            command=command(config),
+            log_path=log_dir
+            / f"{config.target_os}-{config.arch}-{'debug' if config.debug else 'release'}.log",
+        )
+        for config in configs
+    ]
+    pending = list(matrix_jobs)
+    running: List[Tuple[MatrixJob, tracing.Process, Any]] = []
+
+    provision_toolchains(project, configs)
+
+    print(
+        f"|MATRIX| building {len(matrix_jobs)} targets, {parallel} at a time, {jobs} jobs"
+    )
+    start = time.monotonic()
+    last_status = start
+    with _matrix_job_budget(jobs, parallel, log_dir) as budget_env:
+        try:
+            while pending or running:
+                while pending and len(running) < parallel:
+                    job = pending.pop(0)
+                    env = dict(os.environ, **budget_env)
+                    env[TOOLCHAIN_PROVISIONED_ENV_VAR] = "1"
+                    if isolate_target_dirs:
+                        env["CARGO_TARGET_DIR"] = os.path.join(
+                            project.get_cargo_target_dir(),
+                            "matrix",
+                            f"{job.config.target_os}-{job.config.arch}",
+                        )
+                    if tracing.is_enabled():
+                        env[tracing.TRACE_ENV_VAR] = str(
+                            job.log_path.with_suffix(".trace.json")
+                        )
+                    log = open(job.log_path, "w")
+                    print(f"|MATRIX| start {job.name}: {' '.join(job.command)}")
+                    with tracing.phase("matrix"):
+                        proc = tracing.spawn(
+                            job.command,
+                            env,
+                            stdout=log,
+                            stderr=subprocess.STDOUT,
+                            name=job.name,
+                        )
+                    job.status = "running"
+                    job.started = time.monotonic()
+                    running.append((job, proc, log))
+
+                for entry in list(running):
+                    job, proc, log = entry
+                    if proc.poll() is None:
+                        continue
+                    running.remove(entry)
+                    log.close()
+                    job.returncode = proc.returncode
+                    job.duration = time.monotonic() - job.started
+                    job.status = "ok" if proc.returncode == 0 else "failed"
+                    if tracing.is_enabled():
+                        tracing.merge(str(job.log_path.with_suffix(".trace.json")))
+                    print(
+                        f"|MATRIX| {job.status} {job.name} in {job.duration:.1f}s (log: {job.log_path})"
+                    )
+                    if job.status == "failed":
+                        for line in _tail(job.log_path, MATRIX_LOG_TAIL_LINES):
+                            print(f"|MATRIX|   {line}")
+                    _print_matrix_status(matrix_jobs, details=False)
+
+                if time.monotonic() - last_status >= MATRIX_STATUS_INTERVAL:
+                    last_status = time.monotonic()
+                    _print_matrix_status(matrix_jobs)
+                time.sleep(0.2)
+        finally:
+            for job, proc, log in running:
+                proc.terminate()
+                proc.wait()
+                log.close()
+                job.status = "failed"
+
+    result = MatrixResult(matrix_jobs, time.monotonic() - start)
+    print(f"|MATRIX| finished in {result.duration:.1f}s")
+    for job in matrix_jobs:
+        print(f"|MATRIX|   {job.status:<7} {job.duration:7.1f}s  {job.name}")
+    print("")
+    return result
+
+
 def generate_uniffi_bindings(
     project: Project,
     generator_version: str,
@@ -579,12 +1402,12 @@ def generate_uniffi_bindings(
             run_args.append(
                 f"ghcr.io/nordsecurity/uniffi-generators:{generator_version}"
             )
-            self.container_id = subprocess.check_output(run_args).decode().strip()
+            self.container_id = tracing.check_output(run_args).decode().strip()
             return self
 
         def __exit__(self, exc_type, exc_val, exc_tb):
             if self.container_id and self.dockerized:
-                subprocess.check_output(["docker", "stop", self.container_id])
+                tracing.check_output(["docker", "stop", self.container_id])
 
         def exec(self, cmd: List[str]):
             exec_args = (
@@ -598,12 +1421,12 @@ def generate_uniffi_bindings(
             )
 
             exec_args.extend(cmd)
-            return subprocess.check_output(
+            return tracing.check_output(
                 [str(item) for item in exec_args if item is not None]
             )
 
     try:
-        with UniffiContainer(dockerized) as container:
+        with tracing.phase("bindings"), UniffiContainer(dockerized) as container:
             for language in languages:
                 if language in ["kotlin", "swift", "python"]:
                     command = ["uniffi-bindgen", "generate", "--language", language]
@@ -40,7 +40,11 @@ WINDOWS_RUNTIME_LINKING = {
 #       }
 #   "env" :         [Optional, Dictionary], a dict of OS specific environment variables, follows the same structure as arch specific variables, see above.
 #   "pre_build" :   [Optional, List<String>], list of functions to call before the build begins (this is called after the LOCAL pre_build). Functions are written as "full_package_name.subpackage_name.function_name"
-#   "post_build" :  [Optional, List<String>], list of functions to call after the build begins (this is called before the LOCAL post_build). Functions are written as "full_package_name.subpackage_name.function_name"
+#   "env_hooks" :   [Optional, List<String>], list of functions returning a dict of extra environment variables for the build, called with the CargoConfig. Functions are written the same way as "pre_build"
+#   "post_artifact" : [Optional, List<String>], list of functions called with the project, the CargoConfig and the path of a single published binary, for every binary that
+#                   changed, as soon as cargo produced it and while it is still building the others. They run concurrently for different binaries. Functions are written the same way as "pre_build"
+#   "post_build" :  [Optional, List<String>], list of functions called with the project, the CargoConfig and all built packages once cargo finished and the "post_artifact"
+#                   functions of every changed binary returned, skipped when no binary changed (this is called before the LOCAL post_build). Functions are written the same way as "pre_build"
 # }
 
 GLOBAL_CONFIG: Dict[str, Any] = {
@@ -63,7 +67,7 @@ GLOBAL_CONFIG: Dict[str, Any] = {
                 "rust_target": "aarch64-unknown-linux-musl",
             },
         },
-        "post_build": ["rust_build_utils.linux_build_utils.strip"],
+        "post_artifact": ["rust_build_utils.linux_build_utils.strip_artifact"],
     },
     "android": {
         "archs": {
@@ -82,7 +86,7 @@ GLOBAL_CONFIG: Dict[str, Any] = {
             },
         },
         "env": {"PATH": (f":{NDK_IMAGE_PATH}", "append")},
-        "post_build": ["rust_build_utils.android_build_utils.strip"],
+        "post_artifact": ["rust_build_utils.android_build_utils.strip_artifact"],
     },
     "linux": {
         "archs": {
@@ -107,7 +111,7 @@ GLOBAL_CONFIG: Dict[str, Any] = {
                 "rust_target": "arm-unknown-linux-gnueabi",
             },
         },
-        "post_build": ["rust_build_utils.linux_build_utils.strip"],
+        "post_artifact": ["rust_build_utils.linux_build_utils.strip_artifact"],
     },
     "windows": {
         "archs": {
@@ -144,7 +148,9 @@ GLOBAL_CONFIG: Dict[str, Any] = {
             "CARGO_PROFILE_RELEASE_SPLIT_DEBUGINFO": (["packed"], "set"),
             "CARGO_PROFILE_RELEASE_STRIP": (["true"], "set"),
         },
-        "post_build": ["rust_build_utils.darwin_build_utils.assert_version"],
+        "post_artifact": [
+            "rust_build_utils.darwin_build_utils.assert_artifact_version"
+        ],
     },
     "ios": {
         "archs": {
@@ -160,8 +166,10 @@ GLOBAL_CONFIG: Dict[str, Any] = {
             "CARGO_PROFILE_RELEASE_SPLIT_DEBUGINFO": (["packed"], "set"),
             "CARGO_PROFILE_RELEASE_STRIP": (["true"], "set"),
         },
-        "pre_build": ["rust_build_utils.darwin_build_utils.set_sdk"],
-        "post_build": ["rust_build_utils.darwin_build_utils.assert_version"],
+        "env_hooks": ["rust_build_utils.darwin_build_utils.sdk_env"],
+        "post_artifact": [
+            "rust_build_utils.darwin_build_utils.assert_artifact_version"
+        ],
     },
     "ios-sim": {
         "archs": {
@@ -187,8 +195,10 @@ GLOBAL_CONFIG: Dict[str, Any] = {
             "CARGO_PROFILE_RELEASE_SPLIT_DEBUGINFO": (["packed"], "set"),
             "CARGO_PROFILE_RELEASE_STRIP": (["true"], "set"),
         },
-        "pre_build": ["rust_build_utils.darwin_build_utils.set_sdk"],
-        "post_build": ["rust_build_utils.darwin_build_utils.assert_version"],
+        "env_hooks": ["rust_build_utils.darwin_build_utils.sdk_env"],
+        "post_artifact": [
+            "rust_build_utils.darwin_build_utils.assert_artifact_version"
+        ],
     },
     "tvos": {
         "archs": {
@@ -204,8 +214,10 @@ GLOBAL_CONFIG: Dict[str, Any] = {
             "CARGO_PROFILE_RELEASE_SPLIT_DEBUGINFO": (["packed"], "set"),
             "CARGO_PROFILE_RELEASE_STRIP": (["true"], "set"),
         },
-        "pre_build": ["rust_build_utils.darwin_build_utils.set_sdk"],
-        "post_build": ["rust_build_utils.darwin_build_utils.assert_version"],
+        "env_hooks": ["rust_build_utils.darwin_build_utils.sdk_env"],
+        "post_artifact": [
+            "rust_build_utils.darwin_build_utils.assert_artifact_version"
+        ],
     },
     "tvos-sim": {
         "archs": {
@@ -228,7 +240,9 @@ GLOBAL_CONFIG: Dict[str, Any] = {
             "CARGO_PROFILE_RELEASE_SPLIT_DEBUGINFO": (["packed"], "set"),
             "CARGO_PROFILE_RELEASE_STRIP": (["true"], "set"),
         },
-        "pre_build": ["rust_build_utils.darwin_build_utils.set_sdk"],
-        "post_build": ["rust_build_utils.darwin_build_utils.assert_version"],
+        "env_hooks": ["rust_build_utils.darwin_build_utils.sdk_env"],
+        "post_artifact": [
+            "rust_build_utils.darwin_build_utils.assert_artifact_version"
+        ],
     },
 }
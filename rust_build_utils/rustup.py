@@ -0,0 +1,150 @@
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Mapping, Optional
+
+import rust_build_utils.publish as publish
+import rust_build_utils.tracing as tracing
+
+# Bump when the layout of the cached state changes
+STATE_VERSION = 1
+
+
+def rustup_home(env: Optional[Mapping[str, str]] = None) -> Path:
+    env = os.environ if env is None else env
+    if env.get("RUSTUP_HOME"):
+        return Path(env["RUSTUP_HOME"])
+    return Path(os.path.expanduser("~")) / ".rustup"
+
+
+def _fingerprint(home: Path) -> List[List[Any]]:
+    """Cheap summary of the rustup home, changes whenever a toolchain, target or
+    component is installed, removed or updated or the default toolchain changes.
+    """
+    toolchains_dir = home / "toolchains"
+    paths = [home / "settings.toml", toolchains_dir]
+    if toolchains_dir.is_dir():
+        for toolchain in sorted(toolchains_dir.iterdir()):
+            paths.append(toolchain / "lib" / "rustlib" / "components")
+
+    fingerprint: List[List[Any]] = []
+    for path in paths:
+        try:
+            st = path.stat()
+            fingerprint.append([str(path), st.st_mtime_ns, st.st_size])
+        except FileNotFoundError:
+            fingerprint.append([str(path), None, None])
+    return fingerprint
+
+
+def _query(command: List[str], env: Mapping[str, str]) -> str:
+    return tracing.check_output(command, env).decode("utf-8")
+
+
+def _query_state(env: Mapping[str, str]) -> Dict[str, Any]:
+    default_toolchain = None
+    toolchains: Dict[str, List[str]] = {}
+
+    # Lines look like "1.89.0-x86_64-unknown-linux-gnu (active, default)"
+    for line in _query(["rustup", "toolchain", "list"], env).splitlines():
+        parts = line.split(maxsplit=1)
+        if not parts or line.startswith("no installed toolchains"):
+            continue
+        name = parts[0]
+        if len(parts) > 1 and "default" in parts[1]:
+            default_toolchain = name
+        toolchains[name] = _query(
+            ["rustup", "component", "list", "--installed", "--toolchain", name], env
+        ).split()
+
+    return {"default_toolchain": default_toolchain, "toolchains": toolchains}
+
+
+def load_state(cache_file: Path, env: Optional[Mapping[str, str]] = None) -> Dict:
+    """Returns installed toolchains and their components.
+
+    rustup is only queried when the fingerprint of the rustup home differs from
+    the one stored in `cache_file`.
+    """
+    env = os.environ if env is None else env
+    fingerprint = _fingerprint(rustup_home(env))
+    try:
+        with open(cache_file, "r") as f:
+            state = json.load(f)
+        if (
+            state.get("version") == STATE_VERSION
+            and state.get("fingerprint") == fingerprint
+        ):
+            return state
+    except (FileNotFoundError, ValueError):
+        pass
+
+    state = dict(_query_state(env), version=STATE_VERSION, fingerprint=fingerprint)
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    with publish.atomic_write(cache_file) as f:
+        json.dump(state, f)
+    return state
+
+
+def invalidate(cache_file: Path) -> None:
+    try:
+        cache_file.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def find_toolchain(state: Dict, toolchain: str) -> Optional[str]:
+    """Maps a requested toolchain (eg. '1.89.0') to the installed full name
+    (eg. '1.89.0-x86_64-unknown-linux-gnu')."""
+    for name in state["toolchains"]:
+        if name == toolchain:
+            return name
+        # The rest of the name must be a host triple, so '1.89' doesn't match '1.89.0-...'
+        host = name[len(toolchain) + 1 :]
+        if name.startswith(f"{toolchain}-") and host.count("-") in (2, 3):
+            return name
+    return None
+
+
+def _has_component(installed: List[str], component: str) -> bool:
+    # Components are listed with the host triple, eg. "rustfmt-x86_64-unknown-linux-gnu"
+    return any(
+        name == component or name.startswith(f"{component}-") for name in installed
+    )
+
+
+def missing_commands(
+    state: Dict,
+    toolchain: str,
+    targets: Optional[List[str]] = None,
+    components: Optional[List[str]] = None,
+    make_default: bool = False,
+) -> List[List[str]]:
+    """Returns rustup commands installing whatever of the request is missing."""
+    targets = targets or []
+    components = components or []
+    commands: List[List[str]] = []
+    installed_name = find_toolchain(state, toolchain)
+    installed = state["toolchains"].get(installed_name, [])
+
+    if installed_name is None:
+        commands.append(["rustup", "toolchain", "install", toolchain])
+    if make_default and (
+        installed_name is None or state["default_toolchain"] != installed_name
+    ):
+        commands.append(["rustup", "default", toolchain])
+
+    missing_targets = [t for t in targets if f"rust-std-{t}" not in installed]
+    if missing_targets:
+        commands.append(
+            ["rustup", "target", "add", "--toolchain", toolchain] + missing_targets
+        )
+
+    missing_components = [c for c in components if not _has_component(installed, c)]
+    if missing_components:
+        commands.append(
+            ["rustup", "component", "add", "--toolchain", toolchain]
+            + missing_components
+        )
+
+    return commands
@@ -0,0 +1,138 @@
+import os
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+import rust_build_utils.elf as elf
+import rust_build_utils.publish as publish
+from rust_build_utils.publish import StrPath
+
+# When set, strip hooks store debug info in this directory instead of `dist/`
+SYMBOL_STORE_ENV_VAR = "RUST_BUILD_UTILS_SYMBOL_STORE"
+# Maximum size of the store in bytes, least recently used entries are evicted
+SYMBOL_STORE_MAX_SIZE_ENV_VAR = "RUST_BUILD_UTILS_SYMBOL_STORE_MAX_SIZE"
+# Compression of the debug sections, "zlib" (default) or "zstd"
+SYMBOL_STORE_COMPRESSION_ENV_VAR = "RUST_BUILD_UTILS_SYMBOL_STORE_COMPRESSION"
+
+COMPRESSIONS = ("zlib", "zstd")
+
+
+@dataclass(frozen=True)
+class SymbolStore:
+    """Debug info files indexed by GNU build-id.
+
+    Uses the `.build-id/ab/cdef....debug` layout of gdb's and lldb's debug file
+    directories, so the store root can be passed to them directly. A binary that
+    was built before (same build-id) is stored only once.
+    """
+
+    root: Path
+    max_size: Optional[int] = None
+    compression: str = "zlib"
+
+    def path_for(self, build_id: str) -> Path:
+        build_id = build_id.lower()
+        if len(build_id) < 3 or any(c not in "0123456789abcdef" for c in build_id):
+            raise ValueError(f"invalid build-id '{build_id}'")
+        return self.root / ".build-id" / build_id[:2] / f"{build_id[2:]}.debug"
+
+    def lookup(self, build_id: str) -> Optional[Path]:
+        """Path of the debug info of `build_id`, None when it's not stored."""
+        path = self.path_for(build_id)
+        try:
+            # Lookups count as uses for the eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def deposit(
+        self, binary: StrPath, extract: Callable[[Path, str], None]
+    ) -> Optional[Path]:
+        """Stores the debug info of `binary`, written by `extract(output,
+        compression)`, unless it's already stored.
+
+        Returns the path in the store, or None when `binary` has no build-id (eg.
+        a static library), in which case nothing is stored.
+        """
+        try:
+            build_id = elf.read_build_id(binary)
+        except elf.ElfError:
+            return None
+        if build_id is None:
+            return None
+
+        path = self.lookup(build_id)
+        if path is not None:
+            print(f"Debug info of {binary} is already stored in {path}")
+            return path
+
+        path = self.path_for(build_id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with publish.atomic_path(path) as tmp_path:
+            extract(tmp_path, self.compression)
+            os.chmod(tmp_path, 0o444)
+        print(f"Stored debug info of {binary} in {path}")
+        self.evict(keep=path)
+        return path
+
+    def _entries(self) -> List[Tuple[float, int, Path]]:
+        entries = []
+        for root, _, files in os.walk(self.root / ".build-id"):
+            for file in files:
+                if not file.endswith(".debug"):
+                    continue
+                path = Path(root) / file
+                try:
+                    st = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self, keep: Optional[Path] = None) -> None:
+        """Removes the least recently used entries until the store fits in
+        `max_size`."""
+        if self.max_size is None:
+            return
+        entries = sorted(self._entries())
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                print(f"Evicted {path} from symbol store")
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+
+def from_env() -> Optional[SymbolStore]:
+    """The symbol store configured with `RUST_BUILD_UTILS_SYMBOL_STORE*`, if any."""
+    root = os.environ.get(SYMBOL_STORE_ENV_VAR)
+    if not root:
+        return None
+    max_size = os.environ.get(SYMBOL_STORE_MAX_SIZE_ENV_VAR)
+    compression = os.environ.get(SYMBOL_STORE_COMPRESSION_ENV_VAR) or "zlib"
+    if compression not in COMPRESSIONS:
+        raise ValueError(
+            f"{SYMBOL_STORE_COMPRESSION_ENV_VAR} must be one of {COMPRESSIONS}"
+        )
+    return SymbolStore(
+        Path(root), int(max_size) if max_size else None, compression=compression
+    )
+
+
+if __name__ == "__main__":
+    # Usage: python -m rust_build_utils.symbol_store <build-id>
+    store = from_env()
+    if store is None or len(sys.argv) != 2:
+        sys.exit(f"usage: {SYMBOL_STORE_ENV_VAR}=<dir> {sys.argv[0]} <build-id>")
+    found = store.lookup(sys.argv[1])
+    if found is None:
+        sys.exit(f"no debug info for build-id {sys.argv[1]}")
+    print(found)
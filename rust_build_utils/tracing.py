@@ -0,0 +1,331 @@
+import atexit
+import contextlib
+import contextvars
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+# When set, tracing is enabled and the trace is written to the given path
+TRACE_ENV_VAR = "RUST_BUILD_UTILS_TRACE"
+
+_phase: contextvars.ContextVar[str] = contextvars.ContextVar("phase", default="main")
+_events: List[Dict[str, Any]] = []
+_events_lock = threading.Lock()
+_trace_path: Optional[str] = None
+
+
+def enable(path: str) -> None:
+    """Records every command spawned by the library, writes a Chrome trace-event
+    file (chrome://tracing, ui.perfetto.dev) to `path` and prints a summary
+    table when the process exits."""
+    global _trace_path
+    if _trace_path is None:
+        atexit.register(_finish)
+    _trace_path = os.path.abspath(path)
+    # Child processes (eg. `build-matrix` targets) inherit tracing
+    os.environ[TRACE_ENV_VAR] = _trace_path
+
+
+def enable_from_env() -> None:
+    if os.environ.get(TRACE_ENV_VAR):
+        enable(os.environ[TRACE_ENV_VAR])
+
+
+def is_enabled() -> bool:
+    return _trace_path is not None
+
+
+@contextlib.contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Attributes commands spawned inside the block to build phase `name`."""
+    token = _phase.set(name)
+    try:
+        yield
+    finally:
+        _phase.reset(token)
+
+
+def current_phase() -> str:
+    return _phase.get()
+
+
+def record(
+    name: str, start: float, duration: float, args: Optional[Dict[str, Any]] = None
+) -> None:
+    """Records a complete event. `start` is a `time.time()` timestamp."""
+    if _trace_path is None:
+        return
+    event = {
+        "name": name,
+        "cat": _phase.get(),
+        "ph": "X",
+        "ts": int(start * 1e6),
+        "dur": int(duration * 1e6),
+        "pid": os.getpid(),
+        "tid": threading.get_ident(),
+        "args": args or {},
+    }
+    with _events_lock:
+        _events.append(event)
+
+
+@contextlib.contextmanager
+def span(name: str) -> Iterator[None]:
+    """Records the duration of an in-process step."""
+    start = time.time()
+    start_monotonic = time.monotonic()
+    try:
+        yield
+    finally:
+        record(name, start, time.monotonic() - start_monotonic)
+
+
+def _wait(proc: subprocess.Popen) -> Optional[Any]:
+    """Waits for `proc` and returns its resource usage where supported."""
+    if not hasattr(os, "wait4"):
+        proc.wait()
+        return None
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return rusage
+
+
+def _record_command(
+    command: Sequence[str],
+    start: float,
+    duration: float,
+    returncode: int,
+    rusage: Optional[Any],
+    name: Optional[str] = None,
+) -> None:
+    args: Dict[str, Any] = {"command": " ".join(map(str, command)), "exit": returncode}
+    if rusage is not None:
+        # ru_maxrss is in kilobytes on linux and in bytes on macOS
+        max_rss = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        args.update(
+            user=round(rusage.ru_utime, 3),
+            sys=round(rusage.ru_stime, 3),
+            max_rss=max_rss,
+        )
+    record(name or os.path.basename(str(command[0])), start, duration, args)
+
+
+def run(
+    command: Sequence[str],
+    env: Optional[Mapping[str, str]] = None,
+    capture: bool = False,
+    check: bool = True,
+    shell: bool = False,
+    stderr: Optional[int] = None,
+) -> Tuple[int, Optional[bytes]]:
+    """Runs a command and records its wall time, CPU time, max RSS and exit status.
+
+    Returns the exit code and the captured stdout when `capture` is set. Raises
+    `subprocess.CalledProcessError` on failure when `check` is set. `stderr` is
+    passed on to `subprocess.Popen`, eg. `subprocess.DEVNULL` to silence it.
+    """
+    start = time.time()
+    start_monotonic = time.monotonic()
+    proc = subprocess.Popen(
+        command,
+        env=None if env is None else dict(env),
+        stdout=subprocess.PIPE if capture else None,
+        stderr=stderr,
+        shell=shell,
+    )
+    try:
+        output = proc.stdout.read() if proc.stdout else None
+        rusage = _wait(proc)
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    finally:
+        if proc.stdout:
+            proc.stdout.close()
+
+    _record_command(
+        command, start, time.monotonic() - start_monotonic, proc.returncode, rusage
+    )
+    if check and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, command, output)
+    return proc.returncode, output
+
+
+def stream(
+    command: Sequence[str], env: Optional[Mapping[str, str]] = None
+) -> Iterator[str]:
+    """Runs a command and yields its stdout line by line while it is running.
+
+    The command is killed when the caller stops consuming the output early.
+    Raises `subprocess.CalledProcessError` when it fails.
+    """
+    start = time.time()
+    start_monotonic = time.monotonic()
+    proc = subprocess.Popen(
+        command, env=None if env is None else dict(env), stdout=subprocess.PIPE
+    )
+    assert proc.stdout
+    try:
+        for line in proc.stdout:
+            yield line.decode("utf-8", errors="replace")
+        rusage = _wait(proc)
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    finally:
+        proc.stdout.close()
+
+    _record_command(
+        command, start, time.monotonic() - start_monotonic, proc.returncode, rusage
+    )
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, command)
+
+
+class Process:
+    """A command started with `spawn`, recorded once it is reaped by `poll` or
+    `wait`, in the phase it was started in."""
+
+    def __init__(
+        self,
+        command: Sequence[str],
+        proc: subprocess.Popen,
+        name: Optional[str],
+    ) -> None:
+        self.command = command
+        self.name = name
+        self._proc = proc
+        self._phase = _phase.get()
+        self._start = time.time()
+        self._start_monotonic = time.monotonic()
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self._proc.returncode
+
+    def poll(self) -> Optional[int]:
+        """Returns the exit code, or None while the command is still running."""
+        if self._proc.returncode is not None:
+            return self._proc.returncode
+        if not hasattr(os, "wait4"):
+            if self._proc.poll() is None:
+                return None
+            self._finish(None)
+            return self._proc.returncode
+        pid, status, rusage = os.wait4(self._proc.pid, os.WNOHANG)
+        if pid == 0:
+            return None
+        self._proc.returncode = os.waitstatus_to_exitcode(status)
+        self._finish(rusage)
+        return self._proc.returncode
+
+    def wait(self) -> int:
+        if self._proc.returncode is None:
+            self._finish(_wait(self._proc))
+        assert self._proc.returncode is not None
+        return self._proc.returncode
+
+    def terminate(self) -> None:
+        self._proc.terminate()
+
+    def _finish(self, rusage: Optional[Any]) -> None:
+        with phase(self._phase):
+            _record_command(
+                self.command,
+                self._start,
+                time.monotonic() - self._start_monotonic,
+                self._proc.returncode,
+                rusage,
+                self.name,
+            )
+
+
+def spawn(
+    command: Sequence[str],
+    env: Optional[Mapping[str, str]] = None,
+    stdout: Optional[Any] = None,
+    stderr: Optional[Any] = None,
+    name: Optional[str] = None,
+) -> Process:
+    """Starts a command without waiting for it, see `Process`. `name` replaces
+    the executable name in the trace."""
+    proc = subprocess.Popen(
+        command,
+        env=None if env is None else dict(env),
+        stdout=stdout,
+        stderr=stderr,
+    )
+    return Process(command, proc, name)
+
+
+def check_call(command: Sequence[str], env: Optional[Mapping[str, str]] = None):
+    run(command, env)
+
+
+def check_output(
+    command: Sequence[str], env: Optional[Mapping[str, str]] = None
+) -> bytes:
+    _, output = run(command, env, capture=True)
+    assert output is not None
+    return output
+
+
+def merge(path: str) -> None:
+    """Adds the events of a trace written by another process (eg. a child)."""
+    try:
+        with open(path, "r") as f:
+            events = json.load(f).get("traceEvents", [])
+    except (FileNotFoundError, ValueError):
+        return
+    with _events_lock:
+        _events.extend(events)
+
+
+def write(path: str) -> None:
+    with _events_lock:
+        events = sorted(_events, key=lambda e: e["ts"])
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def summary() -> str:
+    """Table of commands grouped by phase and tool, slowest first."""
+    rows: Dict[Tuple[str, str], Dict[str, float]] = {}
+    with _events_lock:
+        for event in _events:
+            if "command" not in event["args"]:
+                continue
+            row = rows.setdefault(
+                (event["cat"], event["name"]),
+                {"count": 0, "wall": 0.0, "cpu": 0.0, "max_rss": 0, "failed": 0},
+            )
+            args = event["args"]
+            row["count"] += 1
+            row["wall"] += event["dur"] / 1e6
+            row["cpu"] += args.get("user", 0.0) + args.get("sys", 0.0)
+            row["max_rss"] = max(row["max_rss"], args.get("max_rss", 0))
+            row["failed"] += args["exit"] != 0
+
+    lines = [
+        f"{'phase':<16} {'command':<24} {'count':>5} {'wall':>10} {'cpu':>10} {'max rss':>10} {'failed':>6}"
+    ]
+    for (phase_name, name), row in sorted(rows.items(), key=lambda r: -r[1]["wall"]):
+        lines.append(
+            f"{phase_name:<16} {name:<24} {row['count']:>5} {row['wall']:>9.2f}s "
+            f"{row['cpu']:>9.2f}s {row['max_rss'] / 2**20:>8.0f}MB {row['failed']:>6.0f}"
+        )
+    return "\n".join(lines)
+
+
+def _finish() -> None:
+    if _trace_path is None:
+        return
+    write(_trace_path)
+    print(f"|TRACE| written to {_trace_path}")
+    print(summary())
@@ -39,23 +39,21 @@ def post_function_win(config, args):
             for _, bin in bins.items():
                 dll_bin = os.path.splitext(bin)[0] + ".dll"
                 dll_bin_path = PROJECT_CONFIG.get_cargo_path(
-                    config.rust_target, dll_bin, config.debug
+                    config.rust_target, dll_bin, config.debug, config.env
                 )
                 if os.path.isfile(dll_bin_path):
+                    rustflags = (config.env or {}).get("RUSTFLAGS", "")
                     should_link_statically = (
                         WINDOWS_RUNTIME_LINKING[WindowsLinkingMethod.STATIC]
-                        in GLOBAL_CONFIG["windows"]["env"]["RUSTFLAGS"]
+                        in rustflags
                     )
-                    msvc_context = None
-                    if not msvc.is_msvc_active():
-                        msvc_context = msvc.activate_msvc(
-                            "amd64" if config.arch == "x86_64" else config.arch
+                    with msvc.msvc_environment(
+                        "amd64" if config.arch == "x86_64" else config.arch,
+                        base_env=config.env,
+                    ) as env:
+                        res = msvc.check_for_static_runtime(
+                            Path(dll_bin_path), should_link_statically, env
                         )
-                    res = msvc.check_for_static_runtime(
-                        Path(dll_bin_path), should_link_statically
-                    )
-                    if msvc_context is not None:
-                        msvc.deactivate_msvc(msvc_context)
                     if not res:
                         print("Incorrect windows runtime linking")
                         exit(1)
@@ -213,6 +211,8 @@ def main() -> None:
     args = rutils.parse_cli()
     if args.command == "build":
         exec_build(args)
+    elif args.command == "build-matrix":
+        exec_build_matrix(args)
     elif args.command == "bindings":
         rutils.generate_uniffi_bindings(
             PROJECT_CONFIG, "v0.28.3-4", ["python"], "src/sample.udl"
@@ -257,22 +257,40 @@ def exec_build(args):
         args.os,
         args.arch,
         args.debug,
+        timings=args.timings,
     )
     rutils.check_config(config)
     call_build(config)
 
 
+def exec_build_matrix(args):
+    configs = rutils.parse_matrix_targets(args.targets, args.debug, args.timings)
+    result = rutils.build_matrix(
+        PROJECT_CONFIG,
+        configs,
+        jobs=args.jobs,
+        parallel=args.parallel,
+        isolate_target_dirs=not args.shared_target_dir,
+    )
+    if not result.succeeded():
+        exit(1)
+
+
 def darwin_build_all(debug: bool) -> None:
-    for target_os in rutils.LIPO_TARGET_OSES:
-        for arch in GLOBAL_CONFIG[target_os]["archs"].keys():
-            if target_os in SAMPLE_CONFIG:
-                config = rutils.CargoConfig(
-                    target_os,
-                    arch,
-                    debug,
-                )
+    configs = [
+        rutils.CargoConfig(
+            target_os,
+            arch,
+            debug,
+        )
+        for target_os in rutils.LIPO_TARGET_OSES
+        if target_os in SAMPLE_CONFIG
+        for arch in GLOBAL_CONFIG[target_os]["archs"].keys()
+    ]
 
-                call_build(config)
+    result = rutils.build_matrix(PROJECT_CONFIG, configs)
+    if not result.succeeded():
+        exit(1)
 
 
 def exec_lipo(args):
@@ -289,7 +307,7 @@ def exec_lipo(args):
 
 
 def call_build(config):
-    rutils.config_local_env_vars(config, SAMPLE_CONFIG)
+    config.env = rutils.resolve_env(config, SAMPLE_CONFIG)
 
     if "pre_build" in SAMPLE_CONFIG[config.target_os]:
         for pre in SAMPLE_CONFIG[config.target_os]["pre_build"]:
@@ -0,0 +1,304 @@
+import os
+import tempfile
+import unittest
+import zipfile
+from pathlib import Path
+from typing import Dict, List
+from unittest import mock
+
+import rust_build_utils.aar as aar
+import rust_build_utils.android_build_utils as abu
+import rust_build_utils.rust_utils as rutils
+
+BASE_ENTRIES = {
+    "AndroidManifest.xml": b"<manifest/>",
+    "classes.jar": b"PK" + b"\0" * 64,
+    "R.txt": b"",
+    # Replaced by the native libraries passed to write_aar
+    "jni/arm64-v8a/libstale.so": b"stale",
+}
+
+
+def _write_zip(
+    path: Path,
+    entries: Dict[str, bytes],
+    compression: int = zipfile.ZIP_DEFLATED,
+) -> None:
+    with zipfile.ZipFile(path, "w", compression) as f:
+        for name, content in entries.items():
+            f.writestr(name, content)
+
+
+def _read_zip(path: Path) -> Dict[str, bytes]:
+    with zipfile.ZipFile(path) as f:
+        assert f.testzip() is None
+        return {info.filename: f.read(info) for info in f.infolist()}
+
+
+class AarTestCase(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = Path(tmp.name)
+
+    def write_libs(self, libs: Dict[str, bytes]) -> Path:
+        lib_dir = self.root / "jniLibs"
+        for name, content in libs.items():
+            path = lib_dir / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(content)
+        return lib_dir
+
+
+class ZipWriterTest(AarTestCase):
+    def test_round_trip(self):
+        source = self.root / "source.zip"
+        _write_zip(source, {"stored": b"abc" * 100, "empty": b""}, zipfile.ZIP_STORED)
+        _write_zip(self.root / "deflated.zip", {"deflated": b"xyz" * 100})
+        big = self.root / "big"
+        big.write_bytes(os.urandom(3 << 20) + b"\0" * (1 << 20))
+        empty = self.root / "empty"
+        empty.write_bytes(b"")
+
+        output = self.root / "output.zip"
+        with open(output, "wb") as f:
+            writer = aar.ZipWriter(f)
+            for path in (source, self.root / "deflated.zip"):
+                with zipfile.ZipFile(path) as z:
+                    for info in z.infolist():
+                        writer.copy_entry(z, info)
+            writer.write_file("jni/x86_64/libbig.so", big)
+            writer.write_file("jni/x86_64/libempty.so", empty)
+            writer.write_file("ünicode.txt", empty)
+            writer.close()
+
+        self.assertEqual(
+            _read_zip(output),
+            {
+                "stored": b"abc" * 100,
+                "empty": b"",
+                "deflated": b"xyz" * 100,
+                "jni/x86_64/libbig.so": big.read_bytes(),
+                "jni/x86_64/libempty.so": b"",
+                "ünicode.txt": b"",
+            },
+        )
+        with zipfile.ZipFile(output) as z:
+            self.assertEqual(z.getinfo("stored").compress_type, zipfile.ZIP_STORED)
+            info = z.getinfo("jni/x86_64/libbig.so")
+            self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(info.date_time, aar.ZIP_DATE_TIME)
+
+    def test_encrypted_entry(self):
+        source = self.root / "source.zip"
+        _write_zip(source, {"secret": b"x"})
+        with zipfile.ZipFile(source) as z:
+            info = z.getinfo("secret")
+            info.flag_bits |= 0x1
+            with open(self.root / "output.zip", "wb") as f:
+                with self.assertRaises(aar.AarError):
+                    aar.ZipWriter(f).copy_entry(z, info)
+
+
+class WriteAarTest(AarTestCase):
+    def setUp(self):
+        super().setUp()
+        self.base = self.root / "base.aar"
+        _write_zip(self.base, BASE_ENTRIES)
+        self.output = self.root / "output.aar"
+
+    def test_jni_entries(self):
+        lib_dir = self.write_libs(
+            {
+                "x86_64/libfoo.so": b"x86_64",
+                "arm64-v8a/libfoo.so": b"arm64",
+                "arm64-v8a/libfoo.a": b"static",
+                "arm64-v8a/libfoo.so.debug": b"debug",
+            }
+        )
+        self.assertEqual(
+            list(aar.jni_entries(lib_dir).items()),
+            [
+                ("jni/arm64-v8a/libfoo.so", str(lib_dir / "arm64-v8a" / "libfoo.so")),
+                ("jni/x86_64/libfoo.so", str(lib_dir / "x86_64" / "libfoo.so")),
+            ],
+        )
+
+    def test_write(self):
+        lib_dir = self.write_libs({"x86_64/libfoo.so": b"x86_64"})
+        self.assertEqual(
+            aar.write_aar(self.output, self.base, aar.jni_entries(lib_dir)), (0, 1)
+        )
+        expected = {
+            name: content
+            for name, content in BASE_ENTRIES.items()
+            if not name.startswith("jni/")
+        }
+        expected["jni/x86_64/libfoo.so"] = b"x86_64"
+        self.assertEqual(_read_zip(self.output), expected)
+
+    def test_reuse_unchanged(self):
+        lib_dir = self.write_libs(
+            {"x86_64/libfoo.so": b"x86_64", "arm64-v8a/libfoo.so": b"arm64"}
+        )
+        previous = self.root / "previous.aar"
+        # Stored instead of deflated, so copied entries can be told apart
+        _write_zip(
+            previous,
+            {"jni/x86_64/libfoo.so": b"x86_64", "jni/arm64-v8a/libfoo.so": b"old"},
+            zipfile.ZIP_STORED,
+        )
+        (lib_dir / "arm64-v8a" / "libfoo.so").write_bytes(b"new")
+
+        copied, compressed = aar.write_aar(
+            self.output,
+            self.base,
+            aar.jni_entries(lib_dir),
+            previous,
+            unchanged={"jni/x86_64/libfoo.so"},
+        )
+        self.assertEqual((copied, compressed), (1, 1))
+        contents = _read_zip(self.output)
+        self.assertEqual(contents["jni/x86_64/libfoo.so"], b"x86_64")
+        self.assertEqual(contents["jni/arm64-v8a/libfoo.so"], b"new")
+        with zipfile.ZipFile(self.output) as z:
+            self.assertEqual(
+                z.getinfo("jni/x86_64/libfoo.so").compress_type, zipfile.ZIP_STORED
+            )
+            self.assertEqual(
+                z.getinfo("jni/arm64-v8a/libfoo.so").compress_type,
+                zipfile.ZIP_DEFLATED,
+            )
+
+    def test_replace_and_remove(self):
+        lib_dir = self.write_libs(
+            {"x86_64/libfoo.so": b"x86_64", "arm64-v8a/libfoo.so": b"arm64"}
+        )
+        aar.write_aar(self.output, self.base, aar.jni_entries(lib_dir))
+
+        (lib_dir / "x86_64" / "libfoo.so").unlink()
+        (lib_dir / "arm64-v8a" / "libfoo.so").write_bytes(b"arm64 v2")
+        (lib_dir / "arm64-v8a" / "libbar.so").write_bytes(b"bar")
+        aar.write_aar(
+            self.output,
+            self.base,
+            aar.jni_entries(lib_dir),
+            previous=self.output,
+            unchanged={"jni/x86_64/libfoo.so"},
+        )
+        jni = {
+            name: content
+            for name, content in _read_zip(self.output).items()
+            if name.startswith("jni/")
+        }
+        self.assertEqual(
+            jni,
+            {"jni/arm64-v8a/libbar.so": b"bar", "jni/arm64-v8a/libfoo.so": b"arm64 v2"},
+        )
+
+    def test_failure_keeps_output(self):
+        lib_dir = self.write_libs({"x86_64/libfoo.so": b"x86_64"})
+        aar.write_aar(self.output, self.base, aar.jni_entries(lib_dir))
+        before = self.output.read_bytes()
+
+        with self.assertRaises(FileNotFoundError):
+            aar.write_aar(
+                self.output, self.base, {"jni/x86_64/libgone.so": lib_dir / "gone"}
+            )
+        self.assertEqual(self.output.read_bytes(), before)
+        self.assertEqual(
+            sorted(os.listdir(self.root)), sorted(["base.aar", "jniLibs", "output.aar"])
+        )
+
+
+class GenerateAarIncrementallyTest(AarTestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(os.chdir, os.getcwd())
+        self.project = rutils.Project(
+            rust_version="1.89.0", root_dir=str(self.root), working_dir=None
+        )
+        self.bindings = self.root / "bindings" / "kotlin"
+        self.bindings.mkdir(parents=True)
+        (self.bindings / "sample.kt").write_text("package sample\n")
+        self.lib_dir = self.write_libs(
+            {"x86_64/libfoo.so": b"x86_64", "arm64-v8a/libfoo.so": b"arm64"}
+        )
+        self.aar_path = self.root / "dist" / "sample.aar"
+        self.aar_path.parent.mkdir()
+        self.gradle_builds: List[str] = []
+
+        def gradle_build(main_dir: str, gradle=None) -> str:
+            self.gradle_builds.append(main_dir)
+            output = self.root / "gradle-output.aar"
+            _write_zip(output, BASE_ENTRIES)
+            return str(output)
+
+        for name, replacement in (
+            ("_prepare_gradle_project", lambda *args: str(self.root / "android")),
+            ("_gradle_build", gradle_build),
+        ):
+            patcher = mock.patch.object(abu, name, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def generate(self) -> None:
+        abu._generate_aar_incrementally(
+            self.project,
+            str(self.aar_path),
+            "com.nordsec.sample",
+            "sample",
+            "1.0.0",
+            str(self.bindings),
+            str(self.lib_dir),
+            None,
+            None,
+            None,
+        )
+
+    def base_aar(self) -> Path:
+        return self.project.get_build_dir() / "aar" / "sample.aar.base"
+
+    def test_gradle_only_when_bindings_change(self):
+        self.generate()
+        self.generate()
+        self.assertEqual(len(self.gradle_builds), 1)
+
+        (self.bindings / "sample.kt").write_text("package sample.v2\n")
+        self.generate()
+        self.assertEqual(len(self.gradle_builds), 2)
+        self.assertEqual(_read_zip(self.aar_path)["jni/arm64-v8a/libfoo.so"], b"arm64")
+
+    def test_missing_base(self):
+        self.generate()
+        self.base_aar().unlink()
+        self.generate()
+        self.assertEqual(len(self.gradle_builds), 2)
+        self.assertIn("classes.jar", _read_zip(self.aar_path))
+
+    def test_corrupt_base(self):
+        self.generate()
+        self.base_aar().write_bytes(b"not a zip")
+        self.generate()
+        self.assertEqual(len(self.gradle_builds), 2)
+        self.assertIn("classes.jar", _read_zip(self.aar_path))
+
+    def test_corrupt_previous(self):
+        self.generate()
+        # Damaged in place, with the size and mtime recorded by the last run
+        st = self.aar_path.stat()
+        content = bytearray(self.aar_path.read_bytes())
+        offset = content.index(b"jni/x86_64/libfoo.so") - 30
+        content[offset : offset + 4] = b"XXXX"
+        self.aar_path.write_bytes(bytes(content))
+        os.utime(self.aar_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+        self.generate()
+        self.assertEqual(len(self.gradle_builds), 1)
+        contents = _read_zip(self.aar_path)
+        self.assertEqual(contents["jni/x86_64/libfoo.so"], b"x86_64")
+        self.assertEqual(contents["jni/arm64-v8a/libfoo.so"], b"arm64")
+
+
+if __name__ == "__main__":
+    unittest.main()
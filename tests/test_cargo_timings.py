@@ -0,0 +1,137 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from typing import Any, Dict, Optional, Sequence
+
+import rust_build_utils.cargo_timings as cargo_timings
+
+
+def _unit(
+    i: int,
+    name: str,
+    start: float,
+    duration: float,
+    rmeta_time: Optional[float] = None,
+    target: str = "",
+    mode: str = "build",
+    unlocked_units: Sequence[int] = (),
+    unlocked_rmeta_units: Sequence[int] = (),
+) -> Dict[str, Any]:
+    return {
+        "i": i,
+        "name": name,
+        "version": "1.0.0",
+        "mode": mode,
+        "target": target,
+        "start": start,
+        "duration": duration,
+        "rmeta_time": rmeta_time,
+        "unlocked_units": list(unlocked_units),
+        "unlocked_rmeta_units": list(unlocked_rmeta_units),
+    }
+
+
+# ring's build script is compiled and run before the library, app's library
+# starts once the metadata of ring and serde is ready and its binary once
+# both libraries are linked.
+UNITS = [
+    _unit(0, "ring", 0.0, 2.0, target=" build script", unlocked_units=[1]),
+    _unit(1, "ring", 2.0, 3.0, mode="run-custom-build", unlocked_units=[2]),
+    _unit(
+        2,
+        "ring",
+        5.0,
+        6.0,
+        rmeta_time=2.0,
+        unlocked_units=[5],
+        unlocked_rmeta_units=[4],
+    ),
+    _unit(3, "serde", 0.0, 4.0, rmeta_time=1.0, unlocked_rmeta_units=[4]),
+    _unit(4, "app", 7.0, 5.0, rmeta_time=3.0, unlocked_units=[5]),
+    _unit(5, "app", 12.0, 2.0, target=' bin "app"'),
+]
+
+
+class CriticalPathTest(unittest.TestCase):
+    def test_critical_path(self):
+        self.assertEqual(
+            [unit["i"] for unit in cargo_timings.critical_path(UNITS)],
+            [0, 1, 2, 4, 5],
+        )
+
+    def test_unlocked_last(self):
+        # serde's metadata is now ready after ring's, so it unlocks app
+        units = [dict(unit) for unit in UNITS]
+        units[3].update(duration=10.0, rmeta_time=8.0)
+        self.assertEqual(
+            [unit["i"] for unit in cargo_timings.critical_path(units)], [3, 4, 5]
+        )
+
+    def test_empty(self):
+        self.assertEqual(cargo_timings.critical_path([]), [])
+
+    def test_report(self):
+        report = cargo_timings.build_report(UNITS, fresh_units=3)
+        self.assertEqual(
+            [unit["unit"] for unit in report["critical_path"]],
+            [
+                "ring v1.0.0 (build script)",
+                "ring v1.0.0",
+                "ring v1.0.0",
+                "app v1.0.0",
+                'app v1.0.0 (bin "app")',
+            ],
+        )
+        # Pipelined units overlap, so less than the sum of their durations
+        self.assertEqual(report["critical_path_duration"], 14.0)
+        self.assertEqual(report["total"], 14.0)
+        self.assertEqual(report["cpu"], 22.0)
+        self.assertEqual(report["frontend"], 6.0)
+        self.assertEqual(report["codegen_and_link"], 9.0)
+        self.assertEqual(report["unsplit"], 7.0)
+        self.assertEqual(
+            report["slowest_crates"][0], {"crate": "ring v1.0.0", "duration": 11.0}
+        )
+        self.assertEqual(
+            [unit["unit"] for unit in report["build_scripts"]],
+            ["ring v1.0.0", "ring v1.0.0 (build script)"],
+        )
+        self.assertIn("critical path (14.00s):", cargo_timings.format_report(report))
+
+
+class WriteReportTest(unittest.TestCase):
+    def test_write_report(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            html_path = cargo_timings.timings_html_path(str(root / "target"))
+            report_path = root / "timings" / "linux-x86_64.json"
+            self.assertIsNone(cargo_timings.write_report(html_path, report_path))
+
+            html_path.parent.mkdir(parents=True)
+            html_path.write_text(
+                "<script>\nconst UNIT_DATA = "
+                + json.dumps(UNITS)
+                + ";\nconst CONCURRENCY_DATA = [];\n</script>\n"
+            )
+            report = cargo_timings.write_report(html_path, report_path)
+            self.assertEqual(json.loads(report_path.read_text()), report)
+            self.assertTrue(report_path.with_suffix(".txt").exists())
+            self.assertEqual(
+                sorted(p.name for p in report_path.parent.iterdir()),
+                [
+                    "linux-x86_64.json",
+                    "linux-x86_64.txt",
+                ],
+            )
+
+    def test_no_unit_data(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            html_path = Path(tmp) / "cargo-timing.html"
+            html_path.write_text("<html></html>")
+            with self.assertRaises(ValueError):
+                cargo_timings.load_units(html_path)
+
+
+if __name__ == "__main__":
+    unittest.main()
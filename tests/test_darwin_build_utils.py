@@ -0,0 +1,412 @@
+import itertools
+import json
+import os
+import struct
+import tempfile
+import unittest
+from pathlib import Path
+from typing import Any, Dict, Iterator, List
+from unittest import mock
+
+import rust_build_utils.darwin_build_utils as dbu
+import rust_build_utils.fingerprint as fingerprint
+import rust_build_utils.macho as macho
+import rust_build_utils.rust_utils as rutils
+
+
+def _lines(output: str) -> List[str]:
+    return output.splitlines(keepends=True)
+
+
+def _macho(cputype: int, command: bytes) -> bytes:
+    """A 64 bit Mach-O object with a single load command."""
+    header = struct.pack("<8I", macho.MH_MAGIC_64, cputype, 0, 1, 1, len(command), 0, 0)
+    return header + command
+
+
+# The binaries described by BUILD_VERSION and VERSION_MIN below
+ARM64 = _macho(
+    macho.CPU_TYPE_ARM64,
+    struct.pack("<6I", macho.LC_BUILD_VERSION, 24, 2, 11 << 16, 17 << 16 | 2 << 8, 0),
+)
+X86_64 = _macho(
+    macho.CPU_TYPE_X86_64,
+    struct.pack(
+        "<4I",
+        macho.LC_VERSION_MIN_IPHONEOS,
+        16,
+        10 << 16 | 12 << 8 | 1,
+        17 << 16 | 2 << 8,
+    ),
+)
+
+
+SEGMENT = """\
+Load command 0
+      cmd LC_SEGMENT_64
+  cmdsize 232
+  segname
+   vmaddr 0x0000000000000000
+   vmsize 0x0000000000000010
+  fileoff 288
+ filesize 16
+  maxprot 0x00000007
+ initprot 0x00000007
+   nsects 1
+    flags 0x0
+Section
+  sectname __text
+   segname __TEXT
+"""
+
+BUILD_VERSION = """\
+Load command 1
+      cmd LC_BUILD_VERSION
+  cmdsize 32
+ platform 2
+    minos 11.0
+      sdk 17.2
+   ntools 1
+     tool 3
+  version 1053.12
+"""
+
+VERSION_MIN = """\
+Load command 1
+      cmd LC_VERSION_MIN_IPHONEOS
+  cmdsize 16
+  version 10.12.1
+      sdk 17.2
+"""
+
+
+class OtoolLoadCommandsTest(unittest.TestCase):
+    def test_build_version(self):
+        output = _lines("librust_sample.dylib:\n" + SEGMENT + BUILD_VERSION)
+        self.assertEqual(
+            list(dbu._otool_load_commands(output)),
+            [
+                {"cmd": "LC_SEGMENT_64"},
+                # The version of the first build tool is kept, but not compared
+                {
+                    "cmd": "LC_BUILD_VERSION",
+                    "minos": "11.0",
+                    "sdk": "17.2",
+                    "version": "1053.12",
+                },
+            ],
+        )
+        self.assertEqual(
+            dbu._load_command_versions(output, "LC_BUILD_VERSION", "minos"), ["11.0"]
+        )
+
+    def test_version_min(self):
+        output = _lines(SEGMENT + VERSION_MIN)
+        self.assertEqual(
+            dbu._load_command_versions(output, "LC_VERSION_MIN_IPHONEOS", "version"),
+            ["10.12"],
+        )
+        self.assertEqual(
+            dbu._load_command_versions(output, "LC_BUILD_VERSION", "minos"), []
+        )
+
+    def test_multiple_archs(self):
+        # `otool -l` of a universal static library, every member and slice
+        # starts with a header line
+        output = _lines(
+            "librust_sample.a(architecture arm64):\n"
+            "Archive : librust_sample.a (architecture arm64)\n"
+            "librust_sample.a(a.o) (architecture arm64):\n"
+            + SEGMENT
+            + BUILD_VERSION
+            + "librust_sample.a(b.o) (architecture arm64):\n"
+            + SEGMENT
+            + BUILD_VERSION.replace("11.0", "12.1")
+            + "librust_sample.a(architecture x86_64):\n"
+            "Archive : librust_sample.a (architecture x86_64)\n"
+            "librust_sample.a(a.o) (architecture x86_64):\n" + SEGMENT + VERSION_MIN
+        )
+        self.assertEqual(
+            dbu._load_command_versions(output, "LC_BUILD_VERSION", "minos"),
+            ["11.0", "12.1"],
+        )
+        self.assertEqual(
+            dbu._load_command_versions(output, "LC_VERSION_MIN_IPHONEOS", "version"),
+            ["10.12"],
+        )
+        # Archive headers are not attributed to the command before them
+        self.assertEqual(
+            [c["cmd"] for c in dbu._otool_load_commands(output)],
+            ["LC_SEGMENT_64", "LC_BUILD_VERSION"] * 2
+            + ["LC_SEGMENT_64", "LC_VERSION_MIN_IPHONEOS"],
+        )
+
+    def test_truncated(self):
+        output = _lines(SEGMENT + BUILD_VERSION)
+        cut = output.index("    minos 11.0\n")
+        self.assertEqual(
+            list(dbu._otool_load_commands(output[:cut]))[-1],
+            {"cmd": "LC_BUILD_VERSION"},
+        )
+        with self.assertRaises(AssertionError):
+            dbu._load_command_versions(output[:cut], "LC_BUILD_VERSION", "minos")
+
+        # Cut before the type of the command is known
+        cut = output.index("      cmd LC_BUILD_VERSION\n")
+        self.assertEqual(
+            dbu._load_command_versions(output[:cut], "LC_BUILD_VERSION", "minos"), []
+        )
+        self.assertEqual(list(dbu._otool_load_commands([])), [])
+
+    def test_streaming(self):
+        def endless() -> Iterator[str]:
+            yield from _lines(BUILD_VERSION)
+            for i in itertools.count(2):
+                yield f"Load command {i}\n"
+                yield "      cmd LC_SEGMENT_64\n"
+
+        commands = dbu._otool_load_commands(endless())
+        self.assertEqual(next(commands)["minos"], "11.0")
+        self.assertEqual(next(commands), {"cmd": "LC_SEGMENT_64"})
+
+
+class MachoVersionsTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = Path(tmp.name)
+
+    def test_same_as_otool(self):
+        cases = [
+            (ARM64, BUILD_VERSION, "LC_BUILD_VERSION", "minos"),
+            (X86_64, VERSION_MIN, "LC_VERSION_MIN_IPHONEOS", "version"),
+        ]
+        for content, otool_output, load_command, version_key in cases:
+            with self.subTest(load_command):
+                path = self.root / load_command
+                path.write_bytes(content)
+                self.assertEqual(
+                    dbu._macho_versions(str(path), load_command, version_key),
+                    dbu._load_command_versions(
+                        _lines(otool_output), load_command, version_key
+                    ),
+                )
+
+    def test_static_library(self):
+        path = self.root / "lib.a"
+        path.write_bytes(
+            macho.AR_MAGIC
+            + b"".join(
+                f"{name:<16}{0:<12}{0:<6}{0:<6}{644:<8}{len(ARM64):<10}`\n".encode()
+                + ARM64
+                for name in ("a.o", "b.o")
+            )
+        )
+        self.assertEqual(
+            dbu._macho_versions(str(path), "LC_BUILD_VERSION", "minos"),
+            ["11.0", "11.0"],
+        )
+        self.assertEqual(
+            dbu._macho_versions(str(path), "LC_VERSION_MIN_IPHONEOS", "version"), []
+        )
+
+
+def _function(name: str, **fields: Any) -> Dict[str, Any]:
+    return dict(
+        {
+            "id": "0x1",
+            "kind": "FunctionDecl",
+            "loc": {"offset": 10, "file": "sample.h", "line": 1, "col": 6},
+            "range": {"begin": {"offset": 5}, "end": {"offset": 20}},
+            "name": name,
+            "type": {"qualType": "void (void)"},
+        },
+        **fields,
+    )
+
+
+DECLARATIONS = [
+    {"id": "0x0", "kind": "TypedefDecl", "isImplicit": True, "name": "__int128_t"},
+    _function("sample_init"),
+    # Nested objects and arrays close at a deeper indentation
+    {
+        "id": "0x2",
+        "kind": "RecordDecl",
+        "name": "sample_config",
+        "inner": [
+            {"kind": "FieldDecl", "name": "callback", "inner": [{"inner": [{}]}]},
+            {"kind": "FieldDecl", "name": "flags", "type": {"qualType": "int"}},
+        ],
+    },
+    # Braces and line breaks inside of strings, eg. of documentation comments
+    _function(
+        "sample_free",
+        inner=[
+            {
+                "kind": "FullComment",
+                "inner": [{"kind": "TextComment", "text": " Frees {ptr}\n}\n  }"}],
+            }
+        ],
+        type={"qualType": "void (struct { int a; } *)"},
+    ),
+    _function("free", loc={"includedFrom": {"file": "sample.h"}}),
+]
+
+
+def _ast_dump(indent: Any = 2) -> List[str]:
+    unit = {
+        "id": "0x0",
+        "kind": "TranslationUnitDecl",
+        "loc": {},
+        "range": {"begin": {}, "end": {}},
+        "inner": DECLARATIONS,
+    }
+    return _lines(json.dumps(unit, indent=indent) + "\n")
+
+
+class TopLevelDeclarationsTest(unittest.TestCase):
+    def test_pretty_printed(self):
+        self.assertEqual(list(dbu._top_level_declarations(_ast_dump())), DECLARATIONS)
+
+    def test_compact(self):
+        for indent in (None, 0):
+            with self.subTest(indent=indent):
+                self.assertEqual(
+                    list(dbu._top_level_declarations(_ast_dump(indent))),
+                    DECLARATIONS,
+                )
+
+    def test_multi_line_chunks(self):
+        # Lines are split by the reader, not necessarily at line breaks
+        dump = "".join(_ast_dump())
+        chunks = [dump[i : i + 7] for i in range(0, len(dump), 7)]
+        self.assertEqual(list(dbu._top_level_declarations(chunks)), DECLARATIONS)
+
+    def test_streaming(self):
+        def dump() -> Iterator[str]:
+            lines = _ast_dump()
+            end = lines.index("    },\n") + 1
+            yield from lines[:end]
+            raise AssertionError("read past the first declaration")
+
+        declarations = dbu._top_level_declarations(dump())
+        self.assertEqual(next(declarations), DECLARATIONS[0])
+
+    def test_empty(self):
+        self.assertEqual(list(dbu._top_level_declarations([])), [])
+        unit = '{\n  "kind": "TranslationUnitDecl",\n  "inner": []\n}\n'
+        self.assertEqual(list(dbu._top_level_declarations(_lines(unit))), [])
+
+    def test_stub_function_names(self):
+        with mock.patch.object(
+            dbu.rutils, "run_command_streaming", return_value=iter(_ast_dump())
+        ):
+            self.assertEqual(
+                dbu._stub_function_names(Path("sample.h")),
+                ["sample_init", "sample_free"],
+            )
+
+
+class GenerateStubLibraryTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = Path(tmp.name)
+        self.header = self.root / "sample.h"
+        self.header.write_text("void sample_init(void);\n")
+        self.cache_dir = self.root / "cache"
+        self.clang_version = "clang version 17.0.0"
+        self.parsed: List[Path] = []
+
+        def function_names(header_path: Path) -> List[str]:
+            self.parsed.append(header_path)
+            return [
+                line.split()[1].split("(")[0]
+                for line in header_path.read_text().splitlines()
+            ]
+
+        for name, replacement in (
+            ("_stub_function_names", function_names),
+            ("_clang_version", lambda: self.clang_version),
+        ):
+            patcher = mock.patch.object(dbu, name, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def generate(self) -> str:
+        return dbu.generate_stub_library(self.header, self.cache_dir)
+
+    def test_cached(self):
+        source = self.generate()
+        self.assertIn("void sample_init() {", source)
+        self.assertEqual(self.generate(), source)
+        self.assertEqual(len(self.parsed), 1)
+        self.assertEqual(len(list(self.cache_dir.iterdir())), 1)
+
+    def test_keyed_by_header_contents(self):
+        self.generate()
+        self.header.write_text("void sample_init(void);\nvoid sample_free(void);\n")
+        self.assertIn("void sample_free() {", self.generate())
+        self.assertEqual(len(self.parsed), 2)
+
+        # The key is the contents, not the path or the modification time
+        other = self.root / "other.h"
+        other.write_text(self.header.read_text())
+        dbu.generate_stub_library(other, self.cache_dir)
+        self.assertEqual(len(self.parsed), 2)
+
+    def test_keyed_by_clang_version(self):
+        self.generate()
+        self.clang_version = "clang version 18.1.0"
+        self.generate()
+        self.assertEqual(len(self.parsed), 2)
+
+    def test_without_cache_dir(self):
+        dbu.generate_stub_library(self.header)
+        dbu.generate_stub_library(self.header)
+        self.assertEqual(len(self.parsed), 2)
+
+
+class SdkEnvTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = Path(tmp.name)
+        self.sdk = self.root / "iPhoneOS.sdk"
+        self.sdk.mkdir()
+        self.xcrun_envs: List[Any] = []
+
+        def check_output(command, env=None) -> bytes:
+            self.xcrun_envs.append(env)
+            return f"{self.sdk}\n".encode()
+
+        for patcher in (
+            mock.patch.object(dbu.tracing, "check_output", check_output),
+            mock.patch.dict(dbu._sdk_paths, clear=True),
+            mock.patch.dict(
+                os.environ, {fingerprint.CACHE_DIR_ENV_VAR: str(self.root / "cache")}
+            ),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_developer_dir_of_config_env(self):
+        env = {"DEVELOPER_DIR": str(self.root / "Xcode.app" / "Contents" / "Developer")}
+        config = rutils.CargoConfig("ios", "aarch64", False, env=env)
+        self.assertEqual(dbu.sdk_env(config), {"SDKROOT": str(self.sdk)})
+        self.assertEqual(self.xcrun_envs, [env])
+        self.assertIn(
+            (os.path.realpath(env["DEVELOPER_DIR"]), "iphoneos"), dbu._sdk_paths
+        )
+
+        # Cached in the user cache directory, keyed by the developer directory
+        dbu._sdk_paths.clear()
+        dbu.sdk_env(config)
+        self.assertEqual(len(self.xcrun_envs), 1)
+        other = dict(env, DEVELOPER_DIR=str(self.root / "Other.app"))
+        dbu.sdk_env(rutils.CargoConfig("ios", "aarch64", False, env=other))
+        self.assertEqual(self.xcrun_envs, [env, other])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,207 @@
+import struct
+import tempfile
+import unittest
+from pathlib import Path
+from typing import Dict, Optional
+
+import rust_build_utils.elf as elf
+
+SHT_PROGBITS = 1
+SHT_SYMTAB = 2
+SHT_STRTAB = 3
+
+
+def _note(build_id: bytes, bo: str) -> bytes:
+    desc = build_id + b"\0" * (-len(build_id) % 4)
+    return (
+        struct.pack(bo + "III", 4, len(build_id), elf.NT_GNU_BUILD_ID) + b"GNU\0" + desc
+    )
+
+
+def _elf(
+    sections: Dict[str, bytes],
+    build_id: Optional[bytes] = None,
+    machine: int = elf.EM_X86_64,
+    is_64: bool = True,
+    big_endian: bool = False,
+    section_headers: bool = True,
+    extended_count: bool = False,
+) -> bytes:
+    """A minimal ELF file with the given sections, a PT_NOTE segment and a
+    .note.gnu.build-id section holding `build_id`."""
+    bo = ">" if big_endian else "<"
+    ehsize, phentsize, shentsize = (64, 56, 64) if is_64 else (52, 32, 40)
+
+    note = _note(build_id, bo) if build_id is not None else b""
+    contents = {".note.gnu.build-id": note} if build_id is not None else {}
+    contents.update(sections)
+    names = list(contents) + [".shstrtab"]
+    shstrtab = b"\0" + b"".join(name.encode() + b"\0" for name in names)
+    contents[".shstrtab"] = shstrtab
+
+    data = b""
+    offsets = {}
+    data_start = ehsize + (phentsize if note else 0)
+    for name, content in contents.items():
+        offsets[name] = data_start + len(data)
+        data += content
+    data += b"\0" * (-len(data) % 8)
+    shoff = data_start + len(data) if section_headers else 0
+
+    phdrs = b""
+    if note:
+        if is_64:
+            phdrs = struct.pack(
+                bo + "IIQQQQQQ",
+                elf.PT_NOTE,
+                4,
+                offsets[".note.gnu.build-id"],
+                0,
+                0,
+                len(note),
+                len(note),
+                4,
+            )
+        else:
+            phdrs = struct.pack(
+                bo + "8I",
+                elf.PT_NOTE,
+                offsets[".note.gnu.build-id"],
+                0,
+                0,
+                len(note),
+                len(note),
+                4,
+                4,
+            )
+
+    def shdr(name_offset: int, sh_type: int, offset: int, size: int) -> bytes:
+        if is_64:
+            return struct.pack(
+                bo + "IIQQQQIIQQ", name_offset, sh_type, 0, 0, offset, size, 0, 0, 1, 0
+            )
+        return struct.pack(
+            bo + "10I", name_offset, sh_type, 0, 0, offset, size, 0, 0, 1, 0
+        )
+
+    shnum = len(contents) + 1
+    shdrs = shdr(0, 0, 0, shnum if extended_count else 0)
+    for name, content in contents.items():
+        sh_type = {
+            ".note.gnu.build-id": elf.SHT_NOTE,
+            ".symtab": SHT_SYMTAB,
+            ".shstrtab": SHT_STRTAB,
+        }.get(name, SHT_PROGBITS)
+        shdrs += shdr(
+            shstrtab.index(name.encode() + b"\0"), sh_type, offsets[name], len(content)
+        )
+
+    ident = elf.ELF_MAGIC + bytes(
+        [
+            elf.ELFCLASS64 if is_64 else elf.ELFCLASS32,
+            elf.ELFDATA2MSB if big_endian else elf.ELFDATA2LSB,
+            1,
+        ]
+    )
+    ident += b"\0" * (16 - len(ident))
+    header_fields = (
+        3,  # ET_DYN
+        machine,
+        1,
+        0,
+        ehsize if note else 0,
+        shoff,
+        0,
+        ehsize,
+        phentsize,
+        1 if note else 0,
+        shentsize,
+        0 if extended_count or not section_headers else shnum,
+        0 if not section_headers else shnum - 1,
+    )
+    header = ident + struct.pack(
+        bo + ("HHIQQQIHHHHHH" if is_64 else "HHIIIIIHHHHHH"), *header_fields
+    )
+    return header + phdrs + data + (shdrs if section_headers else b"")
+
+
+class ElfTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def write(self, content: bytes, name: str = "binary") -> Path:
+        path = Path(self.tmp.name) / name
+        path.write_bytes(content)
+        return path
+
+    def test_build_id(self):
+        path = self.write(_elf({".text": b"\x90" * 16}, build_id=bytes(range(20))))
+        self.assertEqual(elf.read_build_id(path), bytes(range(20)).hex())
+
+    def test_build_id_without_section_headers(self):
+        path = self.write(_elf({}, build_id=b"\xab\xcd\xef", section_headers=False))
+        info = elf.read_elf(path)
+        self.assertEqual(info.build_id, "abcdef")
+        self.assertEqual(info.sections, {})
+
+    def test_no_build_id(self):
+        path = self.write(_elf({".text": b"\x90"}))
+        self.assertIsNone(elf.read_build_id(path))
+
+    def test_32_bit_big_endian(self):
+        path = self.write(
+            _elf(
+                {".text": b"\0" * 4},
+                build_id=b"\x01\x02",
+                machine=elf.EM_MIPS,
+                is_64=False,
+                big_endian=True,
+            )
+        )
+        info = elf.read_elf(path)
+        self.assertEqual(info.build_id, "0102")
+        self.assertEqual(info.endianness, "big")
+        self.assertFalse(info.is_64)
+        self.assertEqual(elf.target_arch(info), "mips")
+
+    def test_extended_section_count(self):
+        path = self.write(
+            _elf({".text": b"\x90", ".symtab": b"\0" * 24}, extended_count=True)
+        )
+        self.assertIn(".symtab", elf.read_elf(path).sections)
+
+    def test_is_stripped(self):
+        cases = {
+            "symtab": ({".text": b"\x90", ".symtab": b"\0" * 24}, False),
+            "debug": ({".text": b"\x90", ".debug_info": b"\0" * 8}, False),
+            "zdebug": ({".text": b"\x90", ".zdebug_line": b"\0" * 8}, False),
+            "stripped": ({".text": b"\x90", ".dynsym": b"\0" * 24}, True),
+        }
+        for name, (sections, stripped) in cases.items():
+            with self.subTest(name):
+                path = self.write(_elf(sections, build_id=b"\x01"), name)
+                self.assertEqual(elf.is_stripped(path), stripped)
+
+    def test_is_stripped_without_section_headers(self):
+        path = self.write(_elf({}, build_id=b"\x01", section_headers=False))
+        self.assertTrue(elf.is_stripped(path))
+
+    def test_not_elf(self):
+        # Static libraries are processed by the strip hooks as before
+        archive = self.write(b"!<arch>\n", "lib.a")
+        self.assertFalse(elf.is_stripped(archive))
+        with self.assertRaises(elf.ElfError):
+            elf.read_elf(archive)
+        with self.assertRaises(elf.ElfError):
+            elf.read_elf(self.write(b"", "empty"))
+
+    def test_truncated(self):
+        content = _elf({".text": b"\x90"}, build_id=b"\x01")
+        path = self.write(content[:40])
+        with self.assertRaises(elf.ElfError):
+            elf.read_elf(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,182 @@
+import struct
+import tempfile
+import unittest
+from pathlib import Path
+from typing import List, Tuple
+
+import rust_build_utils.macho as macho
+
+PLATFORM_IOS = 2
+
+
+def _version(major: int, minor: int, patch: int = 0) -> int:
+    return major << 16 | minor << 8 | patch
+
+
+def _build_version(platform: int, minos: int, sdk: int) -> bytes:
+    return struct.pack("<6I", macho.LC_BUILD_VERSION, 24, platform, minos, sdk, 0)
+
+
+def _version_min(cmd: int, version: int, sdk: int) -> bytes:
+    return struct.pack("<4I", cmd, 16, version, sdk)
+
+
+def _macho(cputype: int, cpusubtype: int, commands: List[bytes]) -> bytes:
+    """A 64 bit little endian Mach-O object with the given load commands."""
+    header = struct.pack(
+        "<8I",
+        macho.MH_MAGIC_64,
+        cputype,
+        cpusubtype,
+        1,  # MH_OBJECT
+        len(commands),
+        sum(len(c) for c in commands),
+        0,
+        0,
+    )
+    return header + b"".join(commands) + b"\0" * 64
+
+
+def _archive(members: List[Tuple[str, bytes]]) -> bytes:
+    data = macho.AR_MAGIC
+    for name, content in members:
+        data += f"{name:<16}{0:<12}{0:<6}{0:<6}{644:<8}{len(content):<10}`\n".encode()
+        data += content + b"\n" * (len(content) % 2)
+    return data
+
+
+ARM64 = _macho(
+    macho.CPU_TYPE_ARM64,
+    0,
+    [_build_version(PLATFORM_IOS, _version(11, 0), _version(17, 2))],
+)
+X86_64 = _macho(
+    macho.CPU_TYPE_X86_64,
+    3,
+    [_version_min(macho.LC_VERSION_MIN_IPHONEOS, _version(10, 12, 1), _version(17, 2))],
+)
+
+
+class MachOTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def write(self, content: bytes, name: str) -> Path:
+        path = Path(self.tmp.name) / name
+        path.write_bytes(content)
+        return path
+
+    def test_thin(self):
+        slices = macho.read_slices(self.write(ARM64, "arm64"))
+        self.assertEqual(len(slices), 1)
+        self.assertEqual(slices[0].arch, "arm64")
+        (command,) = slices[0].commands
+        self.assertEqual(
+            command,
+            macho.VersionCommand("LC_BUILD_VERSION", "11.0", "17.2", PLATFORM_IOS),
+        )
+        self.assertEqual(command.get("minos"), "11.0")
+        self.assertEqual(command.get("sdk"), "17.2")
+
+    def test_version_min(self):
+        (command,) = macho.version_commands(self.write(X86_64, "x86_64"))
+        self.assertEqual(command.name, "LC_VERSION_MIN_IPHONEOS")
+        self.assertEqual(command.get("version"), "10.12.1")
+
+    def test_static_library(self):
+        library = _archive(
+            [
+                ("__.SYMDEF", b"\0" * 8),
+                ("a.o", ARM64),
+                ("b.o", ARM64),
+            ]
+        )
+        (arm64,) = macho.read_slices(self.write(library, "lib.a"))
+        self.assertEqual(arm64.arch, "arm64")
+        self.assertEqual([c.version for c in arm64.commands], ["11.0", "11.0"])
+
+    def test_fat(self):
+        offset = 1 << 14
+        header = struct.pack(">2I", macho.FAT_MAGIC, 1) + struct.pack(
+            ">5I", macho.CPU_TYPE_ARM64, 0, offset, len(ARM64), 14
+        )
+        fat = header + b"\0" * (offset - len(header)) + ARM64
+        (arm64,) = macho.read_slices(self.write(fat, "fat"))
+        self.assertEqual(arm64.arch, "arm64")
+        self.assertEqual(arm64.commands[0].version, "11.0")
+
+    def test_invalid(self):
+        truncated = bytearray(ARM64)
+        # sizeofcmds past the end of the file
+        struct.pack_into("<I", truncated, 20, 1 << 20)
+        cases = {
+            "empty": b"",
+            "short": b"\0" * 4,
+            "not macho": b"\0" * 64,
+            "truncated": bytes(truncated),
+        }
+        for name, content in cases.items():
+            with self.subTest(name):
+                with self.assertRaises(macho.MachOError):
+                    macho.read_slices(self.write(content, name.replace(" ", "_")))
+
+    def test_write_fat(self):
+        arm64 = self.write(ARM64, "arm64")
+        x86_64 = self.write(X86_64, "x86_64")
+        output = Path(self.tmp.name) / "universal"
+        macho.write_fat([arm64, x86_64], output)
+
+        slices = macho.read_slices(output)
+        self.assertEqual([s.arch for s in slices], ["arm64", "x86_64"])
+        self.assertEqual(
+            [s.commands for s in slices],
+            [
+                macho.read_slices(arm64)[0].commands,
+                macho.read_slices(x86_64)[0].commands,
+            ],
+        )
+
+        data = output.read_bytes()
+        magic, count = struct.unpack_from(">2I", data)
+        self.assertEqual((magic, count), (macho.FAT_MAGIC, 2))
+        for i, (content, align) in enumerate([(ARM64, 14), (X86_64, 12)]):
+            _, _, offset, size, slice_align = struct.unpack_from(
+                ">5I", data, 8 + i * 20
+            )
+            self.assertEqual(slice_align, align)
+            self.assertEqual(offset % (1 << align), 0)
+            self.assertEqual(data[offset : offset + size], content)
+
+    def test_write_fat_static_libraries(self):
+        libraries = [
+            self.write(_archive([("a.o", ARM64)]), "arm64.a"),
+            self.write(_archive([("a.o", X86_64)]), "x86_64.a"),
+        ]
+        output = Path(self.tmp.name) / "universal.a"
+        macho.write_fat(libraries, output)
+        self.assertEqual(
+            [s.arch for s in macho.read_slices(output)], ["arm64", "x86_64"]
+        )
+
+    def test_write_fat_invalid(self):
+        arm64 = self.write(ARM64, "arm64")
+        output = Path(self.tmp.name) / "universal"
+        with self.assertRaises(macho.MachOError):
+            macho.write_fat([], output)
+        with self.assertRaises(macho.MachOError):
+            macho.write_fat([arm64, self.write(ARM64, "arm64-2")], output)
+        with self.assertRaises(macho.MachOError):
+            macho.write_fat([arm64, self.write(b"\0" * 64, "garbage")], output)
+        macho.write_fat([arm64], output)
+        with self.assertRaises(macho.MachOError):
+            macho.write_fat([output, self.write(X86_64, "x86_64")], output)
+        # Failed writes leave no temporary files behind
+        self.assertEqual(
+            sorted(p.name for p in Path(self.tmp.name).iterdir()),
+            ["arm64", "arm64-2", "garbage", "universal", "x86_64"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
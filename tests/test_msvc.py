@@ -0,0 +1,175 @@
+import json
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from typing import Dict, List, Mapping
+
+import rust_build_utils.msvc as msvc
+
+BASE_ENV = {
+    "PATH": r"C:\Windows;C:\tools",
+    "INCLUDE": r"C:\include",
+    "LIB": r"C:\lib",
+    "PLATFORM": "1",
+}
+
+
+def _vcvarsall_output(env: Mapping[str, str]) -> Dict[str, str]:
+    """What vcvarsall.bat followed by `set` prints, for `env`."""
+    output = dict(env)
+    output.update(
+        {
+            "PATH": r"C:\VS\bin;" + env.get("PATH", ""),
+            "INCLUDE": env.get("INCLUDE", "") + r";C:\VS\include",
+            "LIB": r"C:\VS\lib;" + env.get("LIB", "") + r";C:\SDK\lib",
+            "PLATFORM": "17.0",
+            "VISUALSTUDIOVERSION": "17.0",
+            "": r"C:\work",
+        }
+    )
+    return output
+
+
+class FakeRunner:
+    def __init__(self) -> None:
+        self.calls: List[str] = []
+
+    def __call__(
+        self, vcvarsall: Path, arch: str, env: Mapping[str, str]
+    ) -> Dict[str, str]:
+        self.calls.append(arch)
+        return _vcvarsall_output(env)
+
+
+class EnvDiffTest(unittest.TestCase):
+    def test_diff(self):
+        diff = msvc._env_diff(BASE_ENV, _vcvarsall_output(BASE_ENV))
+        self.assertEqual(
+            diff,
+            {
+                "PATH": {"prepend": "C:\\VS\\bin;", "append": ""},
+                "INCLUDE": {"prepend": "", "append": ";C:\\VS\\include"},
+                "LIB": {"prepend": "C:\\VS\\lib;", "append": ";C:\\SDK\\lib"},
+                # "1" is part of "17.0", not a list entry
+                "PLATFORM": {"set": "17.0"},
+                "VISUALSTUDIOVERSION": {"set": "17.0"},
+            },
+        )
+
+    def test_apply_to_other_base(self):
+        diff = msvc._env_diff(BASE_ENV, _vcvarsall_output(BASE_ENV))
+        other = {"PATH": r"C:\other", "LIB": r"C:\other\lib", "PLATFORM": "2"}
+        self.assertEqual(
+            msvc._apply_env_diff(other, diff),
+            {
+                key: value
+                for key, value in _vcvarsall_output(other).items()
+                if key in diff
+            },
+        )
+
+    def test_apply_to_same_base(self):
+        env = _vcvarsall_output(BASE_ENV)
+        diff = msvc._env_diff(BASE_ENV, env)
+        self.assertEqual(
+            msvc._apply_env_diff(BASE_ENV, diff),
+            {key: env[key] for key in diff},
+        )
+
+    def test_unchanged(self):
+        self.assertEqual(msvc._env_diff(BASE_ENV, BASE_ENV), {})
+
+
+class CachedVcvarsallTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        root = Path(tmp.name)
+        self.vcvarsall = (
+            root
+            / "2022"
+            / "BuildTools"
+            / "VC"
+            / "Auxiliary"
+            / "Build"
+            / "vcvarsall.bat"
+        )
+        self.vcvarsall.parent.mkdir(parents=True)
+        self.vcvarsall.write_text("@echo off\n")
+        self.cache_dir = root / "cache"
+        self.runner = FakeRunner()
+        msvc._vcvarsall_diffs.clear()
+        self.addCleanup(msvc._vcvarsall_diffs.clear)
+
+    def run_vcvarsall(self, arch: str = "amd64", env=BASE_ENV) -> Dict[str, str]:
+        return msvc._cached_vcvarsall(
+            self.vcvarsall, arch, env, self.runner, self.cache_dir
+        )
+
+    def new_process(self) -> None:
+        msvc._vcvarsall_diffs.clear()
+
+    def cache_files(self) -> List[Path]:
+        return sorted(self.cache_dir.iterdir())
+
+    def test_cached_on_disk(self):
+        first = self.run_vcvarsall()
+        self.assertEqual(self.runner.calls, ["amd64"])
+        self.assertEqual(len(self.cache_files()), 1)
+
+        self.new_process()
+        other = {"PATH": r"C:\other"}
+        self.assertEqual(self.run_vcvarsall(env=other)["PATH"], r"C:\VS\bin;C:\other")
+        self.assertEqual(self.run_vcvarsall(), first)
+        self.assertEqual(self.runner.calls, ["amd64"])
+
+    def test_keyed_by_arch(self):
+        self.run_vcvarsall("amd64")
+        self.run_vcvarsall("amd64_arm64")
+        self.run_vcvarsall("amd64")
+        self.assertEqual(self.runner.calls, ["amd64", "amd64_arm64"])
+        self.assertEqual(len(self.cache_files()), 2)
+
+    def test_stale_after_update(self):
+        self.run_vcvarsall()
+        stat = self.vcvarsall.stat()
+        os.utime(self.vcvarsall, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.new_process()
+        self.run_vcvarsall()
+        self.assertEqual(self.runner.calls, ["amd64", "amd64"])
+
+    def test_invalid_cache(self):
+        expected = self.run_vcvarsall()
+        (cache_file,) = self.cache_files()
+        cases = {
+            "corrupted": "{",
+            "not an object": "[]",
+            "no diff": "{}",
+            "unknown change": json.dumps({"diff": {"PATH": {"remove": "x"}}}),
+            "partial change": json.dumps({"diff": {"PATH": {"prepend": "x"}}}),
+            "not a string": json.dumps({"diff": {"PATH": {"set": 1}}}),
+        }
+        for name, content in cases.items():
+            with self.subTest(name):
+                cache_file.write_text(content)
+                self.new_process()
+                self.runner.calls.clear()
+                self.assertEqual(self.run_vcvarsall(), expected)
+                self.assertEqual(self.runner.calls, ["amd64"])
+                # The invalid entry was replaced
+                self.new_process()
+                self.run_vcvarsall()
+                self.assertEqual(self.runner.calls, ["amd64"])
+
+
+class MsvcEnvironmentTest(unittest.TestCase):
+    def test_already_active(self):
+        env = {"VisualStudioVersion": "17.0", "PATH": r"C:\VS\bin"}
+        with msvc.msvc_environment("x64", base_env=env) as activated:
+            self.assertEqual(activated, env)
+            self.assertIsNot(activated, env)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+import rust_build_utils.publish as publish
+
+
+class AtomicWriteTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = Path(tmp.name)
+        self.path = self.root / "state.json"
+
+    def test_replace(self):
+        self.path.write_text("old")
+        with publish.atomic_write(self.path) as f:
+            json.dump({"new": True}, f)
+            # Not visible before the block finishes
+            self.assertEqual(self.path.read_text(), "old")
+        self.assertEqual(json.loads(self.path.read_text()), {"new": True})
+        self.assertEqual(os.listdir(self.root), ["state.json"])
+
+    def test_failure(self):
+        self.path.write_text("old")
+        with self.assertRaises(ValueError):
+            with publish.atomic_write(self.path, "wb") as f:
+                f.write(b"partial")
+                raise ValueError()
+        self.assertEqual(self.path.read_text(), "old")
+        self.assertEqual(os.listdir(self.root), ["state.json"])
+
+    def test_nothing_written(self):
+        with self.assertRaises(FileNotFoundError):
+            with publish.atomic_path(self.path):
+                pass
+        self.assertFalse(self.path.exists())
+
+    def test_concurrent(self):
+        def write(value: int) -> None:
+            for _ in range(20):
+                with publish.atomic_write(self.path) as f:
+                    json.dump({"value": value, "padding": "x" * 4096}, f)
+
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertIn(json.loads(self.path.read_text())["value"], range(4))
+        self.assertEqual(os.listdir(self.root), ["state.json"])
+
+    def test_publish_file(self):
+        src = self.root / "src"
+        src.write_bytes(b"binary")
+        os.chmod(src, 0o755)
+        dst = self.root / "dist" / "binary"
+        dst.parent.mkdir()
+        publish.publish_file(src, dst)
+        self.assertEqual(dst.read_bytes(), b"binary")
+        self.assertEqual(dst.stat().st_mode & 0o777, 0o755)
+        self.assertEqual(os.listdir(dst.parent), ["binary"])
+
+
+if __name__ == "__main__":
+    unittest.main()
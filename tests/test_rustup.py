@@ -0,0 +1,196 @@
+import os
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from typing import Dict, List
+from unittest import mock
+
+import rust_build_utils.rustup as rustup
+
+HOST = "x86_64-unknown-linux-gnu"
+STABLE = f"1.89.0-{HOST}"
+NIGHTLY = f"nightly-2025-06-20-{HOST}"
+
+
+def _state(toolchains: Dict[str, List[str]], default=None) -> Dict:
+    return {"default_toolchain": default, "toolchains": toolchains}
+
+
+PROVISIONED = _state(
+    {
+        STABLE: [
+            f"cargo-{HOST}",
+            f"rust-std-{HOST}",
+            "rust-std-aarch64-linux-android",
+            f"rustc-{HOST}",
+            f"rustfmt-{HOST}",
+        ],
+        NIGHTLY: ["rust-src", f"rust-std-{HOST}"],
+    },
+    default=STABLE,
+)
+
+
+class FindToolchainTest(unittest.TestCase):
+    def test_find(self):
+        self.assertEqual(rustup.find_toolchain(PROVISIONED, "1.89.0"), STABLE)
+        self.assertEqual(rustup.find_toolchain(PROVISIONED, STABLE), STABLE)
+        self.assertEqual(
+            rustup.find_toolchain(PROVISIONED, "nightly-2025-06-20"), NIGHTLY
+        )
+
+    def test_not_installed(self):
+        for toolchain in ("1.89", "1.8", "1.90.0", "nightly", "nightly-2025-06"):
+            with self.subTest(toolchain):
+                self.assertIsNone(rustup.find_toolchain(PROVISIONED, toolchain))
+
+
+class MissingCommandsTest(unittest.TestCase):
+    def test_provisioned(self):
+        self.assertEqual(
+            rustup.missing_commands(
+                PROVISIONED,
+                "1.89.0",
+                targets=[HOST, "aarch64-linux-android"],
+                components=["rustfmt"],
+                make_default=True,
+            ),
+            [],
+        )
+        self.assertEqual(
+            rustup.missing_commands(
+                PROVISIONED, "nightly-2025-06-20", components=["rust-src"]
+            ),
+            [],
+        )
+
+    def test_partial(self):
+        self.assertEqual(
+            rustup.missing_commands(
+                PROVISIONED,
+                "1.89.0",
+                targets=[HOST, "aarch64-apple-ios", "x86_64-apple-ios"],
+                components=["rustfmt", "clippy"],
+            ),
+            [
+                [
+                    "rustup",
+                    "target",
+                    "add",
+                    "--toolchain",
+                    "1.89.0",
+                    "aarch64-apple-ios",
+                    "x86_64-apple-ios",
+                ],
+                ["rustup", "component", "add", "--toolchain", "1.89.0", "clippy"],
+            ],
+        )
+
+    def test_not_default(self):
+        state = dict(PROVISIONED, default_toolchain=NIGHTLY)
+        self.assertEqual(
+            rustup.missing_commands(state, "1.89.0", make_default=True),
+            [["rustup", "default", "1.89.0"]],
+        )
+
+    def test_not_installed(self):
+        self.assertEqual(
+            rustup.missing_commands(
+                _state({}),
+                "1.90.0",
+                targets=[HOST],
+                components=["rustfmt"],
+                make_default=True,
+            ),
+            [
+                ["rustup", "toolchain", "install", "1.90.0"],
+                ["rustup", "default", "1.90.0"],
+                ["rustup", "target", "add", "--toolchain", "1.90.0", HOST],
+                ["rustup", "component", "add", "--toolchain", "1.90.0", "rustfmt"],
+            ],
+        )
+
+
+class LoadStateTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        root = Path(tmp.name)
+        self.home = root / "rustup"
+        (self.home / "toolchains" / STABLE / "lib" / "rustlib").mkdir(parents=True)
+        self.components = self.home / "toolchains" / STABLE / "lib/rustlib/components"
+        self.components.write_text(f"rustc-{HOST}\n")
+        (self.home / "settings.toml").write_text(f'default_toolchain = "{STABLE}"\n')
+        self.env = {"RUSTUP_HOME": str(self.home)}
+        self.cache_file = root / "build" / "rustup-state.json"
+
+        self.queries = 0
+
+        def query_state(env):
+            self.assertEqual(env, self.env)
+            self.queries += 1
+            return _state({STABLE: [f"rustc-{HOST}"]}, default=STABLE)
+
+        patcher = mock.patch.object(rustup, "_query_state", query_state)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def load(self) -> Dict:
+        return rustup.load_state(self.cache_file, self.env)
+
+    def touch(self, path: Path) -> None:
+        st = path.stat()
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    def test_cached(self):
+        state = self.load()
+        self.assertEqual(state["toolchains"], {STABLE: [f"rustc-{HOST}"]})
+        self.assertEqual(self.load(), state)
+        self.assertEqual(self.queries, 1)
+
+    def test_stale_after_changes(self):
+        changes = {
+            "component added": lambda: self.components.write_text(
+                f"rustc-{HOST}\nrustfmt-{HOST}\n"
+            ),
+            "default changed": lambda: self.touch(self.home / "settings.toml"),
+            "toolchain installed": lambda: (
+                self.home / "toolchains" / NIGHTLY / "lib" / "rustlib"
+            ).mkdir(parents=True),
+            "toolchain removed": lambda: shutil.rmtree(
+                self.home / "toolchains" / NIGHTLY
+            ),
+        }
+        self.load()
+        for name, change in changes.items():
+            with self.subTest(name):
+                queries = self.queries
+                change()
+                self.load()
+                self.assertEqual(self.queries, queries + 1)
+                self.load()
+                self.assertEqual(self.queries, queries + 1)
+
+    def test_other_rustup_home(self):
+        self.load()
+        self.env = {"RUSTUP_HOME": str(self.home.parent / "other")}
+        self.load()
+        self.assertEqual(self.queries, 2)
+
+    def test_invalidate(self):
+        self.load()
+        rustup.invalidate(self.cache_file)
+        rustup.invalidate(self.cache_file)
+        self.load()
+        self.assertEqual(self.queries, 2)
+
+    def test_corrupt_cache(self):
+        self.load()
+        self.cache_file.write_text("{")
+        self.load()
+        self.assertEqual(self.queries, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()